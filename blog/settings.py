@@ -93,9 +93,48 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # 接続をリクエストごとに作り直さず、60秒まで使い回す
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# SQLiteの接続を作るたびに実行するPRAGMA。値はそのままSQLに埋め込まれる。
+# WALにすると、書き込み中でも読み込みが待たされなくなる。
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ミリ秒
+    'cache_size': -20000,  # 負の値はKiB単位
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+# キャッシュ
+# 複数のプロセスで動かす場合は、memcachedやファイル等、全プロセスで共有できるものにしてください。
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'nblog1',
+    }
+}
+
+# タグから記事IDへの逆引きインデックスを、キャッシュに持っておく秒数。
+# キャッシュを共有していないプロセス間では、変更がこの秒数だけ遅れて反映されます。
+TAG_INDEX_TIMEOUT = 60 * 5
+
+# 生成したフィードを、キャッシュに持っておく秒数。
+# キャッシュを共有していないプロセス間では、記事の変更がこの秒数だけ遅れて反映されます。
+FEED_CACHE_TIMEOUT = 60 * 5
+
+# ページキャッシュ等の依存先のバージョン(page_cache)を、キャッシュに持っておく秒数。
+# 期限が切れると新しいバージョンになり、それに依存するキャッシュは作り直されます。
+CACHE_VERSION_TIMEOUT = 60 * 60
+
+# サジェスト用のタイトルのインデックスのバージョンを、キャッシュに持っておく秒数。
+# 期限が切れると各プロセスはインデックスを作り直すので、キャッシュを共有していないプロセス間でも、
+# 記事の変更はこの秒数までに反映されます。
+SUGGEST_INDEX_TIMEOUT = 60 * 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -139,22 +178,95 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# メディアファイルは内容のハッシュで保存し、同じ内容のファイルは共有する。
+# 参照されなくなったファイルは、BLOB_GC_GRACE秒後にジョブで削除する。
+DEFAULT_FILE_STORAGE = 'nblog1.storage.ContentAddressedStorage'
+BLOB_GC_GRACE = 60 * 60
+
+# メディアファイルの配信方法。'django'、'x-accel-redirect'(nginx)、'x-sendfile'(Apache等)のどれか。
+# x-accel-redirectの場合は、MEDIA_ACCEL_PREFIXをMEDIA_ROOTに対応させたinternalなlocationをnginxに設定する。
+MEDIA_SENDFILE = 'django'
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# ファイルの分割アップロードで、1回に送るサイズ・ファイルの最大サイズ・途中のものを削除するまでの秒数
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_MAX_SIZE = 100 * 1024 * 1024
+UPLOAD_EXPIRE = 60 * 60 * 24
+
 # サイトマップフレームワークで使う変数です。
 SITE_ID = 1
 
+# サイトマップの1ページに載せるURLの数
+SITEMAP_PAGE_SIZE = 1000
+
+# 圧縮したサイトマップを、キャッシュに持っておく秒数。
+# キャッシュを共有していないプロセス間では、記事の変更がこの秒数だけ遅れて反映されます。
+SITEMAP_CACHE_TIMEOUT = 60 * 60
+
 # マークダウンの拡張
+# 変えると、保存済みの本文のHTMLは全て古くなります(閲覧時に1件ずつ変換し直します)。
+# 変えた後は、python manage.py render_markdown でまとめて変換し直してください。
 MARKDOWN_EXTENSIONS = [
     'markdown.extensions.extra',
     'markdown.extensions.toc',
+    'nblog1.rendering:ResponsiveImageExtension',
 ]
 
+# 縮小版を作る画像の拡張子。アップロード後、ジョブ(nblog1.create_image_variants)で作ります。
+IMAGE_VARIANT_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp']
+
+# 画像の縮小版を作る幅、JPEG・WebPの品質、縮小に使うプロセスの数(NoneならCPUの数)
+IMAGE_VARIANT_WIDTHS = [480, 960, 1440]
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_VARIANT_WORKERS = None
+
+# 記事中の画像のsizes属性
+IMAGE_SIZES = '(max-width: 960px) 100vw, 960px'
+
 # メールをコンソールに表示する。
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# コメント・返信の通知メールのジョブを、コミット後にWebのプロセス内のスレッドですぐに実行する。
+# Falseの場合は、run_jobsコマンドのワーカーだけが実行する。
+DRAIN_JOBS_AFTER_COMMIT = True
+
+# 記事のメール通知で、1つの接続でまとめて送信する件数
+EMAIL_PUSH_BATCH_SIZE = 100
+
+# まとめて受け取る宛先へ、新着記事のお知らせを送る間隔(秒)
+EMAIL_DIGEST_INTERVAL = 60 * 60 * 24
+
 USE_LINE_BOT = False
 
+# LINEのMessaging APIのURL
+LINE_API_ENDPOINT = 'https://api.line.me'
+
 USE_WEB_PUSH = False
 
+ONE_SIGNAL_API_ENDPOINT = 'https://onesignal.com/api/v1/notifications'
+
+# 外部APIへの通知に使うHTTPクライアントの設定。'default'が共通の値で、連携先ごとに上書きできる。
+# タイムアウトとRESET_TIMEOUTは秒。FAILURE_THRESHOLD回続けて失敗すると、RESET_TIMEOUTの間は送信しない。
+OUTBOUND_HTTP = {
+    'default': {
+        'CONNECT_TIMEOUT': 3.05,
+        'READ_TIMEOUT': 10,
+        'POOL_SIZE': 10,
+        'MAX_CONCURRENCY': 4,
+        'FAILURE_THRESHOLD': 5,
+        'RESET_TIMEOUT': 60,
+    },
+    'line': {},
+    'onesignal': {},
+}
+
+# 記事一覧を、OFFSETではなく(更新日, pk)のカーソルでページ送りする。
+USE_KEYSET_PAGINATION = False
+
+# 匿名ユーザーへの記事一覧・記事詳細のページをキャッシュする。
+USE_PAGE_CACHE = False
+PAGE_CACHE_TIMEOUT = 60 * 60
+
 LOGIN_URL = 'admin:index'
 
 # allauth
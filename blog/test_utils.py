@@ -0,0 +1,38 @@
+"""複数のアプリのテストで使う、テスト用のヘルパー"""
+import re
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+# EXPLAIN QUERY PLANで、インデックスを使わずにテーブル全体を読む行
+FULL_SCAN_RE = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)( AS \w+)?$')
+
+
+class QueryPlanMixin:
+    """ページの表示で実行したSELECTに、テーブル全体を読むもの(フルスキャン)がないことを確かめるMixin
+
+    実行したクエリを記録し、それぞれをEXPLAIN QUERY PLANにかけます。SQLiteでのみ使えます。
+
+    """
+    # 件数が少ないと分かっているので、全体を読んでもよいテーブル
+    full_scan_allowed = ()
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        for query in context.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT'):
+                continue
+            for detail in self.explain(sql):
+                match = FULL_SCAN_RE.match(detail)
+                if match and match.group('table') not in self.full_scan_allowed:
+                    self.fail(f'{url} のクエリがフルスキャンになっています。\n{sql}\n{detail}')
@@ -13,20 +13,22 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
 from django.contrib import admin
 from django.conf import settings
-from django.urls import path, include
-from django.conf.urls.static import static
+from django.urls import path, include, re_path
+from nblog1 import media, sitemaps
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('blog/', include('nblog1.urls')),
+    path('sitemap.xml', sitemaps.index, name='sitemap_index'),
+    path('sitemap-<section>.xml', sitemaps.section, name='sitemap_section'),
     path('accounts/', include('allauth.urls')), 
     path('', include('discussion.urls')), # new
 ]
 
-# 開発環境でのメディアファイルの配信設定
-urlpatterns += static(
-    settings.MEDIA_URL,
-    document_root=settings.MEDIA_ROOT
-)
\ No newline at end of file
+# メディアファイルの配信。MEDIA_SENDFILEで、nginx等に任せることもできる。
+urlpatterns += [
+    re_path(r'^{}(?P<path>.+)$'.format(re.escape(settings.MEDIA_URL.lstrip('/'))), media.serve, name='media'),
+]
\ No newline at end of file
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussion', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='discuser',
+            index=models.Index(fields=['discussion', 'user'], name='discuser_disc_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitation',
+            index=models.Index(fields=['invitee', 'exp_dt'], name='invitation_invitee_exp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='invitation',
+            index=models.Index(fields=['discussion', 'exp_dt'], name='invitation_disc_exp_idx'),
+        ),
+    ]
@@ -27,6 +27,9 @@ class DiscUser(models.Model):
     
     class Meta:
         verbose_name = verbose_name_plural = 'グループユーザ'
+        indexes = [
+            models.Index(fields=['discussion', 'user'], name='discuser_disc_user_idx'),
+        ]
     
     def __str__(self):
         first_name = self.user.first_name
@@ -65,6 +68,10 @@ class Invitation(models.Model):
     class Meta:
         verbose_name = verbose_name_plural = 'グループへの招待'
         ordering = ['exp_dt']
+        indexes = [
+            models.Index(fields=['invitee', 'exp_dt'], name='invitation_invitee_exp_idx'),
+            models.Index(fields=['discussion', 'exp_dt'], name='invitation_disc_exp_idx'),
+        ]
     
     def __str__(self):
         return f'{self.invitee} さんへの {self.discussion} への招待'
@@ -1,3 +1,40 @@
+from datetime import timedelta
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from blog.test_utils import QueryPlanMixin
+from .models import Discussion, DiscUser, Invitation
 
-# Create your tests here.
+
+class DiscussionQueryPlanTests(QueryPlanMixin, TestCase):
+    '''グループ一覧・グループユーザ一覧のクエリが、グループやユーザが多くてもインデックスを使うことの確認
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        user_model = get_user_model()
+        user_model.objects.bulk_create([user_model(username=f'user{i}') for i in range(300)])
+        users = list(user_model.objects.order_by('pk'))
+        Discussion.objects.bulk_create([Discussion(name=f'グループ{i}') for i in range(300)])
+        discussions = list(Discussion.objects.order_by('pk'))
+        DiscUser.objects.bulk_create([
+            DiscUser(discussion=discussion, user=user, is_owner=i == 0)
+            for discussion in discussions for i, user in enumerate(users[:10])
+        ])
+        exp_dt = timezone.now() + timedelta(days=7)
+        Invitation.objects.bulk_create([
+            Invitation(discussion=discussion, inviter=users[0], invitee=user, exp_dt=exp_dt)
+            for discussion in discussions for user in users[10:20]
+        ])
+        cls.user = users[0]
+        cls.discussion = discussions[0]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_disc_list(self):
+        self.assertNoFullScan(reverse('discussion:disc_list'))
+
+    def test_usr_list(self):
+        self.assertNoFullScan(reverse('discussion:usr_list', kwargs={'disc_id': self.discussion.pk}))
@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.utils import timezone
 from .forms import AdminPostCreateForm
-from .models import Post, Comment, Reply, Tag, EmailPush, LinePush
+from .jobs import enqueue, request_info
+from .models import Post, Comment, Reply, Tag, EmailPush, LinePush, EmailPushLog, EmailDigest, Job
 
 
 class ReplyInline(admin.StackedInline):
@@ -13,11 +15,19 @@ class CommentAdmin(admin.ModelAdmin):
 
 
 def notify(modeladmin, request, queryset):
-    """通知を送信アクション"""
+    """通知を送信アクション
+
+    送信には時間がかかるので、ここではジョブを登録するだけにし、run_jobsコマンドで送信します。
+
+    """
     for post in queryset:
-        post.line_push(request)
-        post.browser_push()
-        post.email_push(request)
+        payload = {
+            'post_pk': post.pk,
+            **request_info(request),
+        }
+        for name in ('nblog1.notify_line', 'nblog1.notify_browser', 'nblog1.notify_email'):
+            enqueue(name, payload, key=f'{name}:{post.pk}')
+        modeladmin.message_user(request, f'「{post}」の通知を予約しました。')
 
 
 class PostAdmin(admin.ModelAdmin):
@@ -34,10 +44,45 @@ class PostAdmin(admin.ModelAdmin):
     title_len.short_description = 'タイトルの文字数'
 
 
+def retry_jobs(modeladmin, request, queryset):
+    """失敗したジョブを再実行するアクション"""
+    count = queryset.filter(status=Job.DEAD).update(status=Job.PENDING, attempts=0, run_at=timezone.now())
+    modeladmin.message_user(request, f'{count}件のジョブを再実行します。')
+
+
+retry_jobs.short_description = '失敗したジョブを再実行'
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'key', 'status', 'attempts', 'run_at', 'created_at']
+    list_filter = ['status', 'name']
+    search_fields = ['key']
+    actions = [retry_jobs]
+    ordering = ('-created_at',)
+
+
+class EmailPushAdmin(admin.ModelAdmin):
+    list_display = ['mail', 'is_active', 'digest']
+    list_filter = ['is_active', 'digest']
+
+
+class EmailPushLogAdmin(admin.ModelAdmin):
+    list_display = ['post', 'sent_count', 'started_at', 'finished_at']
+    readonly_fields = ['post', 'last_push_pk', 'sent_count', 'started_at', 'finished_at']
+
+
+class EmailDigestAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'sent_count', 'started_at', 'finished_at']
+    readonly_fields = ['last_push_pk', 'sent_count', 'started_at', 'finished_at']
+
+
 notify.short_description = '通知を送信'
 admin.site.register(Post, PostAdmin)
 admin.site.register(Comment, CommentAdmin)
 admin.site.register(Reply)
 admin.site.register(Tag)
-admin.site.register(EmailPush)
+admin.site.register(EmailPush, EmailPushAdmin)
 admin.site.register(LinePush)
+admin.site.register(EmailPushLog, EmailPushLogAdmin)
+admin.site.register(EmailDigest, EmailDigestAdmin)
+admin.site.register(Job, JobAdmin)
@@ -8,3 +8,5 @@ class Nblog1Config(AppConfig):
         # シグナルのロード
         # デコレーターで登録しているので、signals.pyを読み込む必要があるため
         from . import signals
+        # ジョブもデコレーターで登録しているので、tasks.pyを読み込む
+        from . import tasks
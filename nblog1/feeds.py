@@ -1,11 +1,61 @@
+import hashlib
+from django.conf import settings
 from django.contrib.syndication.views import Feed
-from django.shortcuts import resolve_url
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404, resolve_url
 from django.urls import reverse_lazy
+from django.utils.cache import get_conditional_response
 from django.utils.feedgenerator import Atom1Feed
-from .models import Post
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from . import page_cache
+from .models import Post, Tag
 
 
-class RssLatestPostsFeed(Feed):
+class CachedFeedMixin:
+    """生成したフィードをキャッシュし、ETag/Last-Modifiedで条件付きGETに応えるMixin
+
+    フィードは、記事やタグが変わった後の最初のリクエストで一度だけ生成し、
+    それ以降はキャッシュから返します。キャッシュが有効な間は、データベースにはアクセスしません。
+    If-None-MatchやIf-Modified-Sinceで変更がなければ、304を返します。
+    キャッシュを共有していないプロセスでは他のプロセスでの変更に気づかないので、
+    FEED_CACHE_TIMEOUT秒経ったフィードは作り直します。
+
+    """
+
+    def get_feed_dependencies(self, *args, **kwargs):
+        """フィードが依存するもの。page_cacheの依存先の名前で返す。"""
+        return [page_cache.POSTS, page_cache.TAGS]
+
+    def __call__(self, request, *args, **kwargs):
+        url = request.build_absolute_uri(request.path)
+        key = 'nblog1:feed:' + hashlib.md5(url.encode('utf-8')).hexdigest()
+        entry = cache.get(key)
+        if entry is None or page_cache.get_versions(entry['versions']) != entry['versions']:
+            dependencies = self.get_feed_dependencies(*args, **kwargs)
+            versions = page_cache.get_versions(dependencies)
+            response = super().__call__(request, *args, **kwargs)
+            entry = {
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'etag': quote_etag(hashlib.md5(response.content).hexdigest()),
+                'last_modified': parse_http_date_safe(response.get('Last-Modified', '')),
+                'versions': versions,
+            }
+            cache.set(key, entry, settings.FEED_CACHE_TIMEOUT)
+
+        response = get_conditional_response(
+            request, etag=entry['etag'], last_modified=entry['last_modified'],
+        )
+        if response is None:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+        response['ETag'] = entry['etag']
+        if entry['last_modified'] is not None:
+            response['Last-Modified'] = http_date(entry['last_modified'])
+        return response
+
+
+class RssLatestPostsFeed(CachedFeedMixin, Feed):
     """最新記事のフィード。"""
     link = reverse_lazy('nblog1:top')
 
@@ -39,3 +89,32 @@ class RssLatestPostsFeed(Feed):
 
 class AtomLatestPostsFeed(RssLatestPostsFeed):
     feed_type = Atom1Feed
+
+
+class RssTagPostsFeed(RssLatestPostsFeed):
+    """タグごとの最新記事のフィード。"""
+
+    def get_feed_dependencies(self, pk):
+        return [page_cache.POSTS, page_cache.TAGS, page_cache.tag_dependency(pk)]
+
+    def get_object(self, request, pk):
+        return get_object_or_404(Tag, pk=pk)
+
+    def title(self, obj):
+        return obj.name
+
+    def description(self, obj):
+        return f'「{obj.name}」タグの最新記事'
+
+    def link(self, obj):
+        return '{}?tags={}'.format(resolve_url('nblog1:top'), obj.pk)
+
+    def items(self, obj):
+        """タグが紐づいた記事一覧を返す。"""
+        return obj.post_set.filter(
+            is_public=True
+        ).order_by('-created_at').prefetch_related('tags')[:15]
+
+
+class AtomTagPostsFeed(RssTagPostsFeed):
+    feed_type = Atom1Feed
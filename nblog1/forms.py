@@ -1,5 +1,7 @@
+import os
 from django import forms
-from django.db.models import Count
+from django.conf import settings
+from django.db.models import F
 from django.core.files.storage import default_storage
 from django.urls import reverse_lazy
 from .fields import SimpleCaptchaField
@@ -17,7 +19,7 @@ class PostSearchForm(forms.Form):
     tags = forms.ModelMultipleChoiceField(
         label='タグでの絞り込み',
         required=False,
-        queryset=Tag.objects.annotate(post_count=Count('post')).order_by('name'),
+        queryset=Tag.objects.annotate(post_count=F('public_post_count')).order_by('name'),
         widget=CustomCheckboxSelectMultiple,
     )
 
@@ -63,11 +65,15 @@ class ReplyCreateForm(forms.ModelForm):
 
 
 class EmailForm(forms.ModelForm):
-    """Eメール通知の登録用フォーム"""
+    """Eメール通知の登録用フォーム
+
+    仮登録のままのメールアドレスであれば、そのレコードをinstanceに渡して使い回してください。
+
+    """
 
     class Meta:
         model = EmailPush
-        fields = ('mail',)
+        fields = ('mail', 'digest')
         widgets = {
             'mail': forms.EmailInput(attrs={'placeholder': 'メールアドレス'})
         }
@@ -77,10 +83,25 @@ class EmailForm(forms.ModelForm):
             }
         }
 
-    def clean_email(self):
-        mail = self.cleaned_data['mail']
-        EmailPush.objects.filter(mail=mail, is_active=False).delete()
-        return mail
+
+class ChunkedUploadForm(forms.Form):
+    """分割アップロードの開始用フォーム"""
+    name = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1)
+    sha256 = forms.RegexField(regex=r'^[0-9a-f]{64}$')
+
+    def clean_name(self):
+        # ディレクトリは付けさせない
+        name = os.path.basename(self.cleaned_data['name'])
+        if not name:
+            raise forms.ValidationError('ファイル名を入力してください。')
+        return name
+
+    def clean_size(self):
+        size = self.cleaned_data['size']
+        if size > settings.UPLOAD_MAX_SIZE:
+            raise forms.ValidationError('ファイルが大きすぎます。')
+        return size
 
 
 class FileUploadForm(forms.Form):
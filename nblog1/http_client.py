@@ -0,0 +1,91 @@
+"""外部APIへの通知(LINE、OneSignal等)に使うHTTPクライアント。
+
+連携先ごとに1つのクライアントをプロセス内で共有し、次のことを行います。
+
+- requests.Sessionで接続を使い回す(keep-alive)
+- 接続・読み込みのタイムアウトを必ず付ける
+- 同時に送るリクエストの数を制限する
+- 失敗(接続エラーや5xx)が続いたら、しばらくリクエストを送らずにすぐ失敗させる(サーキットブレーカー)
+
+設定はOUTBOUND_HTTPで、'default'に共通の値を、連携先の名前をキーにそれぞれの値を書きます。
+
+"""
+import threading
+import time
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+
+class CircuitOpenError(Exception):
+    """失敗が続いているため、リクエストを送らなかった"""
+
+
+class HttpClient:
+    """接続の使い回し・タイムアウト・同時実行数の制限・サーキットブレーカーを備えたHTTPクライアント"""
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10, pool_size=10,
+                 max_concurrency=4, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def _check_circuit(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'{self.name}への接続は、失敗が続いているため停止中です。')
+            # 一定時間が経ったので、1回だけ試す。失敗すればまた停止する。
+            self._opened_at = time.monotonic()
+
+    def _record(self, success):
+        with self._lock:
+            if success:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                if self._failures >= self.failure_threshold:
+                    self._opened_at = time.monotonic()
+
+    def request(self, method, url, **kwargs):
+        """リクエストを送る。タイムアウトを省略した場合は、設定の値を使う。"""
+        self._check_circuit()
+        kwargs.setdefault('timeout', self.timeout)
+        with self._semaphore:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                self._record(False)
+                raise
+        self._record(response.status_code < 500)
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    """連携先の名前に対応する、共有のHttpClientを返す。"""
+    config = {**settings.OUTBOUND_HTTP.get('default', {}), **settings.OUTBOUND_HTTP.get(name, {})}
+    key = (name, tuple(sorted(config.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = HttpClient(name, **{k.lower(): v for k, v in config.items()})
+        return client
@@ -0,0 +1,153 @@
+"""画像の派生ファイル(縮小版・WebP)の作成。
+
+アップロードされた画像から、IMAGE_VARIANT_WIDTHSの幅に縮小したものと、WebPに変換したものを作ります。
+派生ファイルも他のファイルと同じく、ContentAddressedStorageの blobs/ に内容のハッシュで保存します。
+作った派生ファイルはResizedImageに元の画像のSHA-256と一緒に記録し、同じ画像が何度アップロードされても、
+記録から探して使い回すので作り直しません(参照数も増やしません)。縮小と変換は、プロセスプールで並行して行います。
+
+マークダウンの変換時には、rendering.ResponsiveImageExtensionがこれを使ってsrcset等を付けます。
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import django
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+from .models import ResizedImage
+
+# 派生ファイルを作る画像の形式と、その拡張子・MIMEタイプ
+FORMATS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'PNG': ('.png', 'image/png'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+# Exifの向き(Orientation)のうち、縦横が入れ替わるもの
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+BLOCK_SIZE = 64 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """派生ファイルの作成に使う、プロセス内で共有のプロセスプールを返す。
+
+    プールはプロセスが終わるまで残るので、Webのプロセスではなくrun_jobsのワーカーから使ってください。
+
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_VARIANT_WORKERS, initializer=django.setup)
+        return _executor
+
+
+def resize(source_path, dest_path, width, format):
+    """source_pathの画像を幅widthに縮小し、formatの形式でdest_pathに保存する。プロセスプールで実行します。"""
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if width < image.width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        if format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(dest_path, format, quality=settings.IMAGE_VARIANT_QUALITY, optimize=True)
+
+
+@contextmanager
+def local_path(name):
+    """ストレージのファイルを読めるローカルのパスを返す。ローカルにないストレージなら、一時ファイルにコピーする。"""
+    try:
+        yield default_storage.path(name)
+    except NotImplementedError:
+        suffix = os.path.splitext(name)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix) as temp, default_storage.open(name) as file:
+            shutil.copyfileobj(file, temp, BLOCK_SIZE)
+            temp.flush()
+            yield temp.name
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_variants(name):
+    """ストレージのnameの画像から派生ファイルを作り、ResizedImageを返す。対応していない画像ならNone。"""
+    with local_path(name) as path:
+        try:
+            with Image.open(path) as image:
+                format = image.format
+                width, height = image.size
+                if image.getexif().get(0x0112) in ROTATED_ORIENTATIONS:
+                    width, height = height, width
+        except (OSError, Image.DecompressionBombError):
+            # 画像ではないか、展開すると大きすぎる画像
+            return None
+        if format not in FORMATS:
+            return None
+
+        sha256 = file_sha256(path)
+        variants = find_variants(sha256)
+        if variants is None:
+            variants = _resize_all(path, format, width)
+            # 作っている間に、同じ画像の派生ファイルが他で作られていたら、そちらを使い、作った分の参照は戻す
+            same_variants = find_variants(sha256)
+            if same_variants is not None:
+                for variant in variants:
+                    default_storage.delete(variant['name'])
+                variants = same_variants
+
+    resized, _ = ResizedImage.objects.update_or_create(name=name, defaults={
+        'sha256': sha256,
+        'type': FORMATS[format][1],
+        'width': width,
+        'height': height,
+        'variants': variants,
+    })
+    return resized
+
+
+def find_variants(sha256):
+    """SHA-256がsha256の画像について、作成済みの派生ファイルの一覧を返す。まだなければNone。"""
+    same_image = ResizedImage.objects.filter(sha256=sha256).first()
+    return None if same_image is None else same_image.variants
+
+
+def _resize_all(path, format, width):
+    """縮小版とWebPを並行して作り、ストレージに保存する。派生ファイルの一覧を返す。"""
+    widths = [variant_width for variant_width in settings.IMAGE_VARIANT_WIDTHS if variant_width < width]
+    # 元の形式では縮小版だけを、WebPでは元の幅のものも作る
+    tasks = [(variant_width, format) for variant_width in widths]
+    if format != 'WEBP':
+        tasks += [(variant_width, 'WEBP') for variant_width in widths + [width]]
+
+    executor = get_executor()
+    variants = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        futures = []
+        for variant_width, variant_format in tasks:
+            extension = FORMATS[variant_format][0]
+            temp_path = os.path.join(temp_dir, f'{variant_width}{extension}')
+            future = executor.submit(resize, path, temp_path, variant_width, variant_format)
+            futures.append((future, temp_path, variant_width, variant_format))
+
+        for future, temp_path, variant_width, variant_format in futures:
+            future.result()
+            extension, type = FORMATS[variant_format]
+            # 保存する名前は内容から決まるので、ここでは拡張子だけが使われる
+            with open(temp_path, 'rb') as file:
+                variant_name = default_storage.save(f'{variant_width}{extension}', File(file))
+            variants.append({'name': variant_name, 'width': variant_width, 'type': type})
+    return variants
@@ -0,0 +1,212 @@
+"""データベースを使ったジョブキュー。
+
+メールやプッシュ通知の送信のように時間がかかる処理は、リクエストの中では実行せず、
+Jobモデルに登録(enqueue)だけしておき、run_jobsコマンドのワーカーが実行します。
+SQLiteだけで動き、外部のメッセージブローカーは必要ありません。
+
+処理は、@job('名前')で登録した関数です。引数はJSONにできる辞書で渡します。
+
+    @job('nblog1.notify_email')
+    def notify_email(payload):
+        ...
+
+    enqueue('nblog1.notify_email', {'post_pk': 1}, key='notify_email:1')
+
+"""
+import logging
+import threading
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpRequest
+from django.utils import timezone
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# 再実行までの間隔(秒)。失敗するたびに倍になる。
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 60 * 60
+
+# 実行中のまま、この時間を過ぎたジョブはワーカーが落ちたものとみなし、再実行する
+STALE_RUNNING_TIMEOUT = timedelta(minutes=30)
+
+_registry = {}
+
+
+def job(name):
+    """関数を、ジョブとして実行できるように登録するデコレータ"""
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, payload=None, key='', run_at=None, max_attempts=5, drain=False):
+    """ジョブを登録する。
+
+    keyを指定した場合、同じキーのジョブが待機中か実行中であれば、新たには登録せずにそれを返します。
+    同時に登録された場合も、一意制約(job_active_key_unique)により登録されるのは1つだけです。
+    呼び出し元のトランザクションの中で登録されるので、ロールバックされればジョブも登録されません。
+    drain=Trueならば、コミットされた後にバックグラウンドのスレッドですぐに実行します(アウトボックス)。
+
+    """
+    while True:
+        if key:
+            existing = Job.objects.filter(key=key, status__in=(Job.PENDING, Job.RUNNING)).first()
+            if existing is not None:
+                return existing
+        try:
+            # 一意制約の違反で呼び出し元のトランザクションが壊れないよう、セーブポイントの中で登録する
+            with transaction.atomic():
+                job = Job.objects.create(
+                    name=name, payload=payload or {}, key=key,
+                    run_at=run_at or timezone.now(), max_attempts=max_attempts,
+                )
+        except IntegrityError:
+            if not key:
+                raise
+            # 同じキーのジョブが同時に登録された。そちらを返す。
+            continue
+        break
+    if drain and settings.DRAIN_JOBS_AFTER_COMMIT:
+        transaction.on_commit(lambda: drainer.wake(name))
+    return job
+
+
+def request_info(request):
+    """ジョブの中でテンプレートを描画するため、リクエストのスキームとホストを辞書にする。"""
+    return {'scheme': request.scheme, 'host': request.get_host()}
+
+
+class JobRequest(HttpRequest):
+    """ジョブの中でテンプレートを描画するためのリクエスト
+
+    メールのテンプレートでは、request.schemeとrequest.get_hostでURLを組み立てているため、
+    元のリクエストのスキームとホストだけを持たせています。
+
+    """
+
+    def __init__(self, scheme, host):
+        super().__init__()
+        self._scheme = scheme
+        self.META['HTTP_HOST'] = host
+
+    def _get_scheme(self):
+        return self._scheme
+
+
+def build_request(payload):
+    """request_infoで作った辞書から、JobRequestを作る。"""
+    return JobRequest(payload['scheme'], payload['host'])
+
+
+def _retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY))
+
+
+def recover_stale_jobs():
+    """実行中のまま止まっているジョブを、待機中に戻す。"""
+    return Job.objects.filter(
+        status=Job.RUNNING, locked_at__lt=timezone.now() - STALE_RUNNING_TIMEOUT,
+    ).update(status=Job.PENDING, locked_at=None)
+
+
+def claim_next(names=None):
+    """実行予定日時を過ぎたジョブを1つ、実行中にして返す。なければNone。
+
+    namesを指定した場合は、その処理名のジョブだけを対象にします。
+
+    """
+    now = timezone.now()
+    queryset = Job.objects.filter(status=Job.PENDING, run_at__lte=now)
+    if names is not None:
+        queryset = queryset.filter(name__in=names)
+    pks = queryset.order_by('run_at', 'pk').values_list('pk', flat=True)[:10]
+    for pk in pks:
+        # 他のワーカーが先に取った場合は、更新件数が0になる
+        claimed = Job.objects.filter(pk=pk, status=Job.PENDING).update(
+            status=Job.RUNNING, locked_at=now,
+        )
+        if claimed:
+            return Job.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    """ジョブを実行し、結果に応じて完了・再実行待ち・失敗にする。"""
+    job.attempts += 1
+    func = _registry.get(job.name)
+    try:
+        if func is None:
+            raise LookupError(f'登録されていないジョブです: {job.name}')
+        func(job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.DEAD
+            logger.error('ジョブ %s(%d)は%d回失敗しました。', job.name, job.pk, job.attempts)
+        else:
+            job.status = Job.PENDING
+            job.run_at = timezone.now() + _retry_delay(job.attempts)
+            logger.warning('ジョブ %s(%d)が失敗しました。%sに再実行します。', job.name, job.pk, job.run_at)
+    else:
+        job.status = Job.DONE
+        job.last_error = ''
+    job.locked_at = None
+    job.save(update_fields=['attempts', 'status', 'run_at', 'locked_at', 'last_error'])
+    return job.status == Job.DONE
+
+
+def run_pending(limit=None, names=None):
+    """実行できるジョブを順に実行する。実行した件数を返す。"""
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next(names)
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+class Drainer:
+    """コミットされたジョブを、Webのプロセス内のバックグラウンドのスレッドで実行する
+
+    リクエストを処理するスレッドはジョブの登録だけを行い、メールの送信等を待ちません。
+    プロセスが終了する等で実行できなかったジョブは、run_jobsコマンドのワーカーが実行します。
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = set()
+        self._event = threading.Event()
+        self._thread = None
+
+    def wake(self, name):
+        """処理名nameのジョブを実行するよう、スレッドに伝える。"""
+        with self._lock:
+            self._names.add(name)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='nblog1-job-drainer', daemon=True)
+                self._thread.start()
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            with self._lock:
+                names = list(self._names)
+            try:
+                run_pending(names=names)
+            except Exception:
+                logger.exception('ジョブの実行中にエラーが発生しました。')
+            finally:
+                # このスレッド用のデータベース接続は、使い終わったら閉じる
+                connection.close()
+
+
+drainer = Drainer()
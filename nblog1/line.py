@@ -0,0 +1,98 @@
+"""LINEのMessaging APIでの通知。
+
+友だち1人ずつにpush messageを送るのではなく、multicastで最大500人ずつまとめて送信します。
+まとめた送信は、共有のHTTPクライアントで接続を使い回しながら並行して行い、
+429(レート制限)が返ってきた場合は待ってから送り直します。
+宛先は、送信中のまとまりが同時実行数に達したら空くのを待ってから読み進めるので、
+全ての宛先を一度にメモリへ読み込むことはありません。
+送信に失敗したまとまりはon_errorに渡し、他のまとまりの送信は続けます。
+呼び出し側はそのまとまりだけを送り直すジョブにするので、送信できた宛先に重ねて送ることはありません。
+
+"""
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from .http_client import get_client
+
+# multicastで一度に送信できる宛先の最大数
+MULTICAST_MAX_RECIPIENTS = 500
+
+# 429が返ってきた場合に送り直す回数と、Retry-Afterがない場合に待つ秒数
+MAX_RETRIES = 5
+RETRY_DELAY = 1.0
+
+
+def chunked(iterable, size):
+    """iterableをsize件ずつのリストにして返すジェネレータ"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class LineApiError(Exception):
+    """LINEのAPIがエラーを返した"""
+
+    def __init__(self, status_code, body):
+        super().__init__(f'LINE API error {status_code}: {body}')
+        self.status_code = status_code
+
+
+class LineClient:
+    """LINEのMessaging APIのクライアント
+
+    通信には、共有のHTTPクライアント(http_client.get_client('line'))を使います。
+
+    """
+
+    def __init__(self, channel_access_token, endpoint='https://api.line.me'):
+        self.endpoint = endpoint.rstrip('/')
+        self.headers = {'Authorization': f'Bearer {channel_access_token}'}
+        self.http = get_client('line')
+
+    def _multicast(self, user_ids, messages):
+        url = f'{self.endpoint}/v2/bot/message/multicast'
+        for attempt in range(MAX_RETRIES + 1):
+            response = self.http.post(url, headers=self.headers, json={'to': user_ids, 'messages': messages})
+            if response.status_code == 429 and attempt < MAX_RETRIES:
+                retry_after = response.headers.get('Retry-After')
+                time.sleep(float(retry_after) if retry_after else RETRY_DELAY * 2 ** attempt)
+                continue
+            if response.status_code != 200:
+                raise LineApiError(response.status_code, response.text)
+            return len(user_ids)
+
+    def multicast(self, user_ids, messages, on_error=None):
+        """宛先をまとめて、並行してメッセージを送信する。送信した宛先の数を返す。
+
+        user_idsはイテレータでも構いません。送信中のまとまりが同時実行数に達している間は、続きを読み込みません。
+        on_errorを渡した場合、送信に失敗したまとまりは on_error(宛先のリスト, 例外) に渡して、残りの送信を続けます。
+        渡さなければ、LineApiErrorを送出します。
+
+        """
+        def result(future):
+            chunk = running_chunks.pop(future)
+            try:
+                return future.result()
+            except LineApiError as e:
+                if on_error is None:
+                    raise
+                on_error(chunk, e)
+                return 0
+
+        window = self.http.max_concurrency
+        sent_count = 0
+        running_chunks = {}
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            running = set()
+            for chunk in chunked(user_ids, MULTICAST_MAX_RECIPIENTS):
+                if len(running) >= window:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    sent_count += sum(result(future) for future in done)
+                future = executor.submit(self._multicast, chunk, messages)
+                running_chunks[future] = chunk
+                running.add(future)
+            sent_count += sum(result(future) for future in running)
+        return sent_count
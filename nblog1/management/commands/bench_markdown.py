@@ -0,0 +1,55 @@
+import timeit
+import markdown
+from django.core.management.base import BaseCommand
+from nblog1.rendering import get_extensions, render_markdown
+
+SAMPLE_TEXT = '''[TOC]
+
+## 概要
+マークダウンの変換速度を測るためのサンプルです。**強調**や`コード`、[リンク](https://example.com/)を含みます。
+
+```python
+print("コードはこのような感じで書く")
+```
+
+| 列1 | 列2 |
+| --- | --- |
+| a   | b   |
+
+脚注もあります[^1]。
+
+[^1]: 脚注の本文
+'''
+
+
+class Command(BaseCommand):
+    """マークダウン変換のマイクロベンチマーク
+
+    毎回Markdownインスタンスを作る変換(以前のテンプレートフィルタと同じ方法)と、
+    スレッドごとのインスタンスを使い回す変換とで、1回あたりの時間を比較します。
+
+    """
+    help = 'マークダウン変換の1回あたりの時間を、インスタンスを使い回す場合と比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=1000, help='変換する回数')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        for escape in (False, True):
+            def fresh():
+                markdown.markdown(SAMPLE_TEXT, extensions=get_extensions(escape))
+
+            def pooled():
+                render_markdown(SAMPLE_TEXT, escape)
+
+            # 1回目はインスタンスの作成を含むので、計測前に済ませておく
+            pooled()
+            fresh_time = timeit.timeit(fresh, number=number) / number
+            pooled_time = timeit.timeit(pooled, number=number) / number
+            label = 'コメント(escape)' if escape else '記事'
+            self.stdout.write(
+                f'{label}: 毎回作成 {fresh_time * 1e6:.1f}us/回, '
+                f'使い回し {pooled_time * 1e6:.1f}us/回 '
+                f'({fresh_time / pooled_time:.1f}倍)'
+            )
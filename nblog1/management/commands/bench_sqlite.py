@@ -0,0 +1,90 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from nblog1.models import Post
+
+BENCH_TABLE = 'nblog1_bench_write'
+
+
+class Command(BaseCommand):
+    """SQLiteの読み込み性能が、書き込み中にどれだけ落ちるかを測るベンチマーク
+
+    複数のスレッドで記事一覧と同じクエリを繰り返し、書き込みがない場合と、
+    別のスレッドが書き込みを続けている場合とで、1秒あたりの読み込み回数を比べます。
+    書き込みは一時的に作るテーブルに行うので、既存のデータは変わりません。
+
+    """
+    help = 'SQLiteの読み込み性能を、書き込みがない場合とある場合とで比較します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=4, help='読み込むスレッドの数')
+        parser.add_argument('--seconds', type=float, default=3, help='それぞれ計測する秒数')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('SQLiteでのみ使えます。')
+
+        with connection.cursor() as cursor:
+            for name in ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size'):
+                cursor.execute(f'PRAGMA {name}')
+                self.stdout.write(f'{name}: {cursor.fetchone()[0]}')
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS {BENCH_TABLE} (id INTEGER PRIMARY KEY, payload TEXT)')
+        try:
+            idle = self.run(options['readers'], options['seconds'], write=False)
+            busy = self.run(options['readers'], options['seconds'], write=True)
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS {BENCH_TABLE}')
+
+        self.stdout.write(f'書き込みなし: 読み込み {idle["reads"]:.0f}回/秒 (エラー {idle["errors"]}回)')
+        self.stdout.write(
+            f'書き込みあり: 読み込み {busy["reads"]:.0f}回/秒 (エラー {busy["errors"]}回), '
+            f'書き込み {busy["writes"]:.0f}回/秒'
+        )
+        if idle['reads']:
+            self.stdout.write(f'書き込み中の読み込み性能: {busy["reads"] / idle["reads"] * 100:.0f}%')
+
+    def run(self, readers, seconds, write):
+        """readers個のスレッドで読み込み、writeがTrueなら書き込みも行う。1秒あたりの回数を返す。"""
+        stop = threading.Event()
+        lock = threading.Lock()
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+
+        def count(key):
+            with lock:
+                counts[key] += 1
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    try:
+                        list(Post.objects.filter(is_public=True).order_by('-updated_at').values_list('pk', 'title')[:10])
+                        count('reads')
+                    except OperationalError:
+                        count('errors')
+            finally:
+                connection.close()
+
+        def writer():
+            try:
+                while not stop.is_set():
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f'INSERT INTO {BENCH_TABLE} (payload) VALUES (%s)', ['x' * 200])
+                        count('writes')
+                    except OperationalError:
+                        count('errors')
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        if write:
+            threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return {key: value / seconds if key != 'errors' else value for key, value in counts.items()}
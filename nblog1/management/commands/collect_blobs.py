@@ -0,0 +1,15 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    """参照されなくなったメディアファイルを削除するコマンド
+
+    DEFAULT_FILE_STORAGEがnblog1.storage.ContentAddressedStorageの場合に使います。
+
+    """
+    help = '参照されなくなったメディアファイルを削除します。'
+
+    def handle(self, *args, **options):
+        count = default_storage.collect_garbage()
+        self.stdout.write(f'{count}件のファイルを削除しました。')
@@ -0,0 +1,45 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from nblog1.images import create_variants
+from nblog1.models import ResizedImage
+
+
+def walk(path=''):
+    """ストレージのファイル名を全て返すジェネレータ"""
+    directories, files = default_storage.listdir(path)
+    for directory in directories:
+        yield from walk(f'{path}{directory}/')
+    for file in files:
+        yield f'{path}{file}'
+
+
+def variant_names():
+    """作成済みの派生ファイルの名前の集合を返す。派生ファイルも元の画像と同じくblobs/にあるためです。"""
+    return {
+        variant['name']
+        for variants in ResizedImage.objects.values_list('variants', flat=True)
+        for variant in variants
+    }
+
+
+class Command(BaseCommand):
+    """アップロード済みの画像の、縮小版・WebPを作るコマンド
+
+    派生ファイルを作る前にアップロードされていた画像に使います。
+    作った画像を使っている記事・コメント・返信は、HTMLに変換し直します。
+
+    """
+    help = 'アップロード済みの画像の、縮小版・WebPを作ります。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='ストレージ上のファイル名。省略した場合は全てのファイル')
+
+    def handle(self, *args, **options):
+        count = rendered = 0
+        skip = variant_names()
+        for name in options['names'] or (name for name in walk() if name not in skip):
+            resized = create_variants(name)
+            if resized is not None:
+                count += 1
+                rendered += resized.render_texts()
+        self.stdout.write(f'{count}件の画像の縮小版を作り、{rendered}件の本文を変換し直しました。')
@@ -0,0 +1,242 @@
+import json
+import os
+from collections import defaultdict
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Count, Max
+from django.http.request import split_domain_port, validate_host
+from django.test import Client, override_settings
+from django.urls import reverse
+from django.utils.http import urlencode
+from nblog1.models import Post, Comment, Reply, Tag
+from nblog1.pagination import paginate_keyset
+from nblog1.rendering import html_key, render_markdown_parallel
+from nblog1.sitemaps import sitemaps
+from nblog1.views import PublicPostIndexView
+
+MANIFEST_NAME = '.export_manifest.json'
+
+EXTENSIONS = {
+    'text/html': '.html',
+    'application/rss+xml': '.xml',
+    'application/atom+xml': '.xml',
+    'application/xml': '.xml',
+}
+
+
+def output_path(url, content_type):
+    """URLを、書き出すファイルのパスにする。
+
+    /で終わるURLはindex.html(フィードはindex.xml)に、クエリ文字列付きのURLは拡張子の前に.<クエリ文字列>を付けます。
+    例: /blog/?page=2 → blog/index.page=2.html, /sitemap-posts.xml?p=2 → sitemap-posts.p=2.xml
+    キーセットページネーションでは、/blog/?cursor=<カーソル> → blog/index.cursor=<カーソル>.html となります。
+
+    """
+    path, _, query = url.partition('?')
+    name = path.lstrip('/')
+    if not name or name.endswith('/'):
+        name += 'index' + EXTENSIONS.get(content_type.split(';')[0].strip(), '.html')
+    if query:
+        root, ext = os.path.splitext(name)
+        name = f'{root}.{query}{ext}'
+    return name
+
+
+def page_urls(url, params, count, per_page):
+    """一覧ページの、1ページ目から最後のページまでのURLを返すジェネレータ"""
+    yield f'{url}?{urlencode(params)}' if params else url
+    last_page = max(1, (count + per_page - 1) // per_page)
+    for page in range(2, last_page + 1):
+        yield f'{url}?{urlencode({**params, "page": page})}'
+
+
+def keyset_page_urls(url, params, queryset, per_page):
+    """キーセットページネーションの一覧ページの、1ページ目から最後のページまでのURLを返すジェネレータ
+
+    ビューと同じくpaginate_keysetでページを送り、各ページの「次へ」「前へ」のリンクと同じカーソルのURLを返します。
+    「前へ」のリンクは1つ前のページと同じ記事を表示しますが、カーソルが違うので、別のファイルとして書き出します。
+
+    """
+    yield f'{url}?{urlencode(params)}' if params else url
+    page = paginate_keyset(queryset, None, per_page)
+    while page.has_next():
+        cursor = page.next_cursor
+        yield f'{url}?{urlencode({**params, "cursor": cursor})}'
+        page = paginate_keyset(queryset, cursor, per_page)
+        yield f'{url}?{urlencode({**params, "cursor": page.previous_cursor})}'
+
+
+def get_fingerprints():
+    """公開記事ごとに、記事の更新日とコメント・返信の件数・最終投稿日、関連記事から作った文字列を返す。
+
+    記事詳細には関連記事も表示しているので、関連記事の紐づけや、関連記事の更新日・公開状態も含めます。
+
+    """
+    comments = {
+        row['target']: row for row in
+        Comment.objects.values('target').annotate(count=Count('pk'), last=Max('created_at')).order_by()
+    }
+    replies = {
+        row['target__target']: row for row in
+        Reply.objects.values('target__target').annotate(count=Count('pk'), last=Max('created_at')).order_by()
+    }
+    relations = defaultdict(list)
+    rows = Post.relation_posts.through.objects.order_by('from_post_id', 'to_post_id').values_list(
+        'from_post_id', 'to_post_id', 'to_post__updated_at', 'to_post__is_public',
+    )
+    for from_pk, to_pk, updated_at, is_public in rows:
+        relations[from_pk].append(f'{to_pk}:{updated_at.isoformat()}:{int(is_public)}')
+    fingerprints = {}
+    for pk, updated_at in Post.objects.filter(is_public=True).values_list('pk', 'updated_at'):
+        parts = [updated_at.isoformat()]
+        for stats in (comments.get(pk), replies.get(pk)):
+            parts += [str(stats['count']), stats['last'].isoformat()] if stats else ['0', '']
+        parts.append(','.join(relations[pk]))
+        fingerprints[str(pk)] = '|'.join(parts)
+    return fingerprints
+
+
+class Command(BaseCommand):
+    """公開中のページを静的なファイルに書き出すコマンド
+
+    記事一覧(タグごとの一覧を含む)、記事詳細、フィード、サイトマップを書き出すので、
+    匿名ユーザーへの配信はnginxやCDNに任せられます。コメントの投稿等、POSTするものはDjangoで処理してください。
+
+    書き出した記事の状態は出力先の.export_manifest.jsonに記録し、次回は更新日かコメント・返信、関連記事が変わった
+    記事だけを書き出し直します。記事が変わった場合は、一覧・フィード・サイトマップも書き出し直します。
+    テンプレートやタグ名の変更を反映する場合は、--forceを付けてください。
+    書き出す前に、HTMLに変換されていない本文をプロセスプールで並行して変換します。
+
+    """
+    help = '公開中のページを、静的なファイルに書き出します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir', help='書き出す先のディレクトリ')
+        parser.add_argument('--host', help='ページを描画する際のホスト名。省略した場合はサイトのドメイン')
+        parser.add_argument('--secure', action='store_true', help='httpsのページとして描画する')
+        parser.add_argument('--workers', type=int, help='マークダウンを変換するプロセスの数。省略した場合はCPUの数')
+        parser.add_argument('--force', action='store_true', help='変更がなくても全て書き出し直す')
+
+    def handle(self, *args, **options):
+        host = options['host'] or Site.objects.get_current().domain
+        domain, _ = split_domain_port(host)
+        if not domain:
+            raise CommandError(f'ホスト名が正しくありません。({host})')
+        if validate_host(domain, settings.ALLOWED_HOSTS):
+            self.export_all(host, options)
+            return
+        # 書き出すホストは、ALLOWED_HOSTSになくても(既定のexample.com等)、この間だけ許可する
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, domain]):
+            self.export_all(host, options)
+
+    def export_all(self, host, options):
+        self.output_dir = options['output_dir']
+        self.secure = options['secure']
+        self.client = Client(HTTP_HOST=host)
+
+        manifest_path = os.path.join(self.output_dir, MANIFEST_NAME)
+        manifest = {'posts': {}, 'files': {}}
+        if not options['force'] and os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as file:
+                manifest = json.load(file)
+
+        fingerprints = get_fingerprints()
+        changed = [pk for pk, fingerprint in fingerprints.items() if manifest['posts'].get(pk) != fingerprint]
+        removed = [pk for pk in manifest['posts'] if pk not in fingerprints]
+        if not changed and not removed:
+            self.stdout.write('変更された記事はありません。')
+            return
+
+        self.render_markdown(changed, options['workers'])
+
+        files = dict(manifest['files'])
+        for pk in removed:
+            self.remove_files(files.pop(f'post:{pk}', []))
+        for pk in changed:
+            files[f'post:{pk}'] = [self.export(reverse('nblog1:post_detail', kwargs={'pk': pk}))]
+
+        listing_files = [self.export(url) for url in self.listing_urls()]
+        self.remove_files(set(files.get('listing', [])) - set(listing_files))
+        files['listing'] = listing_files
+
+        self.write(MANIFEST_NAME, json.dumps({'posts': fingerprints, 'files': files}).encode('utf-8'))
+        self.stdout.write(
+            f'{len(changed)}件の記事と、{len(listing_files)}件の一覧等を書き出しました。(削除: {len(removed)}件)'
+        )
+
+    def render_markdown(self, post_pks, workers):
+        """書き出す記事と、そのコメント・返信のうち、HTMLに変換されていない本文を変換する。"""
+        querysets = (
+            Post.objects.filter(pk__in=post_pks),
+            Comment.objects.filter(target__in=post_pks),
+            Reply.objects.filter(target__target__in=post_pks),
+        )
+        for queryset in querysets:
+            model = queryset.model
+            stale = [
+                obj for obj in queryset.only('pk', 'text', 'text_html_key').iterator()
+                if obj.text_html_key != html_key(obj.text, model.escape_html)
+            ]
+            if not stale:
+                continue
+            # 子プロセスに、開いたままのデータベース接続を引き継がない
+            connections.close_all()
+            htmls = render_markdown_parallel([obj.text for obj in stale], model.escape_html, workers)
+            for obj, html in zip(stale, htmls):
+                obj.text_html = html
+                obj.text_html_key = html_key(obj.text, model.escape_html)
+            model.objects.bulk_update(stale, ['text_html', 'text_html_key'], batch_size=500)
+            self.stdout.write(f'{model._meta.verbose_name}: {len(stale)}件を変換しました。')
+
+    def listing_urls(self):
+        """記事一覧、タグごとの記事一覧、フィード、サイトマップのURLを返すジェネレータ"""
+        top = reverse('nblog1:top')
+        per_page = PublicPostIndexView.paginate_by
+        posts = Post.objects.filter(is_public=True)
+        if settings.USE_KEYSET_PAGINATION:
+            # ?pageは使われないので、ビューと同じカーソルでページを送る
+            yield from keyset_page_urls(top, {}, posts, per_page)
+        else:
+            yield from page_urls(top, {}, posts.count(), per_page)
+        yield reverse('nblog1:rss')
+        yield reverse('nblog1:atom')
+        for tag in Tag.objects.filter(public_post_count__gt=0).order_by('pk'):
+            if settings.USE_KEYSET_PAGINATION:
+                yield from keyset_page_urls(top, {'tags': tag.pk}, posts.filter(tags=tag), per_page)
+            else:
+                yield from page_urls(top, {'tags': tag.pk}, tag.public_post_count, per_page)
+            yield reverse('nblog1:tag_rss', kwargs={'pk': tag.pk})
+            yield reverse('nblog1:tag_atom', kwargs={'pk': tag.pk})
+        yield reverse('sitemap_index')
+        for section, sitemap in sitemaps.items():
+            url = reverse('sitemap_section', kwargs={'section': section})
+            yield url
+            for page in sitemap().paginator.page_range[1:]:
+                yield f'{url}?{urlencode({"p": page})}'
+
+    def export(self, url):
+        """URLのページを描画してファイルに書き出し、書き出したファイルのパスを返す。"""
+        response = self.client.get(url, secure=self.secure)
+        if response.status_code != 200:
+            raise CommandError(f'{url}の描画に失敗しました。(ステータスコード: {response.status_code})')
+        path = output_path(url, response['Content-Type'])
+        self.write(path, response.content)
+        return path
+
+    def write(self, path, content):
+        # 配信中のファイルが書きかけにならないよう、一時ファイルに書いてから置き換える
+        full_path = os.path.join(self.output_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        temp_path = full_path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(content)
+        os.replace(temp_path, full_path)
+
+    def remove_files(self, paths):
+        for path in paths:
+            try:
+                os.remove(os.path.join(self.output_dir, path))
+            except FileNotFoundError:
+                pass
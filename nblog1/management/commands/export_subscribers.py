@@ -0,0 +1,40 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from nblog1.models import EmailPush
+from nblog1.subscribers import FORMATS, guess_format, write_subscribers
+
+
+class Command(BaseCommand):
+    """メール購読者を、CSVかJSON Linesのファイルに書き出すコマンド
+
+    購読者はiterator()で少しずつ読み込みながら書き出すので、件数が多くても使うメモリは一定です。
+
+    """
+    help = 'メール購読者を、CSVかJSON Linesのファイルに書き出します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='書き出すファイル。-なら標準出力')
+        parser.add_argument('--format', choices=FORMATS, help='ファイルの形式。省略した場合は拡張子から推測する')
+        parser.add_argument('--active-only', action='store_true', help='有効な購読者だけを書き出す')
+        parser.add_argument('--batch-size', type=int, default=2000, help='一度に読み込む件数')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or guess_format(path)
+
+        queryset = EmailPush.objects.order_by('pk')
+        if options['active_only']:
+            queryset = queryset.filter(is_active=True)
+        rows = queryset.values_list('mail', 'is_active', 'digest').iterator(chunk_size=options['batch_size'])
+
+        if path == '-':
+            write_subscribers(sys.stdout, rows, file_format)
+            return
+
+        try:
+            file = open(path, 'w', encoding='utf-8', newline='')
+        except OSError as e:
+            raise CommandError(e)
+        with file:
+            count = write_subscribers(file, rows, file_format)
+        self.stdout.write(f'{count}件の購読者を書き出しました。')
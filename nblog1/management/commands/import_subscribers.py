@@ -0,0 +1,74 @@
+import sys
+from contextlib import nullcontext
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import transaction
+from nblog1.models import EmailPush
+from nblog1.subscribers import FORMATS, guess_format, read_subscribers
+
+
+class Command(BaseCommand):
+    """メール購読者を、CSVかJSON Linesのファイルから登録するコマンド
+
+    ファイルは1行ずつ読み込み、batch-size件ずつbulk_createでまとめて登録します。
+    登録済みのメールアドレスは、そのまま残して読み飛ばします。
+    読めない行や不正なメールアドレスは、行番号を表示して読み飛ばします。
+
+    """
+    help = 'メール購読者を、CSVかJSON Linesのファイルから登録します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル。-なら標準入力')
+        parser.add_argument('--format', choices=FORMATS, help='ファイルの形式。省略した場合は拡張子から推測する')
+        parser.add_argument('--batch-size', type=int, default=1000, help='一度に登録する件数')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or guess_format(path)
+        batch_size = options['batch_size']
+        max_length = EmailPush._meta.get_field('mail').max_length
+
+        if path == '-':
+            # 標準入力は閉じない
+            file = nullcontext(sys.stdin)
+        else:
+            try:
+                file = open(path, encoding='utf-8', newline='')
+            except OSError as e:
+                raise CommandError(e)
+
+        before = EmailPush.objects.count()
+        valid_count = skipped_count = 0
+
+        def skip(line_number, reason):
+            nonlocal skipped_count
+            skipped_count += 1
+            self.stderr.write(f'{line_number}行目: {reason}')
+
+        with file as f:
+            batch = []
+            for line_number, mail, is_active, digest in read_subscribers(f, file_format, on_error=skip):
+                try:
+                    validate_email(mail)
+                    if len(mail) > max_length:
+                        raise ValidationError('長すぎます')
+                except ValidationError:
+                    skip(line_number, f'不正なメールアドレスです({mail!r})')
+                    continue
+                valid_count += 1
+                batch.append(EmailPush(mail=mail, is_active=is_active, digest=digest))
+                if len(batch) >= batch_size:
+                    self.save(batch)
+                    batch = []
+            self.save(batch)
+
+        created_count = EmailPush.objects.count() - before
+        self.stdout.write(
+            f'{valid_count + skipped_count}件を読み込み、{created_count}件を登録しました。'
+            f'(登録済み: {valid_count - created_count}件, 読み飛ばした行: {skipped_count}件)'
+        )
+
+    def save(self, batch):
+        with transaction.atomic():
+            EmailPush.objects.bulk_create(batch, ignore_conflicts=True)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from nblog1.models import Post
+from nblog1.search import clear_index, index_posts, is_available
+
+
+class Command(BaseCommand):
+    """記事の全文検索のテーブルを作り直すコマンド"""
+    help = '記事の全文検索のテーブルを作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='一度に登録する件数')
+
+    def handle(self, *args, **options):
+        if not is_available():
+            raise CommandError('全文検索はSQLiteでのみ使えます。')
+
+        batch_size = options['batch_size']
+        queryset = Post.objects.only('pk', 'title', 'text', 'description').order_by('pk')
+        count = 0
+        with transaction.atomic():
+            clear_index()
+            batch = []
+            for post in queryset.iterator(chunk_size=batch_size):
+                batch.append(post)
+                if len(batch) >= batch_size:
+                    index_posts(batch)
+                    count += len(batch)
+                    batch = []
+            index_posts(batch)
+            count += len(batch)
+        self.stdout.write(f'{count}件の記事を登録しました。')
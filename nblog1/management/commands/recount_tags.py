@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from nblog1.models import Tag
+
+
+class Command(BaseCommand):
+    """タグの公開記事数を数え直すコマンド"""
+    help = '全てのタグの公開記事数を数え直します。'
+
+    def handle(self, *args, **options):
+        count = Tag.update_post_counts()
+        self.stdout.write(f'{count}件のタグを数え直しました。')
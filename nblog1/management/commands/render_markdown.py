@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from nblog1.models import Post, Comment, Reply
+from nblog1.rendering import preload_resized_images
+
+
+class Command(BaseCommand):
+    """記事・コメント・返信の本文を、まとめてHTMLに変換し直すコマンド
+
+    MARKDOWN_EXTENSIONSを変更した後や、queryset.update()等で本文を直接書き換えた後に実行してください。
+    本文と変換設定が変わっていないものは変換しません。
+
+    """
+    help = '記事・コメント・返信の本文を、まとめてHTMLに変換し直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='一度に更新する件数')
+        parser.add_argument('--force', action='store_true', help='変更がなくても全て変換し直す')
+
+    def handle(self, *args, **options):
+        with preload_resized_images():
+            self.render_all(options)
+
+    def render_all(self, options):
+        batch_size = options['batch_size']
+        for model in (Post, Comment, Reply):
+            queryset = model.objects.only('pk', 'text', 'text_html_key').order_by('pk')
+            total = updated = 0
+            batch = []
+            for obj in queryset.iterator(chunk_size=batch_size):
+                total += 1
+                if options['force']:
+                    obj.text_html_key = ''
+                if obj.render_text():
+                    batch.append(obj)
+                if len(batch) >= batch_size:
+                    model.objects.bulk_update(batch, ['text_html', 'text_html_key'])
+                    updated += len(batch)
+                    batch = []
+            if batch:
+                model.objects.bulk_update(batch, ['text_html', 'text_html_key'])
+                updated += len(batch)
+            self.stdout.write(f'{model._meta.verbose_name}: {updated}/{total}件を変換しました。')
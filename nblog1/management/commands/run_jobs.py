@@ -0,0 +1,28 @@
+import time
+from django.core.management.base import BaseCommand
+from nblog1.jobs import recover_stale_jobs, run_pending
+
+
+class Command(BaseCommand):
+    """ジョブキューのワーカー
+
+    登録されたジョブ(通知の送信等)を実行します。
+    常駐させる場合はそのまま、cron等で定期的に実行する場合は--onceを付けてください。
+
+    """
+    help = '登録されたジョブ(通知の送信等)を実行します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='実行できるジョブを実行したら終了する')
+        parser.add_argument('--interval', type=float, default=5, help='ジョブがない時に待つ秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            recover_stale_jobs()
+            count = run_pending()
+            if count:
+                self.stdout.write(f'{count}件のジョブを実行しました。')
+            if options['once']:
+                break
+            if not count:
+                time.sleep(options['interval'])
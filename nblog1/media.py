@@ -0,0 +1,142 @@
+"""メディアファイルの配信。
+
+MEDIA_SENDFILEで、配信の方法を選べます。
+
+- 'django': このビューがファイルを返す。Range(一部だけの取得)、ETag、Last-Modifiedに対応します。
+- 'x-accel-redirect': X-Accel-Redirectヘッダだけを返し、配信はnginxに任せる。
+  nginxには、MEDIA_ACCEL_PREFIXをMEDIA_ROOTに対応させたinternalなlocationを設定してください。
+- 'x-sendfile': X-Sendfileヘッダだけを返し、配信はApache(mod_xsendfile)等に任せる。
+
+どの場合も、ETagとLast-Modifiedでの条件付きGETには、このビューが304を返します。
+blobs/以下のファイル(ContentAddressedStorage)は内容が変わらないので、長くキャッシュさせます。
+
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+from .storage import BLOB_DIR
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# 内容の変わらないファイルを、ブラウザにキャッシュさせる秒数
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+
+class RangeFile:
+    """ファイルの、startからlengthバイトだけを読めるようにしたもの。FileResponseに渡す。"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """Rangeヘッダの値を(開始位置, 長さ)にする。
+
+    1つの範囲だけに対応し、それ以外の書き方ならNone(全体を返す)を、範囲がファイルの外ならValueErrorを返します。
+
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-500 は、最後の500バイト
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError(header)
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+def _if_range_matches(request, etag, last_modified):
+    """If-Rangeがなければ、またはファイルが変わっていなければTrue"""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _file_response(request, full_path, size, content_type, etag, last_modified):
+    header = request.headers.get('Range')
+    byte_range = None
+    if header and _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = parse_range(header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    file = open(full_path, 'rb')
+    if byte_range is None:
+        return FileResponse(file, content_type=content_type)
+    start, length = byte_range
+    response = FileResponse(RangeFile(file, start, length), status=206, content_type=content_type)
+    response['Content-Length'] = str(length)
+    response['Content-Range'] = f'bytes {start}-{start + length - 1}/{size}'
+    return response
+
+
+@require_safe
+def serve(request, path):
+    """MEDIA_ROOT以下のファイルを配信する"""
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+
+    etag = '"{:x}-{:x}"'.format(stat.st_size, stat.st_mtime_ns)
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        sendfile = settings.MEDIA_SENDFILE
+        if sendfile == 'x-accel-redirect':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+        elif sendfile == 'x-sendfile':
+            response = HttpResponse(content_type=content_type)
+            response['X-Sendfile'] = full_path
+        else:
+            response = _file_response(request, full_path, stat.st_size, content_type, etag, last_modified)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    if path.startswith(BLOB_DIR + '/'):
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    return response
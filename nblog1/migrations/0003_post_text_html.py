@@ -0,0 +1,43 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0002_post_attachment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='本文(HTML)'),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='text_html_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name='本文(HTML)のキー'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='本文(HTML)'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='text_html_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name='本文(HTML)のキー'),
+        ),
+        migrations.AddField(
+            model_name='reply',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False, verbose_name='本文(HTML)'),
+        ),
+        migrations.AddField(
+            model_name='reply',
+            name='text_html_key',
+            field=models.CharField(blank=True, editable=False, max_length=100, verbose_name='本文(HTML)のキー'),
+        ),
+    ]
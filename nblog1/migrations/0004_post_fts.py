@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+def create_fts_table(apps, schema_editor):
+    """記事の全文検索用の仮想テーブルを作り、既存の記事を登録する。"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from nblog1.search import FTS_TABLE, tokenize
+    schema_editor.execute(
+        f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(title, text, description, prefix=\'1 2\')'
+    )
+    Post = apps.get_model('nblog1', 'Post')
+    documents = [
+        (post.pk, ' '.join(tokenize(post.title)), ' '.join(tokenize(post.text)), ' '.join(tokenize(post.description)))
+        for post in Post.objects.only('pk', 'title', 'text', 'description').iterator()
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, text, description) VALUES (%s, %s, %s, %s)',
+            documents,
+        )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from nblog1.search import FTS_TABLE
+    schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0003_post_text_html'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
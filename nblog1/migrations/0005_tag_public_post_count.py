@@ -0,0 +1,30 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:10
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_public_posts(apps, schema_editor):
+    """既存のタグの公開記事数を数える。"""
+    Tag = apps.get_model('nblog1', 'Tag')
+    Post = apps.get_model('nblog1', 'Post')
+    post_count = Post.tags.through.objects.filter(
+        tag_id=models.OuterRef('pk'), post__is_public=True,
+    ).values('tag_id').annotate(count=models.Count('*')).values('count')
+    Tag.objects.update(public_post_count=Coalesce(models.Subquery(post_count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0004_post_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='public_post_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='公開記事数'),
+        ),
+        migrations.RunPython(count_public_posts, migrations.RunPython.noop),
+    ]
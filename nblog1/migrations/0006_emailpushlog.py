@@ -0,0 +1,26 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0005_tag_public_post_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailPushLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_push_pk', models.PositiveIntegerField(default=0, verbose_name='送信済みの最後の宛先のID')),
+                ('sent_count', models.PositiveIntegerField(default=0, verbose_name='送信数')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='送信開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='送信完了日時')),
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='nblog1.post', verbose_name='記事')),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:15
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0006_emailpushlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='処理名')),
+                ('payload', models.JSONField(blank=True, default=dict, verbose_name='引数')),
+                ('key', models.CharField(blank=True, db_index=True, max_length=255, verbose_name='重複防止キー')),
+                ('status', models.CharField(choices=[('pending', '待機中'), ('running', '実行中'), ('done', '完了'), ('dead', '失敗')], default='pending', max_length=10, verbose_name='状態')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='実行回数')),
+                ('max_attempts', models.PositiveIntegerField(default=5, verbose_name='最大実行回数')),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='実行予定日時')),
+                ('locked_at', models.DateTimeField(blank=True, null=True, verbose_name='実行開始日時')),
+                ('last_error', models.TextField(blank=True, verbose_name='最後のエラー')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'run_at'], name='nblog1_job_status_a2512b_idx'),
+        ),
+    ]
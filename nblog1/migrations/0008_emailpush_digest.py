@@ -0,0 +1,42 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0007_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_push_pk', models.PositiveIntegerField(default=0, verbose_name='送信済みの最後の宛先のID')),
+                ('sent_count', models.PositiveIntegerField(default=0, verbose_name='送信数')),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='送信開始日時')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='送信完了日時')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='emailpush',
+            name='digest',
+            field=models.BooleanField(default=False, help_text='新着記事のお知らせを、一定期間ごとに1通にまとめて受け取ります。', verbose_name='まとめて受け取る'),
+        ),
+        migrations.CreateModel(
+            name='EmailDigestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日')),
+                ('digest', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='nblog1.emaildigest', verbose_name='まとめ')),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='nblog1.post', verbose_name='記事')),
+            ],
+        ),
+    ]
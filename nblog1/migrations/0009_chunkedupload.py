@@ -0,0 +1,30 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nblog1', '0008_emailpush_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, verbose_name='ファイル名')),
+                ('size', models.PositiveBigIntegerField(verbose_name='サイズ')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('offset', models.PositiveBigIntegerField(default=0, verbose_name='受信済みのサイズ')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='開始日時')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0009_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResizedImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='ファイル名')),
+                ('sha256', models.CharField(db_index=True, max_length=64, verbose_name='SHA-256')),
+                ('type', models.CharField(max_length=50, verbose_name='MIMEタイプ')),
+                ('width', models.PositiveIntegerField(verbose_name='幅')),
+                ('height', models.PositiveIntegerField(verbose_name='高さ')),
+                ('variants', models.JSONField(default=list, verbose_name='派生ファイル')),
+            ],
+        ),
+    ]
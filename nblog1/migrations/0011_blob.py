@@ -0,0 +1,25 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0010_resizedimage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='ファイル名')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='サイズ')),
+                ('refcount', models.PositiveIntegerField(default=0, verbose_name='参照数')),
+                ('orphaned_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='参照がなくなった日時')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='作成日')),
+            ],
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0011_blob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['target', 'created_at'], name='comment_target_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(is_public=True), fields=['-updated_at'], name='post_public_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(is_public=True), fields=['-created_at'], name='post_public_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(is_public=True), fields=['id'], name='post_public_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(is_public=False), fields=['-updated_at'], name='post_private_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reply',
+            index=models.Index(fields=['target', 'created_at'], name='reply_target_created_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+def reindex_posts(apps, schema_editor):
+    """トークンの分け方を変えたので、既存の記事を全文検索のテーブルに登録し直す。"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from nblog1.search import FTS_TABLE, tokenize
+    Post = apps.get_model('nblog1', 'Post')
+    documents = [
+        (post.pk, ' '.join(tokenize(post.title)), ' '.join(tokenize(post.text)), ' '.join(tokenize(post.description)))
+        for post in Post.objects.only('pk', 'title', 'text', 'description').iterator()
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, text, description) VALUES (%s, %s, %s, %s)',
+            documents,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0012_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(reindex_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """本文のHTMLへの変換は、マイグレーションでは行いません。
+
+    変換には現在のrendering.render_markdown(MARKDOWN_EXTENSIONSやResizedImage)を使うので、
+    マイグレーションの中で行うと、後のコードの変更で結果が変わってしまうためです。
+    HTMLがまだないか古い記事・コメント・返信は、python manage.py render_markdown でまとめて変換してください。
+    変換していなくても、閲覧時に1件ずつ変換されます。
+
+    適用済みの環境があるため、依存関係を保つ空のマイグレーションとして残しています。
+
+    """
+
+    dependencies = [
+        ('nblog1', '0013_reindex_post_fts'),
+    ]
+
+    operations = []
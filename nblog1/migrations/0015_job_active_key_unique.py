@@ -0,0 +1,35 @@
+# Generated by Django 3.1.5 on 2026-10-18 17:51
+
+from django.db import migrations, models
+
+
+def clear_duplicate_keys(apps, schema_editor):
+    """一意制約を付ける前に、同じキーで待機中・実行中のジョブが重複していれば、古いもの以外のキーを消す。
+
+    重複したジョブは削除せず、これまでどおりそれぞれ実行されます。
+
+    """
+    Job = apps.get_model('nblog1', 'Job')
+    seen = set()
+    duplicates = []
+    active = Job.objects.filter(status__in=['pending', 'running']).exclude(key='').order_by('pk')
+    for pk, key in active.values_list('pk', 'key').iterator():
+        if key in seen:
+            duplicates.append(pk)
+        seen.add(key)
+    Job.objects.filter(pk__in=duplicates).update(key='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nblog1', '0014_render_text_html'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_keys, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['pending', 'running']), models.Q(_negated=True, key='')), fields=('key',), name='job_active_key_unique'),
+        ),
+    ]
@@ -1,14 +1,27 @@
+import logging
+import uuid
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage, get_connection
 from django.core.signing import dumps
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce
 from django.shortcuts import resolve_url
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.safestring import mark_safe
+from .rendering import config_digest, html_key, render_markdown
+
+logger = logging.getLogger(__name__)
+
+# 通知メールを一度だけ作成するため、購読解除用のトークンの位置に入れておく文字列
+EMAIL_PUSH_TOKEN_PLACEHOLDER = 'EMAIL-PUSH-TOKEN'
 
 
 class Tag(models.Model):
     name = models.CharField('タグ名', max_length=255, unique=True)
+    # 紐づいた公開記事の数。記事やタグの紐づけが変わった際に、シグナルで数え直す。
+    public_post_count = models.PositiveIntegerField('公開記事数', default=0, editable=False)
 
     def __str__(self):
         # 検索フォーム等では、紐づいた記事数を表示する。その場合はpost_countという属性に記事数を持つ。
@@ -17,8 +30,56 @@ class Tag(models.Model):
         else:
             return self.name
 
+    @classmethod
+    def update_post_counts(cls, tag_pks=None):
+        """タグの公開記事数を数え直す。tag_pksを省略した場合は、全てのタグを数え直す。"""
+        post_count = Post.tags.through.objects.filter(
+            tag_id=models.OuterRef('pk'), post__is_public=True,
+        ).values('tag_id').annotate(count=models.Count('*')).values('count')
+        queryset = cls.objects.all() if tag_pks is None else cls.objects.filter(pk__in=tag_pks)
+        return queryset.update(public_post_count=Coalesce(models.Subquery(post_count), 0))
+
+
+class RenderedTextModel(models.Model):
+    """本文(text)のマークダウンを、保存時にHTMLへ変換して持っておくモデル"""
+    text_html = models.TextField('本文(HTML)', blank=True, editable=False)
+    text_html_key = models.CharField('本文(HTML)のキー', max_length=100, blank=True, editable=False)
+
+    # 生のHTMLをエスケープするか。コメント欄のように誰でも書けるものはTrueにする。
+    escape_html = False
+
+    class Meta:
+        abstract = True
+
+    def render_text(self):
+        """本文か変換設定が変わっていれば、HTMLに変換し直す。変換し直した場合はTrueを返す。"""
+        key = html_key(self.text, self.escape_html)
+        if key == self.text_html_key:
+            return False
+        self.text_html = render_markdown(self.text, self.escape_html)
+        self.text_html_key = key
+        return True
+
+    def save(self, *args, **kwargs):
+        if self.render_text() and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'text_html', 'text_html_key'}
+        super().save(*args, **kwargs)
+
+    @property
+    def html(self):
+        """変換済みの本文を返す。
+
+        変換設定が変わっていた場合だけ、その場で変換し直します。
+        本文の変更は保存時に反映されるので、ここでは本文のハッシュまでは確認しません。
+        まとめて変換し直す場合は、render_markdownコマンドを使ってください。
+
+        """
+        if not self.text_html_key.startswith(config_digest(self.escape_html) + ':'):
+            self.render_text()
+        return mark_safe(self.text_html)
+
 
-class Post(models.Model):
+class Post(RenderedTextModel):
     """記事"""
     title = models.CharField('タイトル', max_length=32)
     text = models.TextField('本文')
@@ -32,40 +93,75 @@ class Post(models.Model):
     created_at = models.DateTimeField('作成日', default=timezone.now)
     updated_at = models.DateTimeField('更新日', default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # is_publicでの絞り込みは WHERE "is_public" となり、is_publicを先頭にした複合インデックスは使われないため、
+            # 公開・非公開ごとの部分インデックスにする
+            # 記事一覧(更新日順)、フィード(作成日順)、サイトマップ(pk順)、非公開記事一覧
+            models.Index(fields=['-updated_at'], name='post_public_updated_idx', condition=models.Q(is_public=True)),
+            models.Index(fields=['-created_at'], name='post_public_created_idx', condition=models.Q(is_public=True)),
+            models.Index(fields=['id'], name='post_public_id_idx', condition=models.Q(is_public=True)),
+            models.Index(fields=['-updated_at'], name='post_private_updated_idx', condition=models.Q(is_public=False)),
+        ]
+
     def __str__(self):
         return self.title
 
     def line_push(self, request):
-        """記事をラインで通知"""
+        """記事をラインで通知
+
+        友だちを最大500人ずつまとめて、multicastで並行して送信します。
+        送信に失敗したまとまりは、そのまとまりだけを送り直すジョブ(nblog1.multicast_line)にします。
+        このメソッドを再実行すると、送信できた友だちにも重ねて送ってしまうためです。
+
+        """
         if settings.USE_LINE_BOT:
-            import linebot
-            from linebot.models import TextSendMessage
+            from .jobs import enqueue
+            from .line import LineClient
             context = {
                 'post': self,
             }
             message = render_to_string('nblog1/mail/send_latest_notify_line_message.txt', context, request)
-            line_bot_api = linebot.LineBotApi(settings.LINE_BOT_API_KEY)
-            for push in LinePush.objects.all():
-                line_bot_api.push_message(push.user_id, messages=TextSendMessage(text=message))
+            messages = [{'type': 'text', 'text': message}]
+
+            def retry_later(user_ids, error):
+                enqueue(
+                    'nblog1.multicast_line', {'user_ids': user_ids, 'messages': messages},
+                    key=f'line_multicast:{self.pk}:{user_ids[0]}',
+                )
+
+            client = LineClient(settings.LINE_BOT_API_KEY, endpoint=settings.LINE_API_ENDPOINT)
+            user_ids = LinePush.objects.order_by('pk').values_list('user_id', flat=True).iterator()
+            client.multicast(user_ids, messages, on_error=retry_later)
 
     def email_push(self, request):
-        """記事をメールで通知"""
-        from_email = settings.DEFAULT_FROM_EMAIL
-        for mail_push in EmailPush.objects.filter(is_active=True):
-            context = {
-                'post': self,
-                'token': dumps(mail_push.pk),
-            }
-            subject = render_to_string('nblog1/mail/send_latest_notify_email_subject.txt', context, request)
-            message = render_to_string('nblog1/mail/send_latest_notify_email_message.txt', context, request)
-            to = [mail_push.mail]
-            email = EmailMessage(subject, message, from_email, to)
-            email.send()
+        """記事をメールで通知
+
+        件名と本文は1度だけ作成し、購読解除用のトークンだけを宛先ごとに差し替えます。
+        送信状況はEmailPushLogに記録し、途中で中断した場合は次回に続きから送信します。
+        まとめて受け取る宛先には送信しません(EmailDigestでまとめて送信します)。
+        送信した件数を返します。
+
+        """
+        log, _ = EmailPushLog.objects.get_or_create(post=self)
+        if log.finished_at is not None:
+            # 前回は最後まで送信済みなので、最初から送り直す
+            log.restart()
+
+        context = {
+            'post': self,
+            'posts': [self],
+            'token': EMAIL_PUSH_TOKEN_PLACEHOLDER,
+        }
+        subject = render_to_string('nblog1/mail/send_latest_notify_email_subject.txt', context, request)
+        message = render_to_string('nblog1/mail/send_latest_notify_email_message.txt', context, request)
+        pushes = EmailPush.objects.filter(is_active=True, digest=False)
+        return log.send(pushes, subject, message)
 
     def browser_push(self):
         """記事をブラウザ通知"""
         if settings.USE_WEB_PUSH:
-            import requests
+            from .http_client import get_client
             data = {
                 'app_id': settings.ONE_SIGNAL_APP_ID,
                 'included_segments': ['All'],
@@ -73,32 +169,47 @@ class Post(models.Model):
                 'headings': {'en': 'ブログ'},
                 'url': resolve_url('nblog1:post_detail', pk=self.pk),
             }
-            requests.post(
-                "https://onesignal.com/api/v1/notifications",
+            response = get_client('onesignal').post(
+                settings.ONE_SIGNAL_API_ENDPOINT,
                 headers={'Authorization': settings.ONE_SIGNAL_REST_KEY},
                 json=data,
             )
+            response.raise_for_status()
 
 
-class Comment(models.Model):
+class Comment(RenderedTextModel):
     """記事に紐づくコメント"""
+    escape_html = True
     name = models.CharField('名前', max_length=255, default='名無し')
     text = models.TextField('本文')
     email = models.EmailField('メールアドレス', blank=True, help_text='入力しておくと、返信があった際に通知します。コメント欄には表示されません。')
     target = models.ForeignKey(Post, on_delete=models.CASCADE, verbose_name='対象記事')
     created_at = models.DateTimeField('作成日', default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # コメント欄の表示順
+            models.Index(fields=['target', 'created_at'], name='comment_target_created_idx'),
+        ]
+
     def __str__(self):
         return self.text[:20]
 
 
-class Reply(models.Model):
+class Reply(RenderedTextModel):
     """コメントに紐づく返信"""
+    escape_html = True
     name = models.CharField('名前', max_length=255, default='名無し')
     text = models.TextField('本文')
     target = models.ForeignKey(Comment, on_delete=models.CASCADE, verbose_name='対象コメント')
     created_at = models.DateTimeField('作成日', default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # コメント欄の表示順
+            models.Index(fields=['target', 'created_at'], name='reply_target_created_idx'),
+        ]
+
     def __str__(self):
         return self.text[:20]
 
@@ -115,6 +226,286 @@ class EmailPush(models.Model):
     """メールでのプッシュ先を表す"""
     mail = models.EmailField('メールアドレス', unique=True)
     is_active = models.BooleanField('有効フラグ', default=False)
+    digest = models.BooleanField(
+        'まとめて受け取る', default=False,
+        help_text='新着記事のお知らせを、一定期間ごとに1通にまとめて受け取ります。',
+    )
 
     def __str__(self):
         return self.mail
+
+
+class EmailPushProgress(models.Model):
+    """メール通知の送信状況
+
+    宛先にはpkの順に送信し、送信できた分を記録します。途中で中断した場合は、続きから送信できます。
+
+    """
+    last_push_pk = models.PositiveIntegerField('送信済みの最後の宛先のID', default=0)
+    sent_count = models.PositiveIntegerField('送信数', default=0)
+    started_at = models.DateTimeField('送信開始日時', default=timezone.now)
+    finished_at = models.DateTimeField('送信完了日時', null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    def restart(self):
+        """最初から送信し直す"""
+        self.last_push_pk = 0
+        self.sent_count = 0
+        self.started_at = timezone.now()
+        self.finished_at = None
+        self.save()
+
+    def record(self, last_push_pk, count):
+        """送信できた分を記録する"""
+        self.last_push_pk = last_push_pk
+        self.sent_count += count
+        self.save(update_fields=['last_push_pk', 'sent_count'])
+        logger.info('「%s」のメール通知: %d件送信済み', self, self.sent_count)
+
+    def finish(self):
+        """最後まで送信したことを記録する"""
+        self.finished_at = timezone.now()
+        self.save(update_fields=['finished_at'])
+
+    def send(self, pushes, subject, message):
+        """pushesの宛先のうち、まだ送信していないものへメールを送信する。送信した件数を返す。
+
+        件名と本文は作成済みのものを使い、購読解除用のトークンだけを宛先ごとに差し替えます。
+        メールはEMAIL_PUSH_BATCH_SIZE件ずつ、1つの接続を使い回してまとめて送信します。
+
+        """
+        pushes = pushes.filter(pk__gt=self.last_push_pk).order_by('pk').values_list('pk', 'mail')
+        from_email = settings.DEFAULT_FROM_EMAIL
+        sent_count = 0
+        with get_connection() as connection:
+            batch = []
+            for pk, mail in pushes.iterator(chunk_size=settings.EMAIL_PUSH_BATCH_SIZE):
+                token = dumps(pk)
+                batch.append(EmailMessage(
+                    subject.replace(EMAIL_PUSH_TOKEN_PLACEHOLDER, token),
+                    message.replace(EMAIL_PUSH_TOKEN_PLACEHOLDER, token),
+                    from_email, [mail], connection=connection,
+                ))
+                if len(batch) >= settings.EMAIL_PUSH_BATCH_SIZE:
+                    connection.send_messages(batch)
+                    self.record(pk, len(batch))
+                    sent_count += len(batch)
+                    batch = []
+            if batch:
+                connection.send_messages(batch)
+                self.record(pk, len(batch))
+                sent_count += len(batch)
+        self.finish()
+        return sent_count
+
+
+class EmailPushLog(EmailPushProgress):
+    """記事のメール通知の送信状況"""
+    post = models.OneToOneField(Post, on_delete=models.CASCADE, verbose_name='記事')
+
+    def __str__(self):
+        return f'{self.post}({self.sent_count}件)'
+
+
+class EmailDigest(EmailPushProgress):
+    """まとめて送るメール通知
+
+    期間中に通知した記事(EmailDigestEntry)を期間の終わりに1通にまとめ、
+    まとめて受け取る宛先(EmailPush.digest)へ送信します。
+
+    """
+
+    def __str__(self):
+        return f'{timezone.localtime(self.started_at):%Y-%m-%d %H:%M}のまとめ({self.sent_count}件)'
+
+    @classmethod
+    def collect(cls):
+        """まだまとめていない記事をまとめて返す。記事がなければNone。"""
+        entries = EmailDigestEntry.objects.filter(digest__isnull=True)
+        if not entries.exists():
+            return None
+        digest = cls.objects.create()
+        entries.update(digest=digest)
+        return digest
+
+    def push(self, request):
+        """まとめた記事を、まとめて受け取る宛先へメールで通知する。送信した件数を返す。"""
+        posts = list(Post.objects.filter(emaildigestentry__digest=self).distinct().order_by('-created_at'))
+        if not posts:
+            # まとめた後に記事が削除された等で、載せる記事がない
+            self.finish()
+            return 0
+        context = {
+            'post': posts[0],
+            'posts': posts,
+            'token': EMAIL_PUSH_TOKEN_PLACEHOLDER,
+        }
+        subject = render_to_string('nblog1/mail/send_latest_notify_email_subject.txt', context, request)
+        message = render_to_string('nblog1/mail/send_latest_notify_email_message.txt', context, request)
+        pushes = EmailPush.objects.filter(is_active=True, digest=True)
+        return self.send(pushes, subject, message)
+
+
+class EmailDigestEntry(models.Model):
+    """まとめて送るメール通知に載せる記事"""
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, verbose_name='記事')
+    digest = models.ForeignKey(
+        EmailDigest, on_delete=models.CASCADE, null=True, blank=True, related_name='entries', verbose_name='まとめ',
+    )
+    created_at = models.DateTimeField('作成日', default=timezone.now)
+
+    def __str__(self):
+        return str(self.post)
+
+    @classmethod
+    def add(cls, post):
+        """記事を、次のまとめに載せる"""
+        cls.objects.get_or_create(post=post, digest=None)
+
+
+class Job(models.Model):
+    """バックグラウンドで実行する処理(通知の送信等)
+
+    run_jobsコマンドのワーカーが、run_atを過ぎたpendingのものから順に実行します。
+    失敗した場合は間隔を空けて再実行し、max_attempts回失敗したらdead(デッドレター)になります。
+
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = (
+        (PENDING, '待機中'),
+        (RUNNING, '実行中'),
+        (DONE, '完了'),
+        (DEAD, '失敗'),
+    )
+
+    name = models.CharField('処理名', max_length=100)
+    payload = models.JSONField('引数', default=dict, blank=True)
+    key = models.CharField('重複防止キー', max_length=255, blank=True, db_index=True)
+    status = models.CharField('状態', max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField('実行回数', default=0)
+    max_attempts = models.PositiveIntegerField('最大実行回数', default=5)
+    run_at = models.DateTimeField('実行予定日時', default=timezone.now)
+    locked_at = models.DateTimeField('実行開始日時', null=True, blank=True)
+    last_error = models.TextField('最後のエラー', blank=True)
+    created_at = models.DateTimeField('作成日', default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+        ]
+        constraints = [
+            # 同じキーのジョブは、待機中か実行中のものが1つだけ
+            models.UniqueConstraint(
+                fields=['key'], condition=models.Q(status__in=['pending', 'running']) & ~models.Q(key=''),
+                name='job_active_key_unique',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.name}({self.get_status_display()})'
+
+
+class ChunkedUpload(models.Model):
+    """分割してアップロード中のファイル
+
+    受信したデータは一時ファイル(uploads.part_path)に書き足していき、全て受信したらストレージに保存して削除します。
+
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name='ユーザー')
+    name = models.CharField('ファイル名', max_length=255)
+    size = models.PositiveBigIntegerField('サイズ')
+    sha256 = models.CharField('SHA-256', max_length=64)
+    offset = models.PositiveBigIntegerField('受信済みのサイズ', default=0)
+    created_at = models.DateTimeField('開始日時', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.name}({self.offset}/{self.size})'
+
+
+class ResizedImage(models.Model):
+    """アップロードされた画像と、その派生ファイル(縮小版・WebP)
+
+    派生ファイルは元の画像のSHA-256ごとに保存しているので、同じ画像であれば共有します。
+    variantsには、派生ファイルごとに{'name': ストレージ上の名前, 'width': 幅, 'type': MIMEタイプ}を持ちます。
+
+    """
+    name = models.CharField('ファイル名', max_length=255, unique=True)
+    sha256 = models.CharField('SHA-256', max_length=64, db_index=True)
+    type = models.CharField('MIMEタイプ', max_length=50)
+    width = models.PositiveIntegerField('幅')
+    height = models.PositiveIntegerField('高さ')
+    variants = models.JSONField('派生ファイル', default=list)
+
+    def __str__(self):
+        return self.name
+
+    def srcset(self, type):
+        """MIMEタイプがtypeのファイルを、srcset属性の値にして返す。なければ空文字列。"""
+        candidates = [(variant['name'], variant['width']) for variant in self.variants if variant['type'] == type]
+        if candidates and type == self.type:
+            candidates.append((self.name, self.width))
+        return ', '.join(f'{default_storage.url(name)} {width}w' for name, width in candidates)
+
+    def render_texts(self):
+        """この画像を使っている記事・コメント・返信の本文を、HTMLに変換し直す。変換し直した件数を返す。
+
+        派生ファイルを作る前に保存された本文には、srcset等が付いていないためです。
+
+        """
+        url = default_storage.url(self.name)
+        count = 0
+        for model in (Post, Comment, Reply):
+            for obj in model.objects.filter(text__contains=url):
+                obj.text_html_key = ''
+                obj.save(update_fields=['text_html', 'text_html_key'])
+                count += 1
+        return count
+
+
+class Blob(models.Model):
+    """ContentAddressedStorageに保存したファイルと、その参照数
+
+    同じ内容のファイルは1つだけ保存し、保存されるたびに参照数を増やし、削除されるたびに減らします。
+    参照数が0になったファイルは、すぐには削除せず、ContentAddressedStorage.collect_garbageで削除します。
+
+    """
+    name = models.CharField('ファイル名', max_length=255, unique=True)
+    size = models.PositiveBigIntegerField('サイズ', default=0)
+    refcount = models.PositiveIntegerField('参照数', default=0)
+    orphaned_at = models.DateTimeField('参照がなくなった日時', null=True, blank=True, db_index=True)
+    created_at = models.DateTimeField('作成日', default=timezone.now)
+
+    def __str__(self):
+        return f'{self.name}({self.refcount})'
+
+    @classmethod
+    def add_reference(cls, name, size):
+        """ファイルの参照を1つ増やす。まだなければ作る。"""
+        references = cls.objects.filter(name=name)
+        if references.update(refcount=models.F('refcount') + 1, orphaned_at=None):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(name=name, size=size, refcount=1)
+        except IntegrityError:
+            # 同時に同じファイルが保存された
+            references.update(refcount=models.F('refcount') + 1, orphaned_at=None)
+
+    @classmethod
+    def remove_reference(cls, name):
+        """ファイルの参照を1つ減らす。0になったら、その日時を記録する。
+
+        このストレージで保存していないファイルは、参照数0のものとして登録します。
+
+        """
+        now = timezone.now()
+        references = cls.objects.filter(name=name)
+        if not references.filter(refcount__gt=0).update(refcount=models.F('refcount') - 1):
+            cls.objects.get_or_create(name=name, defaults={'orphaned_at': now})
+        references.filter(refcount=0, orphaned_at__isnull=True).update(orphaned_at=now)
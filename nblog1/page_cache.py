@@ -0,0 +1,139 @@
+"""匿名ユーザー向けのページキャッシュ。
+
+ログインしていないユーザーのGETリクエストに対するレスポンスを、URL(クエリ文字列を含む)ごとにキャッシュします。
+キャッシュには、そのページが依存するもの(記事、タグ、記事一覧全体等)のバージョンを一緒に保存し、
+表示する際に現在のバージョンと比べます。記事やコメント、タグが変更されるとシグナルでバージョンが変わるので、
+関係するページのキャッシュだけが無効になります。
+
+依存先の名前は次のとおりです。
+
+- posts: 記事一覧全体(いずれかの記事が変わると変わる)
+- tags: タグ一覧全体(いずれかのタグか、タグの記事数が変わると変わる)
+- post:<pk>: 記事1件(記事、そのコメント・返信、タグや関連記事の紐づけが変わると変わる)
+- tag:<pk>: タグ1件(タグ名が変わると変わる)
+
+バージョンはCACHE_VERSION_TIMEOUT秒で期限が切れ、作り直されます。
+キャッシュを共有していないプロセスでは他のプロセスの変更に気づかないため、古いものを持ち続けないようにしています。
+
+"""
+import hashlib
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+POSTS = 'posts'
+TAGS = 'tags'
+
+
+def post_dependency(pk):
+    return f'post:{pk}'
+
+
+def tag_dependency(pk):
+    return f'tag:{pk}'
+
+
+def _version_key(dependency):
+    return f'nblog1:version:{dependency}'
+
+
+def get_versions(dependencies):
+    """依存先ごとの現在のバージョンを辞書で返す。まだバージョンがなければ作る。"""
+    keys = {_version_key(dependency): dependency for dependency in dependencies}
+    versions = {keys[key]: version for key, version in cache.get_many(keys).items()}
+    for dependency in dependencies:
+        if dependency not in versions:
+            cache.add(_version_key(dependency), uuid.uuid4().hex, settings.CACHE_VERSION_TIMEOUT)
+            versions[dependency] = cache.get(_version_key(dependency))
+    return versions
+
+
+def _bump_versions(dependencies):
+    cache.set_many(
+        {_version_key(dependency): uuid.uuid4().hex for dependency in dependencies}, settings.CACHE_VERSION_TIMEOUT,
+    )
+
+
+def bump_versions(*dependencies):
+    """依存先のバージョンを変え、それに依存するキャッシュを無効にする。
+
+    トランザクションの中で呼ばれた場合は、コミットした後にもう一度変えます。
+    コミット前に他のリクエストが変更前のデータから作ったキャッシュを、新しいバージョンで残さないためです。
+
+    """
+    _bump_versions(dependencies)
+    if not transaction.get_autocommit():
+        transaction.on_commit(lambda: _bump_versions(dependencies))
+
+
+def _page_key(request):
+    url = request.build_absolute_uri()
+    return 'nblog1:page:' + hashlib.md5(url.encode('utf-8')).hexdigest()
+
+
+def get_cached_page(request):
+    """キャッシュ済みで、依存先が変わっていないページがあればレスポンスを返す。"""
+    entry = cache.get(_page_key(request))
+    if entry is None:
+        return None
+    if get_versions(entry['versions']) != entry['versions']:
+        return None
+    return HttpResponse(entry['content'], content_type=entry['content_type'])
+
+
+def set_cached_page(request, response, versions):
+    """レスポンスを、描画前に読んでおいた依存先のバージョンと一緒にキャッシュする。
+
+    描画中に依存先が変わった場合は、キャッシュしたものは次のリクエストで古いと分かります。
+
+    """
+    entry = {
+        'content': response.content,
+        'content_type': response['Content-Type'],
+        'versions': versions,
+    }
+    cache.set(_page_key(request), entry, settings.PAGE_CACHE_TIMEOUT)
+
+
+class PageCacheMixin:
+    """匿名ユーザーのGETリクエストを、ページ単位でキャッシュするMixin
+
+    USE_PAGE_CACHEがTrueの場合だけ使われます。
+    キャッシュしたくないビューでは、page_cacheをFalseにしてください。
+    get_page_dependenciesで、そのページが依存するものを返してください。
+    依存先のバージョンはビューを実行する前に読むので、get_page_dependenciesはself.kwargs等から決めてください。
+
+    """
+    page_cache = True
+
+    def get_page_dependencies(self):
+        return [POSTS, TAGS]
+
+    def use_page_cache(self, request):
+        return (
+            settings.USE_PAGE_CACHE and self.page_cache
+            and request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+        )
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.use_page_cache(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        response = get_cached_page(request)
+        if response is not None:
+            return response
+
+        # 描画中に記事等が変わっても古いページを新しいバージョンで保存しないよう、先にバージョンを読んでおく
+        versions = get_versions(self.get_page_dependencies())
+        response = super().dispatch(request, *args, **kwargs)
+        if request.method == 'GET' and response.status_code == 200 and not response.cookies:
+            def store(rendered_response):
+                set_cached_page(request, rendered_response, versions)
+
+            if hasattr(response, 'add_post_render_callback'):
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+        return response
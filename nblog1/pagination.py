@@ -0,0 +1,89 @@
+"""記事一覧のキーセット(カーソル)ページネーション。
+
+OFFSETでのページ送りは、後ろのページほど読み飛ばす行が増え、件数を数えるCOUNT(*)も毎回実行されます。
+キーセットページネーションでは、前のページの最後の記事の(updated_at, pk)より後ろの記事を取得するので、
+何ページ目でも同じコストで表示できます。そのかわり、総件数や総ページ数は表示しません。
+
+ページの位置は、署名付きの文字列(カーソル)としてGETパラメータのcursorで受け渡します。
+
+"""
+from django.core.signing import BadSignature, dumps, loads
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_cursor(post, direction):
+    """記事の位置と、そこから進む向きをカーソルにする。"""
+    return dumps([post.updated_at.isoformat(), post.pk, direction], compress=True)
+
+
+def decode_cursor(cursor):
+    """カーソルを(updated_at, pk, 向き)に戻す。不正なカーソルならHttp404。"""
+    try:
+        updated_at, pk, direction = loads(cursor)
+    except (BadSignature, TypeError, ValueError):
+        raise Http404('不正なカーソルです。')
+    updated_at = parse_datetime(updated_at)
+    if updated_at is None or direction not in (NEXT, PREVIOUS):
+        raise Http404('不正なカーソルです。')
+    return updated_at, pk, direction
+
+
+class KeysetPage:
+    """キーセットページネーションの1ページ分。テンプレートではpage_objとして使う。"""
+    is_keyset = True
+
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1], NEXT) if self.has_next() else ''
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0], PREVIOUS) if self.has_previous() else ''
+
+
+def paginate_keyset(queryset, cursor, per_page):
+    """(updated_at, pk)の新しい順で、カーソルの位置からper_page件を取得する。"""
+    if not cursor:
+        object_list = list(queryset.order_by('-updated_at', '-pk')[:per_page + 1])
+        return KeysetPage(object_list[:per_page], len(object_list) > per_page, False)
+
+    updated_at, pk, direction = decode_cursor(cursor)
+    if direction == NEXT:
+        queryset = queryset.filter(
+            Q(updated_at__lt=updated_at) | Q(updated_at=updated_at, pk__lt=pk)
+        ).order_by('-updated_at', '-pk')
+        object_list = list(queryset[:per_page + 1])
+        return KeysetPage(object_list[:per_page], len(object_list) > per_page, True)
+
+    # 前のページは、逆順に取得してから並べ直す
+    queryset = queryset.filter(
+        Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=pk)
+    ).order_by('updated_at', 'pk')
+    object_list = list(queryset[:per_page + 1])
+    has_previous = len(object_list) > per_page
+    return KeysetPage(object_list[:per_page][::-1], True, has_previous)
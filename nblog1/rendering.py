@@ -0,0 +1,207 @@
+"""マークダウンからHTMLへの変換処理。
+
+変換結果はモデル側に保存しておき、閲覧時には変換しないようにしています。
+保存したHTMLには、変換設定と本文のハッシュから作ったキーを一緒に持たせ、
+どちらかが変わったら変換し直します。
+
+Markdownインスタンスの作成と拡張の読み込みは重いため、
+設定済みのインスタンスをスレッドごとに持っておき、reset()して使い回します。
+
+"""
+import hashlib
+import threading
+import xml.etree.ElementTree as etree
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import repeat
+import django
+import markdown
+from django.conf import settings
+from markdown.extensions import Extension
+from markdown.postprocessors import Postprocessor
+from markdown.treeprocessors import Treeprocessor
+from urllib.parse import unquote, urlsplit
+
+
+class EscapeHtml(Extension):
+    """生のHTMLをエスケープするための拡張"""
+
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister('html_block')
+        md.inlinePatterns.deregister('html')
+
+
+def media_name(src):
+    """画像のURLが、MEDIA_URL以下のファイルであれば、ストレージ上の名前を返す。"""
+    path = urlsplit(src).path
+    if not path.startswith(settings.MEDIA_URL):
+        return None
+    return unquote(path[len(settings.MEDIA_URL):])
+
+
+@contextmanager
+def preload_resized_images():
+    """この中での変換では、ResizedImageを1件ずつ探さず、最初にまとめて読み込んだものを使う。
+
+    render_markdownコマンド等、まとめて変換する場合に使います。
+
+    """
+    from .models import ResizedImage
+    _local.resized_images = {resized.name: resized for resized in ResizedImage.objects.iterator()}
+    try:
+        yield
+    finally:
+        del _local.resized_images
+
+
+def find_resized_images(names):
+    """ストレージ上の名前がnamesの画像のうち、派生ファイルのあるもの(ResizedImage)のリストを返す。"""
+    preloaded = getattr(_local, 'resized_images', None)
+    if preloaded is not None:
+        return [preloaded[name] for name in names if name in preloaded]
+    from .models import ResizedImage
+    return list(ResizedImage.objects.filter(name__in=names))
+
+
+class ResponsiveImageTreeprocessor(Treeprocessor):
+    """派生ファイルのある画像を、srcset付きのpicture要素にする
+
+    データベースを見るのは、MEDIA_URL以下の画像がある場合だけです。
+
+    """
+
+    def run(self, root):
+        images = {}
+        for parent in root.iter():
+            for index, element in enumerate(parent):
+                name = media_name(element.get('src', '')) if element.tag == 'img' else None
+                if name:
+                    images.setdefault(name, []).append((parent, index, element))
+        if not images:
+            return
+
+        for resized in find_resized_images(list(images)):
+            for parent, index, img in images[resized.name]:
+                picture = etree.Element('picture')
+                webp_srcset = resized.srcset('image/webp')
+                if webp_srcset and resized.type != 'image/webp':
+                    etree.SubElement(picture, 'source', type='image/webp', srcset=webp_srcset, sizes=settings.IMAGE_SIZES)
+                srcset = resized.srcset(resized.type)
+                if srcset:
+                    img.set('srcset', srcset)
+                    img.set('sizes', settings.IMAGE_SIZES)
+                img.set('width', str(resized.width))
+                img.set('height', str(resized.height))
+                img.set('loading', 'lazy')
+                picture.tail, img.tail = img.tail, None
+                picture.append(img)
+                parent[index] = picture
+
+
+class SourceEndTagPostprocessor(Postprocessor):
+    """source要素の終了タグを取り除く
+
+    markdownはsourceを空要素として扱わず、</source>を出力してしまうためです。
+    記事に直接書かれたHTMLを戻す(raw_html)前に実行するので、それには影響しません。
+
+    """
+
+    def run(self, text):
+        return text.replace('</source>', '')
+
+
+class ResponsiveImageExtension(Extension):
+    """アップロードした画像に、縮小版・WebPのsrcsetと、幅・高さを付ける拡張"""
+
+    def extendMarkdown(self, md):
+        md.treeprocessors.register(ResponsiveImageTreeprocessor(md), 'responsive_image', 5)
+        md.postprocessors.register(SourceEndTagPostprocessor(md), 'source_end_tag', 35)
+
+
+def get_extensions(escape=False):
+    """変換に使う拡張の一覧を返す。"""
+    extensions = list(settings.MARKDOWN_EXTENSIONS)
+    if escape:
+        extensions.append(EscapeHtml())
+    return extensions
+
+
+_local = threading.local()
+
+
+def get_converter(escape=False):
+    """このスレッドで使い回す、設定済みのMarkdownインスタンスを返す。
+
+    記事用(escape=False)とコメント用(escape=True)の2つを持ちます。
+    MARKDOWN_EXTENSIONSが変わっていれば、作り直します。
+
+    """
+    converters = getattr(_local, 'converters', None)
+    if converters is None:
+        converters = _local.converters = {}
+    digest = config_digest(escape)
+    digest_and_md = converters.get(escape)
+    if digest_and_md is None or digest_and_md[0] != digest:
+        md = markdown.Markdown(extensions=get_extensions(escape))
+        digest_and_md = converters[escape] = (digest, md)
+    return digest_and_md[1]
+
+
+def render_markdown(text, escape=False):
+    """マークダウンをhtmlに変換する。
+
+    escape=Trueならば、生のHTMLやCSS、JavaScript等のコードをエスケープします。
+
+    """
+    md = get_converter(escape)
+    try:
+        return md.convert(text)
+    finally:
+        # 目次や脚注等、前回の変換の状態が残らないようにする
+        md.reset()
+
+
+def render_markdown_parallel(texts, escape=False, workers=None):
+    """複数の本文を、プロセスプールで並行してHTMLに変換する。変換結果のリストを本文と同じ順で返す。
+
+    変換はCPUを使う処理なので、スレッドではなくプロセスに分けます。
+    workersを省略した場合は、CPUの数だけプロセスを使います。
+
+    """
+    texts = list(texts)
+    if not texts:
+        return []
+    # 各プロセスに、ある程度まとめて渡す
+    chunksize = max(1, len(texts) // ((workers or 4) * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as executor:
+        return list(executor.map(render_markdown, texts, repeat(escape), chunksize=chunksize))
+
+
+def _extension_signature(extension):
+    """拡張を、設定のハッシュ用の文字列にする。"""
+    if isinstance(extension, Extension):
+        cls = type(extension)
+        return '{}.{}{}'.format(cls.__module__, cls.__qualname__, sorted(extension.getConfigs().items()))
+    return str(extension)
+
+
+@lru_cache(maxsize=None)
+def config_digest(escape=False):
+    """変換設定(markdownのバージョン、拡張の一覧、エスケープの有無)のハッシュを返す。
+
+    プロセスごとに一度だけ計算します。MARKDOWN_EXTENSIONSを変えた場合は、signalsでキャッシュを消します。
+
+    """
+    source = repr((
+        markdown.__version__,
+        [_extension_signature(extension) for extension in settings.MARKDOWN_EXTENSIONS],
+        escape,
+    ))
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+
+
+def html_key(text, escape=False):
+    """変換結果のキーを返す。「設定のハッシュ:本文のハッシュ」という形式です。"""
+    text_digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return '{}:{}'.format(config_digest(escape), text_digest)
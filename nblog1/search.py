@@ -0,0 +1,127 @@
+"""記事の全文検索。
+
+SQLiteのFTS5の仮想テーブル(nblog1_post_fts)に、記事のタイトル・本文・説明を入れておき、
+キーワード検索はそのテーブルに対して行います。
+
+FTS5の標準のトークナイザは日本語を単語に区切れないため、
+保存前に単語(英数字や日本語の連続した並び)を文字の2-gram(バイグラム)へ分解し、空白区切りの文字列として登録しています。
+英数字も日本語も同じように分解するので、「令和3年」や「記事Django」のように文字の種類が混ざったキーワードや、
+「ytho」のような英単語の一部でも、icontainsと同じく部分一致で見つかります。
+
+SQLite以外のデータベースでは、従来どおりicontainsでの検索になります。
+
+"""
+import re
+from django.db import connection
+from django.db.models import Q
+
+FTS_TABLE = 'nblog1_post_fts'
+
+# 検索結果の並び順に使う、列ごとの重み(タイトル, 本文, 説明)
+RANK_WEIGHTS = (10.0, 1.0, 5.0)
+
+# 単語(文字の連続した並び)。FTS5のトークナイザは_で区切るので、_も区切りとして扱う。
+_WORD_RE = re.compile(r'[^\W_]+')
+
+
+def is_available():
+    """全文検索のテーブルが使えるかどうか"""
+    return connection.vendor == 'sqlite'
+
+
+def tokenize(text):
+    """テキストをトークンのリストにする。登録と検索で同じものを使います。
+
+    単語ごとに2-gramに分解し、単語の最後の1文字も加えます。
+    1文字のキーワードを前方一致で探した際に、単語の最後の文字にも一致させるためです。
+    1文字だけの単語は、そのまま1つのトークンにします。
+
+    """
+    tokens = []
+    for word in _WORD_RE.findall(text.lower()):
+        if len(word) > 1:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+        tokens.append(word[-1])
+    return tokens
+
+
+def build_match_query(key_word):
+    """検索キーワードから、FTS5のMATCHに渡す検索式を作る。
+
+    半角スペースで区切られたキーワードは、それぞれをフレーズとしてANDで繋ぎます。
+    フレーズには登録時と同じトークンを並べ、2-gramが連続して並んでいるかを確認するので、部分一致と同じ結果になります。
+    ただし、最後の単語の末尾の1文字は除きます。キーワードが単語の途中で終わっていても一致させるためです。
+    最後の単語が1文字の場合は、その文字で始まる2-gramにも一致するよう前方一致にします。
+
+    """
+    phrases = []
+    for word in key_word.split():
+        tokens = tokenize(word)
+        if not tokens:
+            continue
+        last = _WORD_RE.findall(word.lower())[-1]
+        if len(last) > 1:
+            phrases.append('"{}"'.format(' '.join(tokens[:-1])))
+        else:
+            phrases.append('"{}" *'.format(' '.join(tokens)))
+    return ' AND '.join(phrases)
+
+
+def _document(post):
+    return (
+        post.pk,
+        ' '.join(tokenize(post.title)),
+        ' '.join(tokenize(post.text)),
+        ' '.join(tokenize(post.description)),
+    )
+
+
+def index_posts(posts):
+    """記事を全文検索のテーブルに登録(更新)する。"""
+    if not is_available():
+        return
+    documents = [_document(post) for post in posts]
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [(doc[0],) for doc in documents])
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, title, text, description) VALUES (%s, %s, %s, %s)',
+            documents,
+        )
+
+
+def unindex_post(pk):
+    """記事を全文検索のテーブルから削除する。"""
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [pk])
+
+
+def clear_index():
+    """全文検索のテーブルを空にする。"""
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+
+def search_posts(queryset, key_word):
+    """キーワードで記事を絞り込み、関連度の高い順に並べたクエリセットを返す。"""
+    if not is_available():
+        # キーワードが半角スペースで区切られていれば、その回数だけfilterする。つまりAND。
+        for word in key_word.split():
+            queryset = queryset.filter(Q(title__icontains=word) | Q(text__icontains=word))
+        return queryset.order_by('-updated_at')
+
+    match_query = build_match_query(key_word)
+    if not match_query:
+        return queryset.order_by('-updated_at')
+
+    table = queryset.model._meta.db_table
+    weights = ', '.join(str(weight) for weight in RANK_WEIGHTS)
+    return queryset.extra(
+        select={'search_rank': f'bm25({FTS_TABLE}, {weights})'},
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE}.rowid = {table}.id', f'{FTS_TABLE} MATCH %s'],
+        params=[match_query],
+    ).order_by('search_rank', '-updated_at')
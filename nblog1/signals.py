@@ -1,9 +1,15 @@
 from django.conf import settings
-from django.core.mail import send_mail, EmailMessage
-from django.db.models.signals import post_save
+from django.db.backends.signals import connection_created
+from django.core.files.storage import default_storage
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
 from django.dispatch import receiver
-from django.template.loader import render_to_string
-from .models import Comment, Reply
+from . import page_cache, sitemaps, tag_index
+from .jobs import enqueue, request_info
+from .rendering import config_digest
+from .models import Comment, Reply, Post, ResizedImage, Tag
+from .search import index_posts, unindex_post
+from .suggest import title_index
 
 
 @receiver(post_save, sender=Comment)
@@ -16,14 +22,12 @@ def send_mail_to_author(sender, instance, created, **kwargs):
         # コメントの投稿者を識別するため、投稿者のセッションにコメントのpkを入れておく
         request.session[str(instance.pk)] = True
 
-        context = {
-            'post': instance.target,
+        # メールの送信はジョブで行う。コメントと同じトランザクションで登録し、コミット後に送信する。
+        payload = {
+            'post_pk': instance.target_id,
+            **request_info(request),
         }
-        subject = render_to_string('nblog1/mail/comment_notify_subject.txt', context, request)
-        message = render_to_string('nblog1/mail/comment_notify_message.txt', context, request)
-        from_email = settings.DEFAULT_FROM_EMAIL
-        recipient_list = [settings.DEFAULT_FROM_EMAIL]
-        send_mail(subject, message, from_email, recipient_list)
+        enqueue('nblog1.send_comment_mail', payload, key=f'comment_mail:{instance.pk}', drain=True)
 
 
 @receiver(post_save, sender=Reply)
@@ -34,19 +38,217 @@ def send_mail_to_comment_user(sender, instance, created, **kwargs):
         request = instance.request
 
         comment = instance.target
-        post = comment.target
-        context = {
-            'post': post,
-        }
-        subject = render_to_string('nblog1/mail/reply_notify_subject.txt', context, request)
-        message = render_to_string('nblog1/mail/reply_notify_message.txt', context, request)
-
-        from_email = settings.DEFAULT_FROM_EMAIL
         recipient_list = []
-        bcc = [settings.DEFAULT_FROM_EMAIL]
         # コメントした人がメールアドレスを入力しており
         # コメントした人と返信した人が違う場合は、コメントした人に返信あるよとメール
         if comment.email and not request.session.get(str(comment.pk)):
             recipient_list.append(comment.email)
-        email = EmailMessage(subject, message, from_email, recipient_list, bcc)
-        email.send()
+
+        # メールの送信はジョブで行う。コメントと同じトランザクションで登録し、コミット後に送信する。
+        payload = {
+            'post_pk': comment.target_id,
+            'recipient_list': recipient_list,
+            **request_info(request),
+        }
+        enqueue('nblog1.send_reply_mail', payload, key=f'reply_mail:{instance.pk}', drain=True)
+
+
+@receiver(post_save, sender=Post)
+def update_search_index(sender, instance, **kwargs):
+    """記事を全文検索のテーブルに登録する"""
+    index_posts([instance])
+
+
+@receiver(post_delete, sender=Post)
+def delete_search_index(sender, instance, **kwargs):
+    """記事を全文検索のテーブルから削除する"""
+    unindex_post(instance.pk)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_tag_index(sender, instance, action, reverse, pk_set, **kwargs):
+    """記事とタグの紐づけが変わったら、そのタグのインデックスを破棄する"""
+    if action == 'pre_clear':
+        # clearの後では紐づいていたタグが分からないので、先に控えておく
+        instance._cleared_tag_pks = [instance.pk] if reverse else list(instance.tags.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        tag_index.invalidate([instance.pk] if reverse else pk_set)
+    elif action == 'post_clear':
+        tag_index.invalidate(getattr(instance, '_cleared_tag_pks', []))
+
+
+@receiver(pre_delete, sender=Post)
+def remember_post_tags(sender, instance, **kwargs):
+    """記事の削除後に使うため、紐づいているタグを控えておく"""
+    instance._deleted_tag_pks = list(instance.tags.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def delete_post_from_tag_index(sender, instance, **kwargs):
+    """削除した記事に紐づいていたタグのインデックスを破棄する"""
+    tag_index.invalidate(getattr(instance, '_deleted_tag_pks', []))
+
+
+@receiver(post_delete, sender=Tag)
+def delete_tag_index(sender, instance, **kwargs):
+    """削除したタグのインデックスを破棄する"""
+    tag_index.invalidate([instance.pk])
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def update_tag_post_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    """記事とタグの紐づけが変わったら、タグの公開記事数を数え直す"""
+    if action in ('post_add', 'post_remove'):
+        Tag.update_post_counts([instance.pk] if reverse else pk_set)
+    elif action == 'post_clear':
+        Tag.update_post_counts(getattr(instance, '_cleared_tag_pks', []))
+
+
+@receiver(post_save, sender=Post)
+def update_post_tag_counts(sender, instance, created, **kwargs):
+    """記事の公開・非公開が変わるかもしれないので、紐づいたタグの公開記事数を数え直す"""
+    if not created:
+        Tag.update_post_counts(instance.tags.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Post)
+def delete_post_from_tag_counts(sender, instance, **kwargs):
+    """削除した記事に紐づいていたタグの公開記事数を数え直す"""
+    Tag.update_post_counts(getattr(instance, '_deleted_tag_pks', []))
+
+
+@receiver(post_save, sender=Post)
+def update_suggest_index(sender, instance, **kwargs):
+    """記事のタイトルをサジェスト用のインデックスに反映する"""
+    title_index.update(instance.pk, instance.title)
+
+
+@receiver(post_delete, sender=Post)
+def delete_suggest_index(sender, instance, **kwargs):
+    """記事をサジェスト用のインデックスから削除する"""
+    title_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def expire_post_pages(sender, instance, **kwargs):
+    """記事が変わったら、記事一覧とその記事のページキャッシュを無効にする"""
+    page_cache.bump_versions(page_cache.POSTS, page_cache.post_dependency(instance.pk))
+
+
+@receiver(pre_save, sender=Post)
+def remember_post_public(sender, instance, **kwargs):
+    """サイトマップの更新と添付ファイルの参照数のため、保存前の公開状態と添付ファイルを記録しておく"""
+    instance._was_public, instance._old_attachment = Post.objects.filter(pk=instance.pk).values_list(
+        'is_public', 'attachment',
+    ).first() or (None, '')
+
+
+@receiver(post_save, sender=Post)
+def expire_post_sitemap(sender, instance, **kwargs):
+    """記事が載るサイトマップのページを無効にする"""
+    was_public = getattr(instance, '_was_public', None)
+    if instance.is_public or was_public:
+        sitemaps.expire_post(instance.pk, moved=instance.is_public != was_public)
+
+
+@receiver(post_delete, sender=Post)
+def delete_post_from_sitemap(sender, instance, **kwargs):
+    """削除した記事が載っていたサイトマップのページ以降を無効にする"""
+    if instance.is_public:
+        sitemaps.expire_post(instance.pk, moved=True)
+
+
+@receiver(pre_save, sender=Post)
+def remember_attachment_upload(sender, instance, **kwargs):
+    """添付ファイルが、この保存で新しくストレージに保存されるかを記録しておく"""
+    instance._attachment_uploaded = bool(instance.attachment) and not instance.attachment._committed
+
+
+@receiver(post_save, sender=Post)
+def release_same_attachment(sender, instance, **kwargs):
+    """同じ内容のファイルで添付ファイルを置き換えたら、増えた参照を戻す
+
+    ContentAddressedStorageでは同じ内容なら同じ名前になり、保存のたびに参照が増えますが、
+    django_cleanupは名前が変わらないので古いファイルを削除(参照を減らす)しないためです。
+
+    """
+    old_name = getattr(instance, '_old_attachment', '')
+    if getattr(instance, '_attachment_uploaded', False) and old_name and instance.attachment.name == old_name:
+        instance.attachment.storage.delete(old_name)
+
+
+@receiver(post_delete, sender=ResizedImage)
+def release_image_variants(sender, instance, **kwargs):
+    """同じ画像のResizedImageがなくなったら、共有していた派生ファイルの参照を戻す"""
+    if not ResizedImage.objects.filter(sha256=instance.sha256).exists():
+        for variant in instance.variants:
+            default_storage.delete(variant['name'])
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def expire_comment_pages(sender, instance, **kwargs):
+    """コメントが変わったら、その記事のページキャッシュを無効にする"""
+    page_cache.bump_versions(page_cache.post_dependency(instance.target_id))
+
+
+@receiver(post_save, sender=Reply)
+@receiver(post_delete, sender=Reply)
+def expire_reply_pages(sender, instance, **kwargs):
+    """返信が変わったら、その記事のページキャッシュを無効にする"""
+    post_pk = Comment.objects.filter(pk=instance.target_id).values_list('target_id', flat=True).first()
+    if post_pk is not None:
+        page_cache.bump_versions(page_cache.post_dependency(post_pk))
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def expire_tag_pages(sender, instance, **kwargs):
+    """タグが変わったら、タグ一覧とそのタグを表示しているページキャッシュを無効にする"""
+    page_cache.bump_versions(page_cache.TAGS, page_cache.tag_dependency(instance.pk))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def expire_post_tag_pages(sender, instance, action, reverse, pk_set, **kwargs):
+    """記事とタグの紐づけが変わったら、関係するページキャッシュを無効にする"""
+    if not action.startswith('post_'):
+        return
+    dependencies = [page_cache.POSTS, page_cache.TAGS]
+    if reverse:
+        # タグ側から変更した場合。clearでは対象の記事が分からないので、タグに依存するページを無効にする
+        dependencies.append(page_cache.tag_dependency(instance.pk))
+        dependencies += [page_cache.post_dependency(pk) for pk in pk_set or ()]
+    else:
+        dependencies.append(page_cache.post_dependency(instance.pk))
+    page_cache.bump_versions(*dependencies)
+
+
+@receiver(m2m_changed, sender=Post.relation_posts.through)
+def expire_relation_post_pages(sender, instance, action, pk_set, **kwargs):
+    """関連記事の紐づけが変わったら、関係する記事のページキャッシュを無効にする"""
+    if not action.startswith('post_'):
+        return
+    # 関連記事は双方向なので、相手の記事のページも無効にする
+    pks = {instance.pk, *(pk_set or ())}
+    if action == 'post_clear':
+        page_cache.bump_versions(page_cache.POSTS, *[page_cache.post_dependency(pk) for pk in pks])
+    else:
+        page_cache.bump_versions(*[page_cache.post_dependency(pk) for pk in pks])
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """SQLiteの接続に、SQLITE_PRAGMASの設定を反映する"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(setting_changed)
+def reset_markdown_config(sender, setting, **kwargs):
+    """MARKDOWN_EXTENSIONSが変わったら(テストのoverride_settings等)、変換設定のハッシュを計算し直す"""
+    if setting == 'MARKDOWN_EXTENSIONS':
+        config_digest.cache_clear()
@@ -1,14 +1,45 @@
-from django.contrib.sitemaps import Sitemap
+"""サイトマップ。
+
+サイトマップはインデックス(sitemap.xml)と、SITEMAP_PAGE_SIZE件ずつのページ(sitemap-<section>.xml?p=<page>)に分けます。
+各ページはgzipで圧縮してキャッシュし、クローラーにはそのバイト列をそのまま返します。
+gzipを受け付けないクライアントには展開して返し、ETagはエンコーディングごとに別の値にします。
+
+記事のページは記事を古い順(pk順)に並べるので、記事を編集してもその記事のページだけが、
+記事を追加・公開・非公開・削除しても、その記事のページ以降とインデックスだけが無効になります。
+無効になったページは、次のリクエストで作り直します。
+キャッシュを共有していないプロセスには無効にしたことが伝わらないので、SITEMAP_CACHE_TIMEOUT秒で作り直します。
+
+"""
+import gzip
+import hashlib
+import re
+from django.conf import settings
+from django.contrib.sitemaps import Sitemap, views as sitemap_views
+from django.core.cache import cache
+from django.http import HttpResponse
 from django.shortcuts import resolve_url
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
+from . import page_cache
 from .models import Post
 
+INDEX_DEPENDENCY = 'sitemap:index'
+
+ACCEPTS_GZIP_RE = re.compile(r'\bgzip\b')
+
+
+def posts_page_dependency(page):
+    return f'sitemap:posts:{page}'
+
 
 class PostSitemap(Sitemap):
     changefreq = 'daily'
     priority = 1.0
+    limit = settings.SITEMAP_PAGE_SIZE
 
     def items(self):
-        return Post.objects.filter(is_public=True).order_by('-created_at')
+        # URLと更新日だけを使うので、本文等は読み込まない
+        return Post.objects.filter(is_public=True).only('pk', 'updated_at').order_by('pk')
 
     def lastmod(self, obj):
         return obj.updated_at
@@ -16,6 +47,9 @@ class PostSitemap(Sitemap):
     def location(self, obj):
         return resolve_url('nblog1:post_detail', pk=obj.pk)
 
+    def get_page_dependencies(self, page):
+        return [posts_page_dependency(page)]
+
 
 class BlogSitemap(Sitemap):
     changefreq = 'daily'
@@ -26,3 +60,91 @@ class BlogSitemap(Sitemap):
 
     def location(self, obj):
         return resolve_url(obj)
+
+    def get_page_dependencies(self, page):
+        return []
+
+
+sitemaps = {
+    'blog': BlogSitemap,
+    'posts': PostSitemap,
+}
+
+
+def get_post_page(pk):
+    """pkの記事が載る(載っていた)、記事のサイトマップのページ番号を返す。"""
+    position = Post.objects.filter(is_public=True, pk__lt=pk).count()
+    return position // PostSitemap.limit + 1
+
+
+def expire_post(pk, moved=False):
+    """記事のサイトマップのうち、pkの記事が載るページを無効にする。
+
+    記事の追加・公開・非公開・削除でページの記事がずれる場合(moved=True)は、それ以降のページとインデックスも無効にします。
+
+    """
+    page = get_post_page(pk)
+    if not moved:
+        page_cache.bump_versions(posts_page_dependency(page))
+        return
+    last_page = Post.objects.filter(is_public=True).count() // PostSitemap.limit + 1
+    dependencies = [posts_page_dependency(i) for i in range(page, last_page + 1)]
+    page_cache.bump_versions(INDEX_DEPENDENCY, *dependencies)
+
+
+def _cached_response(request, key, dependencies, build):
+    """buildで作ったサイトマップをgzipで圧縮してキャッシュし、レスポンスを返す。"""
+    entry = cache.get(key)
+    # digestのないものは、ETagを1つだけ持っていた以前の形式なので作り直す
+    if entry is None or 'digest' not in entry or page_cache.get_versions(entry['versions']) != entry['versions']:
+        versions = page_cache.get_versions(dependencies)
+        response = build()
+        response.render()
+        if response.status_code != 200:
+            return response
+        content = gzip.compress(response.content)
+        entry = {
+            'content': content,
+            'content_type': response['Content-Type'],
+            'digest': hashlib.md5(content).hexdigest(),
+            'versions': versions,
+        }
+        cache.set(key, entry, settings.SITEMAP_CACHE_TIMEOUT)
+
+    # 圧縮したものと展開したものはバイト列が違うので、強いETagも別の値にする
+    use_gzip = ACCEPTS_GZIP_RE.search(request.META.get('HTTP_ACCEPT_ENCODING', '')) is not None
+    etag = quote_etag(entry['digest'] + ('-gzip' if use_gzip else ''))
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if use_gzip:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(gzip.decompress(entry['content']), content_type=entry['content_type'])
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def _cache_key(request, name):
+    return 'nblog1:sitemap:{}:{}'.format(hashlib.md5(request.build_absolute_uri('/').encode('utf-8')).hexdigest(), name)
+
+
+def index(request):
+    """サイトマップのインデックス"""
+    return _cached_response(
+        request, _cache_key(request, 'index'), [INDEX_DEPENDENCY],
+        lambda: sitemap_views.index(request, sitemaps, sitemap_url_name='sitemap_section'),
+    )
+
+
+def section(request, section):
+    """サイトマップの1ページ"""
+    page = request.GET.get('p', '1')
+    if section not in sitemaps or not page.isdigit():
+        # 存在しないページの404は、Djangoのビューに任せる
+        return sitemap_views.sitemap(request, sitemaps, section)
+    return _cached_response(
+        request, _cache_key(request, f'{section}:{page}'), sitemaps[section]().get_page_dependencies(int(page)),
+        lambda: sitemap_views.sitemap(request, sitemaps, section),
+    )
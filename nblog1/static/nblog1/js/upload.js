@@ -6,32 +6,173 @@ const insertText = (textarea, text) => {
     textarea.value = before + text + after;
 };
 
-const upload = (uploadFile, textarea) => {
-    const formData = new FormData();
-    formData.append('file', uploadFile);
-    fetch(textarea.dataset.url, {
+// 送信に失敗した場合に送り直す回数
+const MAX_RETRIES = 5;
+
+// SHA-256を計算する際に、一度に読み込むサイズ
+const HASH_BLOCK_SIZE = 4 * 1024 * 1024;
+
+const SHA256_K = new Uint32Array([
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+]);
+
+const rotr = (x, n) => (x >>> n) | (x << (32 - n));
+
+// 少しずつデータを渡して計算するSHA-256。
+// crypto.subtle.digestはデータ全体を一度に渡す必要があり、大きなファイルを全てメモリに読み込んでしまうため。
+class Sha256 {
+    constructor() {
+        this.state = new Uint32Array([
+            0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+        ]);
+        this.block = new Uint8Array(64);
+        this.blockLength = 0;
+        this.length = 0;
+        this.words = new Uint32Array(64);
+    }
+
+    update(bytes) {
+        this.length += bytes.length;
+        let pos = 0;
+        while (pos < bytes.length) {
+            const size = Math.min(64 - this.blockLength, bytes.length - pos);
+            this.block.set(bytes.subarray(pos, pos + size), this.blockLength);
+            this.blockLength += size;
+            pos += size;
+            if (this.blockLength === 64) {
+                this.compress();
+                this.blockLength = 0;
+            }
+        }
+    }
+
+    compress() {
+        const w = this.words;
+        const block = this.block;
+        for (let i = 0; i < 16; i++) {
+            w[i] = (block[i * 4] << 24) | (block[i * 4 + 1] << 16) | (block[i * 4 + 2] << 8) | block[i * 4 + 3];
+        }
+        for (let i = 16; i < 64; i++) {
+            const s0 = rotr(w[i - 15], 7) ^ rotr(w[i - 15], 18) ^ (w[i - 15] >>> 3);
+            const s1 = rotr(w[i - 2], 17) ^ rotr(w[i - 2], 19) ^ (w[i - 2] >>> 10);
+            w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+        }
+        let [a, b, c, d, e, f, g, h] = this.state;
+        for (let i = 0; i < 64; i++) {
+            const t1 = (h + (rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)) + ((e & f) ^ (~e & g)) + SHA256_K[i] + w[i]) | 0;
+            const t2 = ((rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)) + ((a & b) ^ (a & c) ^ (b & c))) | 0;
+            h = g;
+            g = f;
+            f = e;
+            e = (d + t1) | 0;
+            d = c;
+            c = b;
+            b = a;
+            a = (t1 + t2) | 0;
+        }
+        const state = this.state;
+        state[0] += a;
+        state[1] += b;
+        state[2] += c;
+        state[3] += d;
+        state[4] += e;
+        state[5] += f;
+        state[6] += g;
+        state[7] += h;
+    }
+
+    hexdigest() {
+        const bitLength = this.length * 8;
+        // 末尾に0x80と0を足し、最後の8バイトにビット数を入れる
+        const padding = new Uint8Array((this.blockLength < 56 ? 56 : 120) - this.blockLength + 8);
+        padding[0] = 0x80;
+        const view = new DataView(padding.buffer);
+        view.setUint32(padding.length - 8, Math.floor(bitLength / 2 ** 32));
+        view.setUint32(padding.length - 4, bitLength >>> 0);
+        this.update(padding);
+        return Array.from(this.state, word => word.toString(16).padStart(8, '0')).join('');
+    }
+}
+
+// ファイルのSHA-256を、HASH_BLOCK_SIZEずつ読み込みながら計算する
+const sha256 = async file => {
+    const hash = new Sha256();
+    for (let offset = 0; offset < file.size; offset += HASH_BLOCK_SIZE) {
+        hash.update(new Uint8Array(await file.slice(offset, offset + HASH_BLOCK_SIZE).arrayBuffer()));
+    }
+    return hash.hexdigest();
+};
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+// 分割したデータを1つ送る。接続が切れた等で失敗したら、少し待って送り直す。
+// 409(位置が合わない)の場合は、サーバーが返す受信済みの位置から続ける。
+const sendChunk = async (state, uploadFile) => {
+    for (let attempt = 0; ; attempt++) {
+        try {
+            const response = await fetch(state.upload_url, {
+                method: 'PUT',
+                body: uploadFile.slice(state.offset, state.offset + state.chunk_size),
+                headers: {
+                    'X-CSRFToken': csrftoken,
+                    'Upload-Offset': state.offset,
+                },
+            });
+            if (response.ok || response.status === 409) {
+                return response.json();
+            }
+            if (response.status < 500 || attempt >= MAX_RETRIES) {
+                throw new Error((await response.json()).error);
+            }
+        } catch (error) {
+            if (attempt >= MAX_RETRIES) {
+                throw error;
+            }
+        }
+        await sleep(1000 * 2 ** attempt);
+    }
+};
+
+const upload = async (uploadFile, textarea) => {
+    // 同じファイルを途中まで送っていれば、その続きから送る
+    const response = await fetch(textarea.dataset.url, {
         method: 'POST',
-        body: formData,
+        body: JSON.stringify({
+            name: uploadFile.name,
+            size: uploadFile.size,
+            sha256: await sha256(uploadFile),
+        }),
         headers: {
             'X-CSRFToken': csrftoken,
+            'Content-Type': 'application/json',
         },
-    }).then(response => {
-        return response.json();
-    }).then(response => {
-        const extension = response.url.split('.').pop().toLowerCase();
-
-        // 画像ならimg要素に、そうでなければa要素に
-        if (['png', 'jpg', 'gif', 'jpeg', 'bmp'].includes(extension)) {
-            html = `![](${response.url})`;
-        } else {
-            html= `[](${response.url})`;
-        }
+    });
+    let state = await response.json();
+    if (!response.ok) {
+        throw new Error(JSON.stringify(state));
+    }
+    while (!state.url) {
+        state = await sendChunk(state, uploadFile);
+    }
 
-        insertText(textarea, html);
+    const extension = state.url.split('.').pop().toLowerCase();
 
-    }).catch(error => {
-        console.log(error);
-    });
+    // 画像ならimg要素に、そうでなければa要素に
+    let html;
+    if (['png', 'jpg', 'gif', 'jpeg', 'bmp'].includes(extension)) {
+        html = `![](${state.url})`;
+    } else {
+        html = `[](${state.url})`;
+    }
+
+    insertText(textarea, html);
 };
 
 
@@ -43,7 +184,9 @@ document.addEventListener('DOMContentLoaded', e => {
 
         textarea.addEventListener('drop', e => {
             e.preventDefault();
-            upload(e.dataTransfer.files[0], textarea);
+            upload(e.dataTransfer.files[0], textarea).catch(error => {
+                console.log(error);
+            });
         });
     }
 });
@@ -0,0 +1,101 @@
+"""内容のハッシュで保存するストレージ。
+
+アップロードされたファイルは、元のファイル名ではなく内容のSHA-256を名前にして
+blobs/<先頭2文字>/<次の2文字>/<SHA-256><拡張子> に保存します。
+同じ内容のファイルは一度しか書き込まず、参照数(Blob)だけを増やします。
+
+削除(django_cleanupによるものを含む)では参照数を減らすだけで、ファイルは消しません。
+参照数が0のまま、BLOB_GC_GRACE秒が経ったファイルを、collect_garbageがまとめて削除します。
+collect_garbageは、削除のたびにジョブとして予約され、run_jobsのワーカーが実行します。
+collect_blobsコマンドで実行することもできます。
+
+"""
+import hashlib
+import os
+import re
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils import timezone
+from .jobs import enqueue
+from .models import Blob
+
+BLOB_DIR = 'blobs'
+
+# 保存する名前に残す拡張子。画像の判定やContent-Typeに使われる。
+EXTENSION_RE = re.compile(r'^\.[0-9a-z]{1,10}$')
+
+
+def blob_name(sha256, extension):
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """内容のハッシュを名前にして保存し、同じ内容のファイルを共有するストレージ"""
+
+    def get_available_name(self, name, max_length=None):
+        # 保存する名前は_saveで内容から決めるので、ここでは変えない
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()
+        if not EXTENSION_RE.match(extension):
+            extension = ''
+
+        # 同じファイルシステム上の一時ファイルに書き込みながらハッシュを計算し、最後に移動する
+        temp_dir = self.path(BLOB_DIR)
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir, suffix='.tmp')
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+
+            name = blob_name(digest.hexdigest(), extension)
+            # 先に参照を増やしておけば、collect_garbageに削除されることはない
+            Blob.add_reference(name, size)
+            full_path = self.path(name)
+            if not os.path.exists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(temp_path, self.file_permissions_mode)
+                os.replace(temp_path, full_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return name
+
+    def delete(self, name):
+        """ファイルは削除せず、参照を1つ減らす。"""
+        Blob.remove_reference(name)
+        enqueue(
+            'nblog1.collect_blobs', key='collect_blobs',
+            run_at=timezone.now() + timedelta(seconds=settings.BLOB_GC_GRACE),
+        )
+
+    def collect_garbage(self):
+        """参照がなくなってからBLOB_GC_GRACE秒以上経ったファイルを削除する。削除した件数を返す。"""
+        deadline = timezone.now() - timedelta(seconds=settings.BLOB_GC_GRACE)
+        count = 0
+        for blob in Blob.objects.filter(refcount=0, orphaned_at__lt=deadline).iterator():
+            # 削除する前に同じファイルが保存された場合に備え、一度よけておき、
+            # 参照数が0のままBlobを削除できた場合だけファイルを削除する
+            full_path = self.path(blob.name)
+            trash_path = full_path + '.trash'
+            try:
+                os.replace(full_path, trash_path)
+            except FileNotFoundError:
+                trash_path = None
+            deleted, _ = Blob.objects.filter(pk=blob.pk, refcount=0).delete()
+            if trash_path is not None:
+                if deleted:
+                    os.remove(trash_path)
+                else:
+                    os.replace(trash_path, full_path)
+            count += deleted
+        return count
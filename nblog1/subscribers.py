@@ -0,0 +1,96 @@
+"""メール購読者(EmailPush)の読み書き。
+
+import_subscribers・export_subscribersコマンドで使います。
+CSV(1行目は見出し)とJSON Lines(1行に1つのJSONオブジェクト)に対応し、どちらも1行ずつ読み書きするので、
+件数が多くても使うメモリは一定です。
+
+"""
+import csv
+import json
+
+FIELDS = ('mail', 'is_active', 'digest')
+FORMATS = ('csv', 'jsonl')
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def guess_format(path, default='csv'):
+    """ファイル名の拡張子から形式を推測する。"""
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if path.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def to_bool(value, default):
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in TRUE_VALUES
+
+
+def _read_csv(file):
+    reader = csv.DictReader(file)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, None, str(e)
+        else:
+            yield reader.line_num, row, None
+
+
+def _read_jsonl(file):
+    for line_number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f'JSONとして読めません({e})'
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'JSONオブジェクトではありません'
+            continue
+        yield line_number, row, None
+
+
+def read_subscribers(file, file_format, on_error=None):
+    """ファイルから1件ずつ、(行番号, メールアドレス, 有効フラグ, まとめて受け取るか)を返すジェネレータ
+
+    有効フラグの列がなければ有効、まとめて受け取るかの列がなければFalseとします。
+    読めない行は読み飛ばし、on_errorがあれば(行番号, 理由)を渡して呼び出します。
+
+    """
+    rows = _read_csv(file) if file_format == 'csv' else _read_jsonl(file)
+    for line_number, row, error in rows:
+        if error is not None:
+            if on_error is not None:
+                on_error(line_number, error)
+            continue
+        yield (
+            line_number,
+            str(row.get('mail') or '').strip(),
+            to_bool(row.get('is_active'), True),
+            to_bool(row.get('digest'), False),
+        )
+
+
+def write_subscribers(file, rows, file_format):
+    """(メールアドレス, 有効フラグ, まとめて受け取るか)のイテラブルを、1件ずつファイルに書き込む。件数を返す。"""
+    count = 0
+    if file_format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(FIELDS)
+        for mail, is_active, digest in rows:
+            writer.writerow((mail, int(is_active), int(digest)))
+            count += 1
+    else:
+        for row in rows:
+            file.write(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n')
+            count += 1
+    return count
@@ -0,0 +1,126 @@
+"""記事タイトルのサジェスト用インデックス。
+
+関連記事の入力欄では、キーを入力するたびに候補を問い合わせます。
+毎回データベースを部分一致で検索しないよう、記事のタイトルをプロセスのメモリ上に持ち、
+1文字と2文字のn-gramから記事を引けるようにしておきます。
+
+記事が保存・削除されると、トランザクションのコミット後に、そのプロセスのインデックスを更新し、
+キャッシュ上のバージョンを変えます。キャッシュを共有している他のプロセスは、バージョンの違いに気づいた時点で
+インデックスを作り直します。共有していない場合(LocMemCache等)は他のプロセスには伝わりませんが、
+バージョンはSUGGEST_INDEX_TIMEOUT秒で期限が切れるので、それまでには作り直されます。
+ロールバックされた変更は反映せず、コミット前のデータで作り直したインデックスも、コミット後には古いものになります。
+
+"""
+import threading
+import uuid
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'nblog1:suggest_index_version'
+
+
+def _ngrams(text):
+    """1文字と2文字のn-gramの集合を返す。"""
+    return set(text) | {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+class TitleIndex:
+    """記事タイトルのn-gramインデックス"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.titles = {}
+        self.grams = defaultdict(set)
+
+    def _current_version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid.uuid4().hex, settings.SUGGEST_INDEX_TIMEOUT)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def _add(self, pk, title):
+        self.titles[pk] = title
+        for gram in _ngrams(title.lower()):
+            self.grams[gram].add(pk)
+
+    def _remove(self, pk):
+        title = self.titles.pop(pk, None)
+        if title is None:
+            return
+        for gram in _ngrams(title.lower()):
+            pks = self.grams.get(gram)
+            if pks is not None:
+                pks.discard(pk)
+                if not pks:
+                    del self.grams[gram]
+
+    def _ensure_fresh(self):
+        version = self._current_version()
+        if version == self.version:
+            return
+        from .models import Post
+        self.titles = {}
+        self.grams = defaultdict(set)
+        for pk, title in Post.objects.values_list('pk', 'title').iterator():
+            self._add(pk, title)
+        self.version = version
+
+    def search(self, keyword, limit=10):
+        """キーワードを含むタイトルの記事を、(pk, タイトル)のリストで返す。
+
+        完全一致、前方一致、キーワードが前の方にあるもの、短いタイトルの順に並べます。
+
+        """
+        keyword = keyword.lower()
+        with self.lock:
+            self._ensure_fresh()
+            grams = [keyword] if len(keyword) == 1 else [keyword[i:i + 2] for i in range(len(keyword) - 1)]
+            posting_lists = sorted((self.grams.get(gram, ()) for gram in grams), key=len)
+            candidates = set(posting_lists[0]).intersection(*posting_lists[1:])
+            matches = []
+            for pk in candidates:
+                title = self.titles[pk]
+                position = title.lower().find(keyword)
+                if position != -1:
+                    matches.append((position != 0 or len(title) != len(keyword), position, len(title), pk, title))
+        matches.sort()
+        return [(pk, title) for *_, pk, title in matches[:limit]]
+
+    def update(self, pk, title):
+        """記事の追加・更新を、コミット後に反映する。"""
+        transaction.on_commit(lambda: self._update(pk, title))
+
+    def remove(self, pk):
+        """記事の削除を、コミット後に反映する。"""
+        transaction.on_commit(lambda: self._remove_post(pk))
+
+    def _update(self, pk, title):
+        with self.lock:
+            fresh = self.version is not None and self.version == self._current_version()
+            self._remove(pk)
+            self._add(pk, title)
+            self.version = self._bump_version(fresh)
+
+    def _remove_post(self, pk):
+        with self.lock:
+            fresh = self.version is not None and self.version == self._current_version()
+            self._remove(pk)
+            self.version = self._bump_version(fresh)
+
+    def _bump_version(self, fresh):
+        """他のプロセスに作り直しを促すため、バージョンを変える。
+
+        このプロセスのインデックスが最新だった場合は、変更を反映済みなので新しいバージョンを返します。
+        そうでなければNoneを返し、次の検索時に作り直します。
+
+        """
+        version = uuid.uuid4().hex
+        cache.set(VERSION_KEY, version, settings.SUGGEST_INDEX_TIMEOUT)
+        return version if fresh else None
+
+
+title_index = TitleIndex()
@@ -0,0 +1,94 @@
+"""タグから記事IDへの逆引きインデックス。
+
+タグごとに、紐づいた記事のIDを昇順の整数配列(array)にしてキャッシュに持っておきます。
+複数のタグで絞り込む場合は、それらの配列の共通部分をメモリ上で求めるため、
+タグの数だけ中間テーブルをJOINする必要がありません。
+
+インデックスのキャッシュキーには、タグごとのバージョン(page_cacheの依存先 tag_index:<pk>)を含めます。
+記事とタグの紐づけが変わった時(m2m_changed)にタグ単位でバージョンを変え、コミット後にもう一度変えるので、
+コミット前のデータから作り直したインデックスが残ることはありません。
+
+CACHESが既定のLocMemCacheの場合、バージョンの変更はそのプロセスにしか届きません。
+複数プロセスで動かす場合は全プロセスで共有できるキャッシュを設定してください。
+共有していない場合でも、インデックスはTAG_INDEX_TIMEOUT秒で作り直されます。
+
+"""
+import json
+from array import array
+from bisect import bisect_left
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from . import page_cache
+from .models import Post
+
+# これ以下の件数なら、記事のIDをそのままIN句で渡す。
+# 多い場合、SQLiteではIDをJSONの配列1つにまとめて渡す。
+MAX_IN_IDS = 500
+
+
+def _dependency(tag_pk):
+    return f'tag_index:{tag_pk}'
+
+
+def _cache_key(tag_pk, version):
+    return f'nblog1:tag_index:{tag_pk}:{version}'
+
+
+def get_post_ids(tag_pks):
+    """タグのpkをキー、紐づいた記事IDの配列を値とした辞書を返す。"""
+    # 作り直す前にバージョンを読んでおく。作り直している間に紐づけが変われば、このキーは使われなくなる。
+    versions = page_cache.get_versions([_dependency(tag_pk) for tag_pk in tag_pks])
+    keys = {_cache_key(tag_pk, versions[_dependency(tag_pk)]): tag_pk for tag_pk in tag_pks}
+    result = {keys[key]: post_ids for key, post_ids in cache.get_many(keys).items()}
+
+    missing = [tag_pk for tag_pk in tag_pks if tag_pk not in result]
+    if missing:
+        built = {tag_pk: array('q') for tag_pk in missing}
+        rows = Post.tags.through.objects.filter(
+            tag_id__in=missing
+        ).order_by('tag_id', 'post_id').values_list('tag_id', 'post_id')
+        for tag_id, post_id in rows.iterator():
+            built[tag_id].append(post_id)
+        cache.set_many(
+            {_cache_key(tag_pk, versions[_dependency(tag_pk)]): post_ids for tag_pk, post_ids in built.items()},
+            settings.TAG_INDEX_TIMEOUT,
+        )
+        result.update(built)
+
+    return result
+
+
+def _contains(sorted_ids, value):
+    i = bisect_left(sorted_ids, value)
+    return i < len(sorted_ids) and sorted_ids[i] == value
+
+
+def intersect(tag_pks):
+    """全てのタグが紐づいた記事のIDを、昇順のリストで返す。"""
+    if not tag_pks:
+        return []
+    post_ids_list = sorted(get_post_ids(tag_pks).values(), key=len)
+    smallest, others = post_ids_list[0], post_ids_list[1:]
+    return [post_id for post_id in smallest if all(_contains(ids, post_id) for ids in others)]
+
+
+def filter_by_tags(queryset, tags):
+    """選択した全てのタグが紐づいた記事に絞り込む。"""
+    tag_pks = sorted({tag.pk for tag in tags})
+    post_ids = intersect(tag_pks)
+    if len(post_ids) <= MAX_IN_IDS or connection.vendor != 'sqlite':
+        return queryset.filter(pk__in=post_ids)
+
+    # SQLiteのパラメータ数の上限に掛からないよう、IDはJSONの配列1つにまとめて渡す
+    table = queryset.model._meta.db_table
+    return queryset.extra(
+        where=[f'{table}.id IN (SELECT value FROM json_each(%s))'],
+        params=[json.dumps(post_ids)],
+    )
+
+
+def invalidate(tag_pks):
+    """タグのインデックスを破棄する。トランザクションの中であれば、コミット後にもう一度破棄する。"""
+    if tag_pks:
+        page_cache.bump_versions(*[_dependency(tag_pk) for tag_pk in tag_pks])
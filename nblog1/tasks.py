@@ -0,0 +1,112 @@
+"""ジョブとして実行する処理。
+
+リクエストの中では、これらをjobs.enqueueで登録するだけにしています。
+
+"""
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage, send_mail
+from django.template.loader import render_to_string
+from django.utils import timezone
+from .jobs import build_request, enqueue, job
+from .models import Post, EmailDigest, EmailDigestEntry
+
+
+@job('nblog1.notify_line')
+def notify_line(payload):
+    """記事をラインで通知"""
+    post = Post.objects.get(pk=payload['post_pk'])
+    post.line_push(build_request(payload))
+
+
+@job('nblog1.multicast_line')
+def multicast_line(payload):
+    """ラインでの通知のうち、送信に失敗した宛先のまとまりに送り直す"""
+    from .line import LineClient
+    client = LineClient(settings.LINE_BOT_API_KEY, endpoint=settings.LINE_API_ENDPOINT)
+    client.multicast(payload['user_ids'], payload['messages'])
+
+
+@job('nblog1.notify_browser')
+def notify_browser(payload):
+    """記事をブラウザ通知"""
+    post = Post.objects.get(pk=payload['post_pk'])
+    post.browser_push()
+
+
+@job('nblog1.notify_email')
+def notify_email(payload):
+    """記事をメールで通知。途中で失敗した場合、再実行時には続きから送信される。
+
+    まとめて受け取る宛先には、期間の終わりにsend_email_digestでまとめて送信する。
+
+    """
+    post = Post.objects.get(pk=payload['post_pk'])
+    EmailDigestEntry.add(post)
+    # 期間ごとに1つだけ、期間の終わりに実行するジョブを登録する
+    interval = settings.EMAIL_DIGEST_INTERVAL
+    period = int(timezone.now().timestamp() // interval)
+    enqueue(
+        'nblog1.send_email_digest', {'scheme': payload['scheme'], 'host': payload['host']},
+        key=f'email_digest:{period}',
+        run_at=datetime.fromtimestamp((period + 1) * interval, tz=dt_timezone.utc),
+    )
+    post.email_push(build_request(payload))
+
+
+@job('nblog1.send_email_digest')
+def send_email_digest(payload):
+    """期間中に通知した記事を、まとめて受け取る宛先へ1通にまとめて送信する"""
+    request = build_request(payload)
+    # 前回に途中で失敗したまとめがあれば、先にその続きを送信する
+    for digest in EmailDigest.objects.filter(finished_at__isnull=True).order_by('pk'):
+        digest.push(request)
+    # その後に通知した記事も、取り残さないようにまとめて送信する
+    digest = EmailDigest.collect()
+    if digest is not None:
+        digest.push(request)
+
+
+@job('nblog1.send_comment_mail')
+def send_comment_mail(payload):
+    """コメントがあったことを管理者に伝える"""
+    request = build_request(payload)
+    context = {
+        'post': Post.objects.get(pk=payload['post_pk']),
+    }
+    subject = render_to_string('nblog1/mail/comment_notify_subject.txt', context, request)
+    message = render_to_string('nblog1/mail/comment_notify_message.txt', context, request)
+    from_email = settings.DEFAULT_FROM_EMAIL
+    recipient_list = [settings.DEFAULT_FROM_EMAIL]
+    send_mail(subject, message, from_email, recipient_list)
+
+
+@job('nblog1.send_reply_mail')
+def send_reply_mail(payload):
+    """コメントに返信があったことを、管理者とコメント者に伝える"""
+    request = build_request(payload)
+    context = {
+        'post': Post.objects.get(pk=payload['post_pk']),
+    }
+    subject = render_to_string('nblog1/mail/reply_notify_subject.txt', context, request)
+    message = render_to_string('nblog1/mail/reply_notify_message.txt', context, request)
+    from_email = settings.DEFAULT_FROM_EMAIL
+    bcc = [settings.DEFAULT_FROM_EMAIL]
+    email = EmailMessage(subject, message, from_email, payload['recipient_list'], bcc)
+    email.send()
+
+
+@job('nblog1.collect_blobs')
+def collect_blobs(payload):
+    """参照されなくなったメディアファイルを削除する"""
+    default_storage.collect_garbage()
+
+
+@job('nblog1.create_image_variants')
+def create_image_variants(payload):
+    """アップロードされた画像の縮小版・WebPを作り、その画像を使っている本文に反映する"""
+    from .images import create_variants
+    resized = create_variants(payload['name'])
+    if resized is not None:
+        resized.render_texts()
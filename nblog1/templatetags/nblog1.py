@@ -4,8 +4,7 @@ from django.conf import settings
 from django.shortcuts import resolve_url
 from django.utils.safestring import mark_safe
 from nblog1.forms import EmailForm
-import markdown
-from markdown.extensions import Extension
+from nblog1.rendering import render_markdown
 
 register = template.Library()
 
@@ -21,17 +20,10 @@ def url_replace(request, field, value):
 @register.filter
 def markdown_to_html(text):
     """マークダウンをhtmlに変換する。"""
-    html = markdown.markdown(text, extensions=settings.MARKDOWN_EXTENSIONS)
+    html = render_markdown(text)
     return mark_safe(html)
 
 
-class EscapeHtml(Extension):
-
-    def extendMarkdown(self, md):
-        md.preprocessors.deregister('html_block')
-        md.inlinePatterns.deregister('html')
-
-
 @register.filter
 def markdown_to_html_with_escape(text):
     """マークダウンをhtmlに変換する。
@@ -40,8 +32,7 @@ def markdown_to_html_with_escape(text):
     公開しているコメント欄等には、こちらを使ってください。
 
     """
-    extensions = settings.MARKDOWN_EXTENSIONS + [EscapeHtml()]
-    html = markdown.markdown(text, extensions=extensions)
+    html = render_markdown(text, escape=True)
     return mark_safe(html)
 
 
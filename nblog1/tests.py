@@ -1,3 +1,1415 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock, skipUnless
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Permission
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.signing import dumps
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
+from django.http import Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from blog.test_utils import QueryPlanMixin
+from . import jobs, media, page_cache, tag_index, uploads
+from .admin import retry_jobs
+from .http_client import CircuitOpenError, HttpClient
+from .line import MULTICAST_MAX_RECIPIENTS, LineClient
+from .management.commands.export_static import output_path
+from .models import (
+    Post, Comment, Reply, Tag, LinePush, Job, ResizedImage, EmailPush, EmailDigest, EmailDigestEntry, Blob,
+    ChunkedUpload, EmailPushLog,
+)
+from .rendering import config_digest, preload_resized_images, render_markdown
+from .search import search_posts
+from .suggest import title_index
+from .tasks import send_email_digest
+from .threads import load_comment_threads
 
-# Create your tests here.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+class PostDetailQueryCountTests(TestCase):
+    """記事詳細ページのクエリ数が、コメントの件数に関わらず一定であることの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.post = Post.objects.create(title='記事', text='# 本文', description='説明')
+        cls.post.tags.add(Tag.objects.create(name='タグ'))
+        cls.post.relation_posts.add(Post.objects.create(title='関連記事', text='本文', description='説明'))
+
+    def create_comments(self, count):
+        comments = [Comment(target=self.post, name=f'名前{i}', text=f'コメント{i}') for i in range(count)]
+        for comment in comments:
+            comment.render_text()
+        Comment.objects.bulk_create(comments)
+        replies = [Reply(target=comment, text='返信') for comment in Comment.objects.filter(target=self.post)]
+        for reply in replies:
+            reply.render_text()
+        Reply.objects.bulk_create(replies)
+
+    def get_detail(self, num=5):
+        url = reverse('nblog1:post_detail', kwargs={'pk': self.post.pk})
+        # 記事, タグ, 関連記事, コメント, 返信の5回
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_no_comments(self):
+        response = self.get_detail()
+        self.assertContains(response, 'まだコメントはありません。')
+
+    def test_many_comments(self):
+        self.create_comments(1000)
+        response = self.get_detail()
+        self.assertContains(response, 'コメント999')
+        self.assertContains(response, '関連記事')
+
+    def test_stale_html(self):
+        # 一度も変換していないコメントと、古い変換設定のキーを持つ返信
+        Comment.objects.bulk_create([Comment(target=self.post, text=f'**コメント{i}**') for i in range(50)])
+        Reply.objects.bulk_create([
+            Reply(target=comment, text='**返信**', text_html='古いHTML', text_html_key='old:key')
+            for comment in Comment.objects.filter(target=self.post)
+        ])
+        # 古いものの本文を、コメントと返信で1回ずつまとめて読み込む
+        response = self.get_detail(7)
+        self.assertContains(response, '<strong>コメント49</strong>')
+        self.assertContains(response, '<strong>返信</strong>', count=50)
+        self.assertNotContains(response, '古いHTML')
+
+
+class TagPostCountTests(TestCase):
+    """タグの公開記事数が、紐づけや公開状態の変更で数え直されることの確認"""
+
+    def assertCounts(self, *expected):
+        self.assertEqual(
+            [tag.public_post_count for tag in Tag.objects.filter(pk__in=[tag.pk for tag in self.tags]).order_by('pk')],
+            list(expected),
+        )
+
+    def test_counts(self):
+        self.tags = [Tag.objects.create(name=f'タグ{i}') for i in range(2)]
+        first = Post.objects.create(title='記事1', text='本文', description='説明', is_public=True)
+        second = Post.objects.create(title='記事2', text='本文', description='説明', is_public=True)
+        hidden = Post.objects.create(title='非公開', text='本文', description='説明', is_public=False)
+
+        # 記事側・タグ側からの追加
+        first.tags.add(*self.tags)
+        self.tags[0].post_set.add(second, hidden)
+        self.assertCounts(2, 1)
+        # 記事側・タグ側からの削除
+        first.tags.remove(self.tags[1])
+        self.assertCounts(2, 0)
+        self.tags[0].post_set.remove(second)
+        self.assertCounts(1, 0)
+
+        # 公開・非公開の切り替え
+        hidden.is_public = True
+        hidden.save()
+        self.assertCounts(2, 0)
+        first.is_public = False
+        first.save()
+        self.assertCounts(1, 0)
+
+        # 記事側・タグ側からのclear
+        second.tags.add(*self.tags)
+        self.assertCounts(2, 1)
+        second.tags.clear()
+        self.assertCounts(1, 0)
+        hidden.tags.add(self.tags[1])
+        self.tags[0].post_set.clear()
+        self.assertCounts(0, 1)
+
+        # 記事の削除
+        hidden.delete()
+        self.assertCounts(0, 0)
+
+
+@override_settings(USE_KEYSET_PAGINATION=True)
+class KeysetPaginationTests(TestCase):
+    """記事一覧の、カーソルでのページ送りの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        # 更新日が同じ記事があっても、pkの順でページをまたいで並ぶ
+        now = timezone.now()
+        Post.objects.bulk_create([
+            Post(title=f'記事{i}', text='本文', description='説明', updated_at=now - timedelta(minutes=i // 2))
+            for i in range(25)
+        ])
+        cls.expected = list(Post.objects.order_by('-updated_at', '-pk').values_list('pk', flat=True))
+
+    def get_page(self, cursor=None):
+        response = self.client.get(reverse('nblog1:top'), {'cursor': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200)
+        return response.context['page_obj']
+
+    def test_next_and_previous(self):
+        pages = [self.get_page()]
+        while pages[-1].has_next():
+            pages.append(self.get_page(pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([post.pk for page in pages for post in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[-1].has_previous())
+
+        # 前のページへ戻ると、同じ記事が同じ順で並ぶ
+        previous = self.get_page(pages[2].previous_cursor)
+        self.assertEqual([post.pk for post in previous], [post.pk for post in pages[1]])
+        self.assertTrue(previous.has_next())
+        first = self.get_page(previous.previous_cursor)
+        self.assertEqual([post.pk for post in first], [post.pk for post in pages[0]])
+        self.assertFalse(first.has_previous())
+
+    def test_tampered_cursor(self):
+        cursor = self.get_page().next_cursor
+        for tampered in (cursor[:-1] + ('A' if cursor[-1] != 'A' else 'B'), 'garbage', dumps(['2020-01-01', 1, 'x'])):
+            with self.subTest(cursor=tampered):
+                response = self.client.get(reverse('nblog1:top'), {'cursor': tampered})
+                self.assertEqual(response.status_code, 404)
+
+
+@override_settings(USE_PAGE_CACHE=True)
+class PageCacheTests(TestCase):
+    """匿名ユーザー向けのページキャッシュの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tag = Tag.objects.create(name='タグ')
+        cls.relation_post = Post.objects.create(title='関連記事', text='本文', description='説明')
+        cls.post = Post.objects.create(title='記事', text='本文', description='説明')
+        cls.post.tags.add(cls.tag)
+        cls.post.relation_posts.add(cls.relation_post)
+        cls.url = reverse('nblog1:post_detail', kwargs={'pk': cls.post.pk})
+        Comment.objects.bulk_create([Comment(target=cls.post, text='削除するコメント')])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hit_and_miss(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, '記事')
+        # 2回目はキャッシュから返すので、データベースにはアクセスしない
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url)
+        self.assertEqual(cached.content, response.content)
+        # ログインしているユーザーにはキャッシュを使わない
+        self.client.force_login(get_user_model().objects.create_user('user', password='password'))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.url)
+        self.assertTrue(context.captured_queries)
+
+    def test_invalidation(self):
+        self.client.get(self.url)
+        Post.objects.filter(pk=self.post.pk).update(title='書き換え')
+        # シグナルを通さない変更では、キャッシュのまま
+        self.assertNotContains(self.client.get(self.url), '書き換え')
+
+        self.post.refresh_from_db()
+        self.post.save()
+        self.assertContains(self.client.get(self.url), '書き換え')
+
+        self.tag.name = '新しいタグ'
+        self.tag.save()
+        self.assertContains(self.client.get(self.url), '新しいタグ')
+
+        self.relation_post.title = '新しい関連記事'
+        self.relation_post.save()
+        self.assertContains(self.client.get(self.url), '新しい関連記事')
+
+        self.assertContains(self.client.get(self.url), '削除するコメント')
+        Comment.objects.get(target=self.post).delete()
+        self.assertNotContains(self.client.get(self.url), '削除するコメント')
+
+    def test_change_during_render(self):
+        def change_post(post):
+            Post.objects.filter(pk=post.pk).update(title='描画中の変更')
+            Post.objects.get(pk=post.pk).save()
+            return load_comment_threads(post)
+
+        with mock.patch('nblog1.views.load_comment_threads', change_post):
+            self.assertNotContains(self.client.get(self.url), '描画中の変更')
+        # 描画前のバージョンで保存しているので、次のリクエストでは変更後のページになる
+        self.assertContains(self.client.get(self.url), '描画中の変更')
+
+
+class PageCacheCommitTests(TransactionTestCase):
+    """トランザクションの中での無効化が、コミット後にも反映されることの確認"""
+
+    def test_bump_after_commit(self):
+        with transaction.atomic():
+            page_cache.bump_versions(page_cache.POSTS)
+            # コミット前に、他のリクエストがこのバージョンで変更前のページを保存したとする
+            versions = page_cache.get_versions([page_cache.POSTS])
+        self.assertNotEqual(page_cache.get_versions([page_cache.POSTS]), versions)
+
+
+class TagIndexTests(TestCase):
+    """タグの逆引きインデックスでの絞り込みの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Post.objects.bulk_create([Post(title=f'記事{i}', text='本文', description='説明') for i in range(1200)])
+        cls.posts = list(Post.objects.order_by('pk'))
+        cls.tag_a = Tag.objects.create(name='A')
+        cls.tag_b = Tag.objects.create(name='B')
+        cls.tag_a.post_set.add(*cls.posts[:1000])
+        cls.tag_b.post_set.add(*cls.posts[200:])
+
+    def setUp(self):
+        cache.clear()
+
+    def filter(self, *tags):
+        return list(tag_index.filter_by_tags(Post.objects.order_by('pk'), tags))
+
+    def test_intersection(self):
+        self.assertEqual(self.filter(self.tag_a), self.posts[:1000])
+        # 共通部分が多い場合も、求めた共通部分をそのまま使う
+        self.assertEqual(self.filter(self.tag_a, self.tag_b), self.posts[200:1000])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.filter(self.tag_a, self.tag_b), self.posts[200:1000])
+
+    def test_invalidate(self):
+        self.assertEqual(self.filter(self.tag_a, self.tag_b), self.posts[200:1000])
+        self.tag_a.post_set.add(self.posts[1100])
+        self.posts[300].tags.remove(self.tag_b)
+        expected = [*self.posts[200:300], *self.posts[301:1000], self.posts[1100]]
+        self.assertEqual(self.filter(self.tag_a, self.tag_b), expected)
+
+
+class TagIndexCommitTests(TransactionTestCase):
+    """コミット前のデータから作ったインデックスが、コミット後に使われないことの確認"""
+
+    def test_rebuild_after_commit(self):
+        post = Post.objects.create(title='記事', text='本文', description='説明')
+        tag = Tag.objects.create(name='タグ')
+        with transaction.atomic():
+            post.tags.add(tag)
+            # コミット前に、他のリクエストが変更前のデータでインデックスを作ったとする
+            version = page_cache.get_versions([f'tag_index:{tag.pk}'])[f'tag_index:{tag.pk}']
+            cache.set(f'nblog1:tag_index:{tag.pk}:{version}', array('q'))
+        self.assertEqual(tag_index.intersect([tag.pk]), [post.pk])
+
+
+class RenderedTextTests(TestCase):
+    """保存済みの本文のHTMLと、変換設定のハッシュの確認"""
+
+    def test_config_digest(self):
+        digest = config_digest()
+        self.assertIs(config_digest(), digest)
+        self.assertNotEqual(config_digest(escape=True), digest)
+        post = Post.objects.create(title='記事', text='**本文**', description='説明')
+        self.assertTrue(post.text_html_key.startswith(digest + ':'))
+
+        # 変換設定が変われば、閲覧時に変換し直す
+        with override_settings(MARKDOWN_EXTENSIONS=['markdown.extensions.extra']):
+            self.assertNotEqual(config_digest(), digest)
+            self.assertEqual(post.html, '<p><strong>本文</strong></p>')
+            self.assertFalse(post.text_html_key.startswith(digest + ':'))
+        self.assertEqual(config_digest(), digest)
+
+    def test_render_markdown_command(self):
+        post = Post.objects.create(title='記事', text='**本文**', description='説明')
+        Comment.objects.bulk_create([Comment(target=post, text='<b>コメント</b>')])
+        # マイグレーション前から保存されていた、HTMLのない本文
+        Post.objects.filter(pk=post.pk).update(text_html='', text_html_key='')
+        stdout = io.StringIO()
+        call_command('render_markdown', stdout=stdout)
+        self.assertIn('1/1件', stdout.getvalue())
+        post.refresh_from_db()
+        self.assertEqual(post.text_html, '<p><strong>本文</strong></p>')
+        self.assertEqual(Comment.objects.get(target=post).text_html, '<p>&lt;b&gt;コメント&lt;/b&gt;</p>')
+
+        # 変わっていないものは変換しない
+        stdout = io.StringIO()
+        call_command('render_markdown', stdout=stdout)
+        self.assertNotIn('1/1件', stdout.getvalue())
+
+
+class ResponsiveImageTests(TestCase):
+    """アップロードした画像への、srcset等の付与の確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.variants = [
+            {'name': 'blobs/aa/aa/480.jpg', 'width': 480, 'type': 'image/jpeg'},
+            {'name': 'blobs/bb/bb/480.webp', 'width': 480, 'type': 'image/webp'},
+            {'name': 'blobs/cc/cc/2000.webp', 'width': 2000, 'type': 'image/webp'},
+        ]
+
+    def create_resized(self):
+        return ResizedImage.objects.create(
+            name='photo.jpg', sha256='0' * 64, type='image/jpeg', width=2000, height=1000, variants=self.variants,
+        )
+
+    def test_srcset(self):
+        self.create_resized()
+        html = render_markdown('![写真](/media/photo.jpg)')
+        self.assertInHTML(
+            '<picture>'
+            '<source type="image/webp" srcset="/media/blobs/bb/bb/480.webp 480w, /media/blobs/cc/cc/2000.webp 2000w"'
+            ' sizes="(max-width: 960px) 100vw, 960px">'
+            '<img alt="写真" src="/media/photo.jpg" srcset="/media/blobs/aa/aa/480.jpg 480w, /media/photo.jpg 2000w"'
+            ' sizes="(max-width: 960px) 100vw, 960px" width="2000" height="1000" loading="lazy">'
+            '</picture>',
+            html,
+        )
+
+    def test_no_variants(self):
+        self.create_resized()
+        # 外部の画像や派生ファイルのない画像は、そのまま
+        with self.assertNumQueries(1):
+            html = render_markdown('![外部](https://example.com/photo.jpg) ![なし](/media/other.jpg)')
+        self.assertNotIn('<picture>', html)
+        # MEDIA_URL以下の画像がなければ、データベースは見ない
+        with self.assertNumQueries(0):
+            render_markdown('本文だけ')
+
+    def test_preload(self):
+        self.create_resized()
+        with self.assertNumQueries(1), preload_resized_images():
+            for _ in range(3):
+                self.assertIn('<picture>', render_markdown('![写真](/media/photo.jpg)'))
+
+    def test_render_texts(self):
+        post = Post.objects.create(title='記事', text='![写真](/media/photo.jpg)', description='説明')
+        self.assertNotIn('srcset', post.text_html)
+        # 派生ファイルを後から作った場合も、本文に反映する
+        self.assertEqual(self.create_resized().render_texts(), 1)
+        post.refresh_from_db()
+        self.assertIn('srcset', post.text_html)
+
+
+@skipUnless(Image, 'Pillowが必要です')
+class ImageVariantTests(TestCase):
+    """Pillowで実際に縮小版・WebPを作り、srcsetに使われることの確認"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        overridden = override_settings(MEDIA_ROOT=self.temp_dir, IMAGE_VARIANT_WIDTHS=[480, 960])
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def save_image(self, name, size):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        return default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    def test_create_variants(self):
+        from .images import create_variants
+        name = self.save_image('photo.jpg', (1200, 800))
+        resized = create_variants(name)
+        self.assertEqual((resized.type, resized.width, resized.height), ('image/jpeg', 1200, 800))
+        self.assertEqual(sorted((variant['type'], variant['width']) for variant in resized.variants), [
+            ('image/jpeg', 480), ('image/jpeg', 960), ('image/webp', 480), ('image/webp', 960), ('image/webp', 1200),
+        ])
+        for variant in resized.variants:
+            with default_storage.open(variant['name']) as file, Image.open(file) as image:
+                self.assertEqual(image.width, variant['width'])
+                self.assertEqual(image.format, variant['type'].split('/')[1].upper())
+
+        # 同じ画像は作り直さず、派生ファイルを共有する
+        blob_count = Blob.objects.count()
+        copy = create_variants(self.save_image('copy.jpg', (1200, 800)))
+        self.assertEqual(copy.variants, resized.variants)
+        self.assertEqual(Blob.objects.count(), blob_count)
+
+        html = render_markdown(f'![写真]({default_storage.url(name)})')
+        variants = {
+            (variant['type'], variant['width']): default_storage.url(variant['name']) for variant in resized.variants
+        }
+        self.assertIn(f'{variants["image/webp", 480]} 480w, {variants["image/webp", 960]} 960w', html)
+        self.assertIn(f'{variants["image/jpeg", 960]} 960w, {default_storage.url(name)} 1200w', html)
+        self.assertIn('width="1200" height="800"', html)
+
+    def test_not_image(self):
+        from .images import create_variants
+        self.assertIsNone(create_variants(default_storage.save('note.jpg', ContentFile(b'not an image'))))
+        # 展開すると大きすぎる画像は、派生ファイルを作らない
+        name = self.save_image('bomb.jpg', (1200, 800))
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 100):
+            self.assertIsNone(create_variants(name))
+        self.assertFalse(ResizedImage.objects.exists())
+
+
+class UploadTests(TestCase):
+    """ファイルの分割アップロードの確認"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        overridden = override_settings(
+            MEDIA_ROOT=self.temp_dir, FILE_UPLOAD_TEMP_DIR=self.temp_dir, UPLOAD_CHUNK_SIZE=4,
+        )
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.user = self.create_staff('user')
+
+    def create_staff(self, username):
+        user = get_user_model().objects.create_user(username, password='password', is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='add_post'))
+        return user
+
+    def upload(self, name, data):
+        upload = uploads.start(self.user, name, len(data), hashlib.sha256(data).hexdigest())
+        for offset in range(0, len(data), 4):
+            chunk = data[offset:offset + 4]
+            uploads.write_chunk(upload, offset, io.BytesIO(chunk), len(chunk))
+        return uploads.finish(upload)
+
+    def start_upload(self, data, **kwargs):
+        params = {'name': 'note.txt', 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest(), **kwargs}
+        return self.client.post(reverse('nblog1:image_upload'), json.dumps(params), content_type='application/json')
+
+    def put_chunk(self, url, offset, chunk):
+        return self.client.put(url, chunk, content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resume(self):
+        self.client.force_login(self.user)
+        data = b'0123456789'
+        state = self.start_upload(data).json()
+        self.assertEqual(state['offset'], 0)
+        self.assertEqual(self.put_chunk(state['upload_url'], 0, data[:4]).json()['offset'], 4)
+
+        # 同じファイルをもう一度開始すると、続きの位置が返る
+        resumed = self.start_upload(data).json()
+        self.assertEqual(resumed, {**state, 'offset': 4})
+        self.assertEqual(self.client.get(state['upload_url']).json()['offset'], 4)
+        self.assertEqual(self.put_chunk(state['upload_url'], 4, data[4:8]).json()['offset'], 8)
+        url = self.put_chunk(state['upload_url'], 8, data[8:]).json()['url']
+        with default_storage.open(url.rsplit('/media/', 1)[1]) as file:
+            self.assertEqual(file.read(), data)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+    def test_out_of_order(self):
+        self.client.force_login(self.user)
+        data = b'0123456789'
+        state = self.start_upload(data).json()
+        self.put_chunk(state['upload_url'], 0, data[:4])
+        # 受信済みの位置と合わないデータは、書き込まずに409と現在の位置を返す
+        for offset in (0, 8):
+            response = self.put_chunk(state['upload_url'], offset, data[offset:offset + 2])
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.json()['offset'], 4)
+        self.put_chunk(state['upload_url'], 4, data[4:8])
+        url = self.put_chunk(state['upload_url'], 8, data[8:]).json()['url']
+        with default_storage.open(url.rsplit('/media/', 1)[1]) as file:
+            self.assertEqual(file.read(), data)
+
+    def test_checksum_mismatch(self):
+        self.client.force_login(self.user)
+        data = b'0123'
+        state = self.start_upload(data, sha256=hashlib.sha256(b'other').hexdigest()).json()
+        response = self.put_chunk(state['upload_url'], 0, data)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        # 受信したデータは捨て、ストレージには保存しない
+        self.assertFalse(ChunkedUpload.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+
+    @override_settings(UPLOAD_MAX_SIZE=8)
+    def test_oversize(self):
+        self.client.force_login(self.user)
+        response = self.start_upload(b'0123456789')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('size', response.json())
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+        # UPLOAD_CHUNK_SIZEより大きいデータや、開始時のサイズを超えるデータは受け付けない
+        state = self.start_upload(b'012345').json()
+        self.assertEqual(self.put_chunk(state['upload_url'], 0, b'01234').status_code, 400)
+        self.put_chunk(state['upload_url'], 0, b'0123')
+        self.assertEqual(self.put_chunk(state['upload_url'], 4, b'456').status_code, 400)
+        self.assertEqual(self.client.get(state['upload_url']).json()['offset'], 4)
+
+    def test_other_user(self):
+        response = self.start_upload(b'0123')
+        self.assertEqual(response.status_code, 403)
+        self.client.force_login(self.user)
+        state = self.start_upload(b'0123').json()
+        self.client.force_login(self.create_staff('other'))
+        self.assertEqual(self.client.get(state['upload_url']).status_code, 404)
+        self.assertEqual(self.put_chunk(state['upload_url'], 0, b'0123').status_code, 404)
+
+    def test_permission(self):
+        # 記事を書けないユーザーは、ログインしていてもアップロードできない
+        for user in (
+            get_user_model().objects.create_user('member', password='password'),
+            get_user_model().objects.create_user('staff', password='password', is_staff=True),
+        ):
+            with self.subTest(user=user):
+                self.client.force_login(user)
+                self.assertEqual(self.start_upload(b'0123').status_code, 403)
+        self.client.force_login(self.user)
+        state = self.start_upload(b'0123').json()
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.put_chunk(state['upload_url'], 0, b'0123').status_code, 403)
+
+    def test_image_variants_job(self):
+        name = self.upload('photo.JPG', b'not really a jpeg')
+        job = Job.objects.get(name='nblog1.create_image_variants')
+        self.assertEqual(job.payload, {'name': name})
+        # 画像ではないファイルには、ジョブを登録しない
+        self.upload('note.txt', b'text')
+        self.assertEqual(Job.objects.filter(name='nblog1.create_image_variants').count(), 1)
+
+
+class BlobReferenceTests(TestCase):
+    """同じ内容のファイルを保存した時の、参照数の確認"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        overridden = override_settings(MEDIA_ROOT=self.temp_dir)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def test_same_attachment(self):
+        post = Post.objects.create(
+            title='記事', text='本文', description='説明', attachment=ContentFile(b'data', name='a.txt'),
+        )
+        name = post.attachment.name
+        self.assertTrue(name.startswith('blobs/'))
+        # 同じ内容のファイルで置き換えても、参照は1つのまま
+        post = Post.objects.get(pk=post.pk)
+        post.attachment = ContentFile(b'data', name='b.txt')
+        post.save()
+        self.assertEqual(post.attachment.name, name)
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+        # 添付ファイルを変えずに保存しても、参照は変わらない
+        Post.objects.get(pk=post.pk).save()
+        self.assertEqual(Blob.objects.get(name=name).refcount, 1)
+
+    def test_release_image_variants(self):
+        variant_name = default_storage.save('480.webp', ContentFile(b'variant'))
+        variants = [{'name': variant_name, 'width': 480, 'type': 'image/webp'}]
+        images = [
+            ResizedImage.objects.create(
+                name=name, sha256='a' * 64, type='image/jpeg', width=960, height=640, variants=variants,
+            )
+            for name in ('a.jpg', 'b.jpg')
+        ]
+        # 同じ画像の派生ファイルは共有しているので、最後のResizedImageがなくなった時に参照を戻す
+        images[0].delete()
+        self.assertEqual(Blob.objects.get(name=variant_name).refcount, 1)
+        images[1].delete()
+        self.assertEqual(Blob.objects.get(name=variant_name).refcount, 0)
+
+
+class EmailPushTests(TestCase):
+    """記事のメール通知を、まとめて送信し、途中で失敗しても続きから送ることの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        EmailPush.objects.bulk_create([
+            *[EmailPush(mail=f'user{i}@example.com', is_active=True) for i in range(10)],
+            EmailPush(mail='inactive@example.com'),
+            EmailPush(mail='digest@example.com', is_active=True, digest=True),
+        ])
+        cls.post = Post.objects.create(title='記事', text='本文', description='説明')
+
+    @override_settings(EMAIL_PUSH_BATCH_SIZE=3)
+    def test_resume(self):
+        send_messages = locmem.EmailBackend.send_messages
+        batches = []
+
+        def fail_second_batch(backend, messages):
+            batches.append(len(messages))
+            if len(batches) == 2:
+                raise ConnectionError('接続が切れました')
+            return send_messages(backend, messages)
+
+        request = RequestFactory().get('/')
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', fail_second_batch):
+            with self.assertRaises(ConnectionError):
+                self.post.email_push(request)
+            self.assertEqual(len(mail.outbox), 3)
+            log = EmailPushLog.objects.get(post=self.post)
+            self.assertEqual(log.sent_count, 3)
+            self.assertIsNone(log.finished_at)
+
+            # 再実行すると、送信できなかったまとまりから続ける
+            self.assertEqual(self.post.email_push(request), 7)
+        self.assertEqual(batches, [3, 3, 3, 3, 1])
+        recipients = [message.to[0] for message in mail.outbox]
+        self.assertEqual(sorted(recipients), sorted(f'user{i}@example.com' for i in range(10)))
+        log.refresh_from_db()
+        self.assertEqual(log.sent_count, 10)
+        self.assertIsNotNone(log.finished_at)
+        # 宛先ごとに、購読解除用のトークンが差し替えられている
+        self.assertEqual(len({message.body for message in mail.outbox}), 10)
+
+
+class EmailDigestTests(TestCase):
+    """まとめて送るメール通知の確認"""
+    payload = {'scheme': 'http', 'host': 'testserver'}
+
+    @classmethod
+    def setUpTestData(cls):
+        EmailPush.objects.bulk_create([
+            EmailPush(mail='digest@example.com', is_active=True, digest=True),
+            EmailPush(mail='each@example.com', is_active=True),
+        ])
+        cls.first = Post.objects.create(title='最初の記事', text='本文', description='説明')
+        cls.second = Post.objects.create(title='次の記事', text='本文', description='説明')
+
+    def test_resume_and_collect(self):
+        # 前回は途中で失敗し、その後に次の記事が通知された
+        EmailDigestEntry.add(self.first)
+        unfinished = EmailDigest.collect()
+        EmailDigestEntry.add(self.second)
+
+        send_email_digest(self.payload)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('最初の記事', mail.outbox[0].body)
+        self.assertIn('次の記事', mail.outbox[1].body)
+        self.assertEqual(mail.outbox[1].to, ['digest@example.com'])
+        unfinished.refresh_from_db()
+        self.assertIsNotNone(unfinished.finished_at)
+        self.assertFalse(EmailDigest.objects.filter(finished_at__isnull=True).exists())
+        self.assertFalse(EmailDigestEntry.objects.filter(digest__isnull=True).exists())
+
+        # 送信済みのものは、もう送らない
+        send_email_digest(self.payload)
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_empty(self):
+        post = Post.objects.create(title='削除する記事', text='本文', description='説明')
+        EmailDigestEntry.add(post)
+        digest = EmailDigest.collect()
+        post.delete()
+
+        send_email_digest(self.payload)
+        self.assertEqual(mail.outbox, [])
+        digest.refresh_from_db()
+        self.assertIsNotNone(digest.finished_at)
+
+
+class TitleIndexTests(TransactionTestCase):
+    """サジェスト用のインデックスに、コミットした変更だけが反映されることの確認"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_commit_and_rollback(self):
+        self.assertEqual(title_index.search('記事'), [])
+        post = Post.objects.create(title='コミットする記事', text='本文', description='説明')
+        with transaction.atomic():
+            Post.objects.create(title='ロールバックする記事', text='本文', description='説明')
+            transaction.set_rollback(True)
+        pk = post.pk
+        self.assertEqual(title_index.search('記事'), [(pk, 'コミットする記事')])
+
+        with transaction.atomic():
+            post.delete()
+            # コミットするまでは、他のリクエストからはまだ見える
+            self.assertEqual(title_index.search('記事'), [(pk, 'コミットする記事')])
+        self.assertEqual(title_index.search('記事'), [])
+
+    def test_expire(self):
+        post = Post.objects.create(title='記事', text='本文', description='説明')
+        self.assertEqual(title_index.search('記事'), [(post.pk, '記事')])
+        # シグナルが届かない、他のプロセスでの変更
+        Post.objects.filter(pk=post.pk).update(title='変更後の記事')
+        self.assertEqual(title_index.search('記事'), [(post.pk, '記事')])
+        with mock.patch('time.time', return_value=time.time() + settings.SUGGEST_INDEX_TIMEOUT + 1):
+            self.assertEqual(title_index.search('記事'), [(post.pk, '変更後の記事')])
+
+
+class NotificationOutboxTests(TransactionTestCase):
+    """コメント・返信の通知メールのジョブが、コミットした場合だけ登録・実行されることの確認
+
+    Django 3.1にはcaptureOnCommitCallbacksがないので、コミットを実際に行うTransactionTestCaseで確かめます。
+
+    """
+
+    def setUp(self):
+        self.post = Post.objects.create(title='記事', text='本文', description='説明')
+        patcher = mock.patch.object(jobs.drainer, 'wake')
+        self.wake = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, model, **kwargs):
+        obj = model(text='本文', **kwargs)
+        obj.request = RequestFactory().post('/')
+        obj.request.session = SessionStore()
+        obj.save()
+        return obj
+
+    def test_rollback(self):
+        with transaction.atomic():
+            comment = self.create(Comment, target=self.post, email='commenter@example.com')
+            self.create(Reply, target=comment)
+            self.assertEqual(Job.objects.count(), 2)
+            transaction.set_rollback(True)
+        self.assertFalse(Job.objects.exists())
+        self.wake.assert_not_called()
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(mail.outbox, [])
+
+    def test_send_after_commit(self):
+        with transaction.atomic():
+            comment = self.create(Comment, target=self.post, email='commenter@example.com')
+            # コミットするまでは、実行もメールの送信もしない
+            self.wake.assert_not_called()
+        self.wake.assert_called_once_with('nblog1.send_comment_mail')
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+        with transaction.atomic():
+            self.create(Reply, target=comment)
+            self.assertEqual(self.wake.call_count, 1)
+        self.wake.assert_called_with('nblog1.send_reply_mail')
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIn('commenter@example.com', mail.outbox[1].to)
+
+
+class SubscriberTests(TestCase):
+    """メール購読者の登録と、import_subscribersコマンドの確認"""
+
+    def import_subscribers(self, text, *args):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        stdin = io.StringIO(text)
+        with mock.patch('sys.stdin', stdin):
+            call_command('import_subscribers', '-', *args, stdout=stdout, stderr=stderr)
+        # 標準入力は閉じない
+        self.assertFalse(stdin.closed)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import_jsonl(self):
+        EmailPush.objects.create(mail='exists@example.com')
+        stdout, stderr = self.import_subscribers(
+            '{"mail": "a@example.com", "digest": true}\n'
+            '{"mail": "broken@example.com"\n'
+            '["not", "an", "object"]\n'
+            '\n'
+            '{"mail": "invalid"}\n'
+            '{"mail": "exists@example.com"}\n'
+            '{"mail": "b@example.com", "is_active": "0"}\n',
+            '--format', 'jsonl',
+        )
+        self.assertIn('6件を読み込み、2件を登録しました。(登録済み: 1件, 読み飛ばした行: 3件)', stdout)
+        self.assertIn('2行目', stderr)
+        self.assertIn('3行目', stderr)
+        self.assertIn('5行目', stderr)
+        self.assertEqual(
+            list(EmailPush.objects.order_by('mail').values_list('mail', 'is_active', 'digest')),
+            [('a@example.com', True, True), ('b@example.com', False, False), ('exists@example.com', False, False)],
+        )
+
+    def test_import_csv(self):
+        stdout, stderr = self.import_subscribers(
+            'mail,is_active,digest\na@example.com,1,0\nnot-a-mail,1,0\n', '--format', 'csv',
+        )
+        self.assertIn('2件を読み込み、1件を登録しました。', stdout)
+        self.assertIn('3行目', stderr)
+
+    def test_subscribe_again(self):
+        # 仮登録のままのメールアドレスは、同じレコードで確認メールを送り直す
+        push = EmailPush.objects.create(mail='a@example.com')
+        url = reverse('nblog1:subscribe_email')
+        response = self.client.post(url, {'mail': 'a@example.com', 'digest': 'on'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(EmailPush.objects.values_list('pk', 'digest')), [(push.pk, True)])
+        self.assertEqual(len(mail.outbox), 1)
+
+        # 本登録済みなら、登録済みのエラー
+        EmailPush.objects.filter(pk=push.pk).update(is_active=True)
+        response = self.client.post(url, {'mail': 'a@example.com'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['mail'][0]['message'], 'メールアドレスは登録済みです！')
+
+
+class EnqueueTests(TestCase):
+    """ジョブの重複防止キーと、失敗したジョブの再実行の確認"""
+
+    def register(self, name, func):
+        jobs.job(name)(func)
+        self.addCleanup(jobs._registry.pop, name)
+
+    def test_same_key(self):
+        job = jobs.enqueue('nblog1.notify_line', {'post_pk': 1}, key='notify_line:1')
+        self.assertEqual(jobs.enqueue('nblog1.notify_line', {'post_pk': 1}, key='notify_line:1'), job)
+        # 完了したものと同じキーなら、新たに登録する
+        Job.objects.filter(pk=job.pk).update(status=Job.DONE)
+        self.assertNotEqual(jobs.enqueue('nblog1.notify_line', {'post_pk': 1}, key='notify_line:1'), job)
+        self.assertEqual(Job.objects.count(), 2)
+
+    def test_concurrent_enqueue(self):
+        existing = Job.objects.create(name='nblog1.notify_line', key='notify_line:1')
+        first = QuerySet.first
+        calls = []
+
+        def miss_once(queryset):
+            # 他のリクエストが、確認と登録の間に同じキーで登録した場合
+            calls.append(queryset)
+            return None if len(calls) == 1 else first(queryset)
+
+        with mock.patch.object(QuerySet, 'first', miss_once):
+            job = jobs.enqueue('nblog1.notify_line', {'post_pk': 1}, key='notify_line:1')
+        self.assertEqual(job, existing)
+        self.assertEqual(Job.objects.count(), 1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Job.objects.create(name='nblog1.notify_line', key='notify_line:1')
+
+        # キーのないジョブは、いくつでも登録できる
+        jobs.enqueue('nblog1.notify_line')
+        jobs.enqueue('nblog1.notify_line')
+        self.assertEqual(Job.objects.filter(key='').count(), 2)
+
+    def test_retry_and_dead(self):
+        calls = []
+
+        def fail(payload):
+            calls.append(payload)
+            raise ValueError('失敗')
+
+        self.register('tests.fail', fail)
+        job = jobs.enqueue('tests.fail', {'n': 1}, max_attempts=3)
+        with self.assertLogs('nblog1.jobs', 'WARNING'):
+            for attempts in (1, 2):
+                before = timezone.now()
+                self.assertEqual(jobs.run_pending(), 1)
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), (Job.PENDING, attempts))
+                self.assertIn('ValueError: 失敗', job.last_error)
+                # 失敗するたびに、再実行までの間隔が倍になる
+                delay = jobs.RETRY_BASE_DELAY * 2 ** (attempts - 1)
+                self.assertGreaterEqual(job.run_at, before + timedelta(seconds=delay))
+                self.assertLessEqual(job.run_at, timezone.now() + timedelta(seconds=delay))
+                # 実行予定日時までは実行しない
+                self.assertEqual(jobs.run_pending(), 0)
+                Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+
+            # max_attempts回失敗したら、デッドレターになり、もう実行しない
+            self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 3))
+        self.assertEqual(jobs.run_pending(), 0)
+        self.assertEqual(calls, [{'n': 1}] * 3)
+
+    def test_retry_jobs(self):
+        self.register('tests.succeed', lambda payload: None)
+        dead = Job.objects.create(name='tests.succeed', status=Job.DEAD, attempts=5, last_error='エラー')
+        done = Job.objects.create(name='tests.succeed', status=Job.DONE, attempts=1)
+        modeladmin = mock.Mock()
+        retry_jobs(modeladmin, RequestFactory().post('/'), Job.objects.all())
+        modeladmin.message_user.assert_called_once()
+
+        dead.refresh_from_db()
+        self.assertEqual((dead.status, dead.attempts), (Job.PENDING, 0))
+        done.refresh_from_db()
+        self.assertEqual(done.status, Job.DONE)
+        # 再実行して成功すれば、エラーも消える
+        self.assertEqual(jobs.run_pending(), 1)
+        dead.refresh_from_db()
+        self.assertEqual((dead.status, dead.attempts, dead.last_error), (Job.DONE, 1, ''))
+
+
+class MediaServeTests(TestCase):
+    """メディアファイルの配信ビューの、Range・条件付きGET・sendfileのヘッダの確認"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        media_root = os.path.join(self.temp_dir, 'media')
+        os.makedirs(os.path.join(media_root, 'blobs', 'aa'))
+        with open(os.path.join(media_root, 'blobs', 'aa', 'file.txt'), 'wb') as file:
+            file.write(b'0123456789')
+        with open(os.path.join(self.temp_dir, 'secret.txt'), 'wb') as file:
+            file.write(b'secret')
+        overridden = override_settings(MEDIA_ROOT=media_root, MEDIA_SENDFILE='django')
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.url = '/media/blobs/aa/file.txt'
+
+    def get(self, url=None, **headers):
+        return self.client.get(url or self.url, **{f'HTTP_{name}': value for name, value in headers.items()})
+
+    def test_full(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_range(self):
+        for header, content, content_range in (
+            ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+            ('bytes=7-', b'789', 'bytes 7-9/10'),
+            ('bytes=8-100', b'89', 'bytes 8-9/10'),
+            # 末尾からの範囲
+            ('bytes=-3', b'789', 'bytes 7-9/10'),
+            ('bytes=-100', b'0123456789', 'bytes 0-9/10'),
+        ):
+            with self.subTest(header=header):
+                response = self.get(RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b''.join(response.streaming_content), content)
+                self.assertEqual(response['Content-Range'], content_range)
+                self.assertEqual(response['Content-Length'], str(len(content)))
+
+        # 複数の範囲には対応せず、全体を返す
+        response = self.get(RANGE='bytes=0-1,4-5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_range_not_satisfiable(self):
+        for header in ('bytes=10-', 'bytes=5-2', 'bytes=-0'):
+            with self.subTest(header=header):
+                response = self.get(RANGE=header)
+                self.assertEqual(response.status_code, 416)
+                self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(RANGE='bytes=0-1', IF_RANGE=etag).status_code, 206)
+        # ファイルが変わっていれば、全体を返す
+        response = self.get(RANGE='bytes=0-1', IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(self.get(IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get(IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        response = self.get(IF_NONE_MATCH=response['ETag'], RANGE='bytes=0-1')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.get(IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_not_found(self):
+        for url in (
+            '/media/../secret.txt', '/media/blobs/../../secret.txt', '/media/%2e%2e/secret.txt',
+            '/media/blobs/aa/missing.txt', '/media/blobs/aa/', '/media/blobs/aa/file.txt/x',
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.get(url).status_code, 404)
+        # URLの正規化を通さずに、ビューに渡された場合も
+        for path in ('../secret.txt', 'blobs/../../secret.txt', os.path.join(self.temp_dir, 'secret.txt')):
+            with self.subTest(path=path), self.assertRaises(Http404):
+                media.serve(RequestFactory().get('/'), path)
+
+    def test_sendfile(self):
+        with override_settings(MEDIA_SENDFILE='x-accel-redirect', MEDIA_ACCEL_PREFIX='/protected-media/'):
+            response = self.get('/media/blobs/aa/file.txt')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/blobs/aa/file.txt')
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertIn('ETag', response)
+            # 条件付きGETには、nginxに任せずに304を返す
+            self.assertEqual(self.get(IF_NONE_MATCH=response['ETag']).status_code, 304)
+        with override_settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.get()
+            self.assertEqual(response['X-Sendfile'], os.path.join(settings.MEDIA_ROOT, 'blobs', 'aa', 'file.txt'))
+            self.assertEqual(response.content, b'')
+
+
+class ExportStaticTests(TestCase):
+    """export_staticコマンドの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.post = Post.objects.create(title='記事', text='本文', description='説明')
+        cls.relation_post = Post.objects.create(title='関連記事', text='本文', description='説明')
+        cls.post.relation_posts.add(cls.relation_post)
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def export(self, *args):
+        stdout = io.StringIO()
+        call_command('export_static', self.output_dir, *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def read(self, post):
+        path = os.path.join(self.output_dir, 'blog', 'detail', str(post.pk), 'index.html')
+        with open(path, encoding='utf-8') as file:
+            return file.read()
+
+    def test_default_site_host(self):
+        # 既定のサイト(example.com)は、ALLOWED_HOSTSになくても書き出せる
+        self.assertIn('2件の記事', self.export())
+        self.assertIn('関連記事', self.read(self.post))
+
+    def test_related_post_changed(self):
+        self.export()
+        self.relation_post.title = '新しい関連記事'
+        self.relation_post.updated_at = timezone.now()
+        self.relation_post.save()
+        # 関連記事として表示している記事も書き出し直す
+        self.assertIn('2件の記事', self.export())
+        self.assertIn('新しい関連記事', self.read(self.post))
+
+        self.assertIn('変更された記事はありません。', self.export())
+
+    @override_settings(USE_KEYSET_PAGINATION=True)
+    def test_keyset_pagination(self):
+        Post.objects.bulk_create([Post(title=f'一覧の記事{i}', text='本文', description='説明') for i in range(20)])
+        self.export()
+
+        def read_listing(query):
+            path = os.path.join(self.output_dir, output_path(f'/blog/?{query}' if query else '/blog/', 'text/html'))
+            with open(path, encoding='utf-8') as file:
+                html = file.read()
+            links = dict(re.findall(r'href="\?(cursor=[^"]+)"\s+title="(前|次)ページへ"', html))
+            titles = re.findall(r'一覧の記事\d+|関連記事|>記事<', html)
+            return titles, {direction: query for query, direction in links.items()}
+
+        # 「次へ」のリンクをたどると、全ての記事が1回ずつ書き出されている
+        pages = [read_listing('')]
+        while '次' in pages[-1][1]:
+            pages.append(read_listing(pages[-1][1]['次']))
+        self.assertEqual([len(titles) for titles, _ in pages], [10, 10, 2])
+        self.assertEqual(len({title for titles, _ in pages for title in titles}), 22)
+        # 「前へ」のリンクも書き出されている
+        for previous, (_, links) in zip(pages, pages[1:]):
+            self.assertEqual(read_listing(links['前'])[0], previous[0])
+
+
+class FeedCacheTests(TestCase):
+    """フィードのキャッシュが、他のプロセスでの変更に備えて期限切れになることの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.post = Post.objects.create(title='記事', text='本文', description='説明')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_expire(self):
+        url = reverse('nblog1:rss')
+        self.assertContains(self.client.get(url), '記事')
+        # シグナルが届かない、他のプロセスでの変更
+        Post.objects.filter(pk=self.post.pk).update(title='変更後')
+        self.assertNotContains(self.client.get(url), '変更後')
+        with mock.patch('time.time', return_value=time.time() + settings.FEED_CACHE_TIMEOUT + 1):
+            self.assertContains(self.client.get(url), '変更後')
+
+    def test_version_expire(self):
+        versions = page_cache.get_versions([page_cache.POSTS])
+        self.assertEqual(page_cache.get_versions([page_cache.POSTS]), versions)
+        with mock.patch('time.time', return_value=time.time() + settings.CACHE_VERSION_TIMEOUT + 1):
+            self.assertNotEqual(page_cache.get_versions([page_cache.POSTS]), versions)
+
+
+class SitemapTests(TestCase):
+    """サイトマップの、エンコーディングごとのレスポンスの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Post.objects.create(title='記事', text='本文', description='説明')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_etag_per_encoding(self):
+        url = reverse('sitemap_index')
+        compressed = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        identity = self.client.get(url)
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertFalse(identity.has_header('Content-Encoding'))
+        self.assertNotEqual(compressed['ETag'], identity['ETag'])
+        for response in (compressed, identity):
+            self.assertIn('Accept-Encoding', response['Vary'])
+
+        # 他のエンコーディングのETagでは、304を返さない
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, identity.content)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=compressed['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_expire(self):
+        url = reverse('sitemap_section', kwargs={'section': 'posts'})
+        self.assertEqual(len(re.findall('<url>', self.client.get(url).content.decode())), 1)
+        # シグナルが届かない、他のプロセスでの変更
+        Post.objects.bulk_create([Post(title='記事', text='本文', description='説明')])
+        self.assertEqual(len(re.findall('<url>', self.client.get(url).content.decode())), 1)
+        with mock.patch('time.time', return_value=time.time() + settings.SITEMAP_CACHE_TIMEOUT + 1):
+            self.assertEqual(len(re.findall('<url>', self.client.get(url).content.decode())), 2)
+
+
+class SearchTests(TestCase):
+    """全文検索が、icontainsと同じく部分一致で記事を見つけることの確認"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.summary = Post.objects.create(title='令和3年のまとめ', text='本文', description='説明')
+        cls.django = Post.objects.create(title='タイトル', text='この記事Djangoの使い方', description='説明')
+        cls.python = Post.objects.create(title='Python入門', text='snake_case', description='説明')
+
+    def search(self, key_word):
+        return set(search_posts(Post.objects.all(), key_word))
+
+    def test_japanese(self):
+        self.assertEqual(self.search('まとめ'), {self.summary})
+        self.assertEqual(self.search('とめ'), {self.summary})
+        self.assertEqual(self.search('ま'), {self.summary})
+        self.assertEqual(self.search('め'), {self.summary})
+
+    def test_mixed_script(self):
+        self.assertEqual(self.search('令和3年'), {self.summary})
+        self.assertEqual(self.search('和3'), {self.summary})
+        self.assertEqual(self.search('記事Django'), {self.django})
+        self.assertEqual(self.search('事D'), {self.django})
+        self.assertEqual(self.search('python入'), {self.python})
+
+    def test_digit(self):
+        self.assertEqual(self.search('3'), {self.summary})
+        self.assertEqual(self.search('3年'), {self.summary})
+        self.assertEqual(self.search('4年'), set())
+
+    def test_substring(self):
+        self.assertEqual(self.search('ytho'), {self.python})
+        self.assertEqual(self.search('YTHON'), {self.python})
+        self.assertEqual(self.search('n'), {self.django, self.python})
+        self.assertEqual(self.search('case'), {self.python})
+        self.assertEqual(self.search('ythn'), set())
+
+    def test_and(self):
+        self.assertEqual(self.search('ytho 入門'), {self.python})
+        self.assertEqual(self.search('ytho まとめ'), set())
+
+
+def start_stub_server(testcase, handler_class):
+    """ローカルにスタブのHTTPサーバーを起動し、そのURLを返す。テストの終了時に停止する。"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    testcase.addCleanup(server.server_close)
+    testcase.addCleanup(server.shutdown)
+    testcase.server = server
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """受け取ったJSONを記録し、respondの結果を返すハンドラ"""
+
+    def respond(self, request_count):
+        return 200, {}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            status, headers = self.respond(server.request_count)
+            if status == 200:
+                server.received.append(body)
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        except ConnectionError:
+            # タイムアウトのテスト等で、クライアントが先に接続を切った
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLineApiHandler(StubHandler):
+    """LINEのAPIの代わり。最初の1回は429を返す。"""
+
+    def respond(self, request_count):
+        if request_count == 1:
+            return 429, {'Retry-After': '0'}
+        return 200, {}
+
+
+class FailOnceLineApiHandler(StubHandler):
+    """LINEのAPIの代わり。2回目のリクエストだけ400を返す。"""
+
+    def respond(self, request_count):
+        if request_count == 2:
+            return 400, {}
+        return 200, {}
+
+
+class LinePushTests(TestCase):
+    """ラインでの通知を、ローカルのスタブサーバーに送って確認する"""
+
+    def test_multicast_in_batches(self):
+        endpoint = start_stub_server(self, StubLineApiHandler)
+        LinePush.objects.bulk_create([LinePush(user_id=f'U{i:05}') for i in range(1201)])
+        post = Post.objects.create(title='記事', text='本文', description='説明')
+        with override_settings(USE_LINE_BOT=True, LINE_BOT_API_KEY='token', LINE_API_ENDPOINT=endpoint):
+            post.line_push(RequestFactory().get('/'))
+
+        received = self.server.received
+        self.assertEqual(sorted(len(body['to']) for body in received), [201, 500, 500])
+        user_ids = [user_id for body in received for user_id in body['to']]
+        self.assertEqual(sorted(user_ids), [f'U{i:05}' for i in range(1201)])
+        self.assertIn('記事', received[0]['messages'][0]['text'])
+
+    def test_retry_failed_chunk(self):
+        endpoint = start_stub_server(self, FailOnceLineApiHandler)
+        LinePush.objects.bulk_create([LinePush(user_id=f'U{i:05}') for i in range(1201)])
+        post = Post.objects.create(title='記事', text='本文', description='説明')
+        with override_settings(USE_LINE_BOT=True, LINE_BOT_API_KEY='token', LINE_API_ENDPOINT=endpoint):
+            post.line_push(RequestFactory().get('/'))
+            # 失敗したまとまりだけが、送り直すジョブになる
+            job = Job.objects.get(name='nblog1.multicast_line')
+            self.assertEqual(len(self.server.received), 2)
+            sent = {user_id for body in self.server.received for user_id in body['to']}
+            self.assertFalse(sent & set(job.payload['user_ids']))
+            self.assertEqual(jobs.run_pending(names=['nblog1.multicast_line']), 1)
+
+        user_ids = [user_id for body in self.server.received for user_id in body['to']]
+        self.assertEqual(sorted(user_ids), [f'U{i:05}' for i in range(1201)])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+
+    def test_multicast_streams_recipients(self):
+        consumed = []
+
+        def user_ids():
+            for i in range(10000):
+                consumed.append(i)
+                yield f'U{i:05}'
+
+        release = threading.Event()
+
+        def send(chunk, messages):
+            release.wait(5)
+            return len(chunk)
+
+        client = LineClient('token')
+        window = client.http.max_concurrency
+        result = []
+        with mock.patch.object(client, '_multicast', side_effect=send):
+            thread = threading.Thread(target=lambda: result.append(client.multicast(user_ids(), [])))
+            thread.start()
+            time.sleep(0.2)
+            # 送信中のまとまりと、空きを待っている1つ分だけを読み込んでいる
+            self.assertLessEqual(len(consumed), (window + 1) * MULTICAST_MAX_RECIPIENTS)
+            release.set()
+            thread.join()
+        self.assertEqual(result, [10000])
+
+
+class ServerErrorHandler(StubHandler):
+
+    def respond(self, request_count):
+        return 500, {}
+
+
+class SlowHandler(StubHandler):
+
+    def respond(self, request_count):
+        time.sleep(0.5)
+        return 200, {}
+
+
+class HttpClientTests(TestCase):
+    """外部API用のHTTPクライアントを、ローカルのスタブサーバーに送って確認する"""
+
+    def test_browser_push(self):
+        endpoint = start_stub_server(self, StubHandler)
+        post = Post.objects.create(title='記事', text='本文', description='説明')
+        with override_settings(USE_WEB_PUSH=True, ONE_SIGNAL_API_ENDPOINT=endpoint,
+                               ONE_SIGNAL_APP_ID='app', ONE_SIGNAL_REST_KEY='key'):
+            post.browser_push()
+        self.assertEqual(self.server.received[0]['contents'], {'en': '記事'})
+
+    def test_read_timeout(self):
+        endpoint = start_stub_server(self, SlowHandler)
+        client = HttpClient('test', read_timeout=0.1)
+        with self.assertRaises(requests.Timeout):
+            client.post(endpoint, json={})
+
+    def test_circuit_breaker(self):
+        endpoint = start_stub_server(self, ServerErrorHandler)
+        client = HttpClient('test', failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            self.assertEqual(client.post(endpoint, json={}).status_code, 500)
+        with self.assertRaises(CircuitOpenError):
+            client.post(endpoint, json={})
+        self.assertEqual(self.server.request_count, 2)
+
+
+class ListViewQueryPlanTests(QueryPlanMixin, TestCase):
+    """記事一覧等のクエリが、記事やコメントが多くてもインデックスを使うことの確認"""
+    full_scan_allowed = ('nblog1_tag',)
+
+    @classmethod
+    def setUpTestData(cls):
+        Post.objects.bulk_create([
+            Post(title=f'記事{i}', text='本文', description='説明', is_public=i % 10 != 0) for i in range(2000)
+        ])
+        cls.tag = Tag.objects.create(name='タグ')
+        cls.tag.post_set.add(*Post.objects.filter(pk__lte=500))
+        cls.post = Post.objects.filter(is_public=True).first()
+        Comment.objects.bulk_create([Comment(target=cls.post, text=f'コメント{i}') for i in range(200)])
+        other = Post.objects.filter(is_public=True).last()
+        Comment.objects.bulk_create([Comment(target=other, text=f'コメント{i}') for i in range(2000)])
+        Reply.objects.bulk_create([Reply(target=comment, text='返信') for comment in Comment.objects.all()[:500]])
+        cls.user = get_user_model().objects.create_user('user', password='password')
+
+    def test_post_list(self):
+        top = reverse('nblog1:top')
+        for url in (top, f'{top}?page=5', f'{top}?tags={self.tag.pk}', f'{top}?key_word=記事'):
+            with self.subTest(url=url):
+                self.assertNoFullScan(url)
+
+    @override_settings(USE_KEYSET_PAGINATION=True)
+    def test_post_list_keyset(self):
+        self.assertNoFullScan(reverse('nblog1:top'))
+
+    def test_private_post_list(self):
+        self.client.force_login(self.user)
+        self.assertNoFullScan(reverse('nblog1:private_post_list'))
+
+    def test_post_detail(self):
+        self.assertNoFullScan(reverse('nblog1:post_detail', kwargs={'pk': self.post.pk}))
+
+    def test_feeds(self):
+        for url in (
+            reverse('nblog1:rss'), reverse('nblog1:atom'),
+            reverse('nblog1:tag_rss', kwargs={'pk': self.tag.pk}),
+            reverse('nblog1:tag_atom', kwargs={'pk': self.tag.pk}),
+        ):
+            with self.subTest(url=url):
+                self.assertNoFullScan(url)
+
+    def test_sitemaps(self):
+        for url in (reverse('sitemap_index'), reverse('sitemap_section', kwargs={'section': 'posts'}) + '?p=2'):
+            with self.subTest(url=url):
+                self.assertNoFullScan(url)
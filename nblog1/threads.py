@@ -0,0 +1,50 @@
+"""記事詳細ページのコメント欄の読み込み。
+
+コメントと返信は、コメントの件数に関わらず2回のクエリで取得し、
+(コメント, そのコメントへの返信のリスト)の組のリストにしてテンプレートに渡します。
+本文は保存済みのHTMLを使うので、マークダウンの本文(text)は読み込みません。
+変換設定が変わる等して保存済みのHTMLが古いものだけ、本文をまとめて1回で読み込んで変換し直します。
+
+"""
+from collections import defaultdict, namedtuple
+from .models import Comment, Reply
+from .rendering import config_digest
+
+CommentThread = namedtuple('CommentThread', ['comment', 'replies'])
+
+# コメント欄の表示に必要な列
+THREAD_FIELDS = ('pk', 'name', 'created_at', 'target', 'text_html', 'text_html_key')
+
+
+def render_stale_html(objects):
+    """保存済みのHTMLが古いものについて、本文をまとめて読み込んでHTMLに変換し直す。
+
+    textを読み込んでいないインスタンスでhtmlを使うと、1件ごとに本文を読み込むクエリが発生するため、
+    その前にここで変換しておきます。変換結果は保存しません(render_markdownコマンドで保存してください)。
+
+    """
+    if not objects:
+        return
+    model = type(objects[0])
+    prefix = config_digest(model.escape_html) + ':'
+    stale = {obj.pk: obj for obj in objects if not obj.text_html_key.startswith(prefix)}
+    if not stale:
+        return
+    for pk, text in model.objects.filter(pk__in=stale).values_list('pk', 'text'):
+        obj = stale[pk]
+        obj.text = text
+        obj.render_text()
+
+
+def load_comment_threads(post):
+    """記事のコメントと返信を読み込み、CommentThreadのリストを返す。"""
+    comments = list(Comment.objects.filter(target=post).only(*THREAD_FIELDS).order_by('created_at', 'pk'))
+    # 返信はコメントのpkをIN句で並べず、コメントとJOINして1回で取得する
+    replies = list(Reply.objects.filter(target__target=post).only(*THREAD_FIELDS).order_by('created_at', 'pk'))
+    render_stale_html(comments)
+    render_stale_html(replies)
+
+    replies_by_comment = defaultdict(list)
+    for reply in replies:
+        replies_by_comment[reply.target_id].append(reply)
+    return [CommentThread(comment, replies_by_comment[comment.pk]) for comment in comments]
@@ -0,0 +1,125 @@
+"""ファイルの分割アップロード。
+
+大きなファイルも1回のリクエストでは送らず、ブラウザ側でUPLOAD_CHUNK_SIZEずつに分けて順に送ります。
+
+1. POST image/upload/ にファイル名・サイズ・SHA-256を送ると、送信先のURLと受信済みのサイズ(offset)が返る。
+   同じユーザーが同じファイルを途中まで送っていれば、その続きのoffsetが返るので、そこから再開できる。
+2. PUT image/upload/<id>/ に、Upload-Offsetヘッダでoffsetを付けてデータを送る。
+   offsetが合わなければ409と現在のoffsetが返る。
+3. 全て受信したら、ファイル全体のSHA-256を確かめてストレージに保存し、そのURLを返す。
+   画像であれば、縮小版・WebP(images.create_variants)を作るジョブを登録する(run_jobsのワーカーが実行する)。
+
+受信したデータはメモリに溜めず、BLOCK_SIZEずつ一時ファイルに書き込みます。
+ブラウザ側(upload.js)も、ファイル全体はメモリに読み込まず、SHA-256は少しずつ読み込みながら計算します。
+
+"""
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from .jobs import enqueue
+from .models import ChunkedUpload
+
+# 一度に読み書きするサイズ
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """アップロードされたデータが正しくない"""
+
+
+class OffsetMismatch(UploadError):
+    """送られたデータの位置が、受信済みのサイズと合わない"""
+
+
+def get_temp_dir():
+    return os.path.join(settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), 'nblog1_uploads')
+
+
+def part_path(upload):
+    """受信中のデータを書き込む一時ファイルのパス"""
+    return os.path.join(get_temp_dir(), f'{upload.pk}.part')
+
+
+def start(user, name, size, sha256):
+    """アップロードを開始する。同じファイルを途中まで受信していれば、それを返す。"""
+    delete_expired()
+    upload = ChunkedUpload.objects.filter(user=user, name=name, size=size, sha256=sha256).first()
+    if upload is None:
+        upload = ChunkedUpload.objects.create(user=user, name=name, size=size, sha256=sha256)
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """streamから読み込んだlengthバイトを、一時ファイルのoffsetの位置に書き込む。
+
+    ストリームから少しずつ読み込んで書き込むので、チャンクの全体をメモリに載せることはありません。
+
+    """
+    if offset != upload.offset:
+        raise OffsetMismatch(f'offsetは{upload.offset}です。')
+    if length <= 0 or length > settings.UPLOAD_CHUNK_SIZE or offset + length > upload.size:
+        raise UploadError('データのサイズが正しくありません。')
+
+    path = part_path(upload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as file:
+        # 前回のリクエストが途中で切れていた場合に備え、受信済みの位置より後ろは捨てる
+        file.truncate(offset)
+        remaining = length
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                raise UploadError('データが途中で切れました。')
+            file.write(block)
+            remaining -= len(block)
+
+    # 同じアップロードに並行して送られた場合、後のほうは失敗させる
+    updated = ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(offset=offset + length)
+    if not updated:
+        raise OffsetMismatch('他のリクエストが先に書き込みました。')
+    upload.offset = offset + length
+
+
+def finish(upload):
+    """受信したファイルのSHA-256を確かめ、ストレージに保存する。保存したファイルの名前を返す。
+
+    SHA-256が合わなければ受信したデータは捨て、UploadErrorを送出します。
+
+    """
+    path = part_path(upload)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(BLOCK_SIZE), b''):
+            digest.update(block)
+        if digest.hexdigest() != upload.sha256:
+            discard(upload)
+            raise UploadError('SHA-256が一致しません。')
+        file.seek(0)
+        name = default_storage.save(upload.name, File(file))
+    discard(upload)
+
+    # 画像であれば、縮小版・WebPはジョブで作る。CPUを使うので、Webのプロセスではなくrun_jobsのワーカーに任せる。
+    if os.path.splitext(name)[1].lower() in settings.IMAGE_VARIANT_EXTENSIONS:
+        enqueue('nblog1.create_image_variants', {'name': name}, key=f'image_variants:{name}')
+    return name
+
+
+def discard(upload):
+    """アップロードを、一時ファイルごと削除する。"""
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+    upload.delete()
+
+
+def delete_expired():
+    """UPLOAD_EXPIRE秒以上前に開始され、終わっていないアップロードを削除する。"""
+    expired = ChunkedUpload.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=settings.UPLOAD_EXPIRE))
+    for upload in expired:
+        discard(upload)
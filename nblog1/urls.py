@@ -20,7 +20,10 @@ urlpatterns = [
 
     path('posts/suggest/', views.posts_suggest, name='posts_suggest'),
     path('image/upload/', views.image_upload, name='image_upload'),
+    path('image/upload/<uuid:pk>/', views.image_upload_chunk, name='image_upload_chunk'),
 
     path('rss/', feeds.RssLatestPostsFeed(), name='rss'),
     path('atom/', feeds.AtomLatestPostsFeed(), name='atom'),
+    path('rss/tag/<int:pk>/', feeds.RssTagPostsFeed(), name='tag_rss'),
+    path('atom/tag/<int:pk>/', feeds.AtomTagPostsFeed(), name='tag_atom'),
 ]
@@ -1,21 +1,37 @@
 import json
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.files.storage import default_storage
 from django.core.mail import EmailMessage
 from django.core.signing import BadSignature, SignatureExpired, loads, dumps
-from django.db.models import Q
-from django.http import Http404, JsonResponse, HttpResponseBadRequest, HttpResponse
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import Http404, JsonResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_http_methods, require_POST
 from .forms import (
     PostSearchForm, CommentCreateForm, ReplyCreateForm,
-    EmailForm, FileUploadForm, AdminPostCreateForm
+    EmailForm, FileUploadForm, AdminPostCreateForm, ChunkedUploadForm
 )
-from .models import Post, Comment, Reply, EmailPush, LinePush, Tag
-from django.urls import reverse_lazy
+from . import uploads
+from .models import Post, Comment, Reply, EmailPush, LinePush, Tag, ChunkedUpload
+from .page_cache import PageCacheMixin, post_dependency, tag_dependency
+from .pagination import paginate_keyset
+from .search import search_posts
+from .suggest import title_index
+from .tag_index import filter_by_tags
+from .threads import load_comment_threads
+from django.urls import reverse, reverse_lazy
+
+# サジェスト候補の件数と、ブラウザにキャッシュさせる秒数
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+SUGGEST_MAX_AGE = 30
+
 
 class PostCreate(generic.CreateView): #add
     """記事の作成"""
@@ -41,7 +57,7 @@ class PostDelete(generic.DeleteView): #add
     # template_name = 'nblog1/post_confirm_delete.html'
     success_url = reverse_lazy('nblog1:top')
 
-class PublicPostIndexView(generic.ListView):
+class PublicPostIndexView(PageCacheMixin, generic.ListView):
     """公開記事の一覧を表示する。"""
     paginate_by = 10
     model = Post
@@ -49,24 +65,31 @@ class PublicPostIndexView(generic.ListView):
 
     def get_queryset(self):
         queryset = super().get_queryset()
+        # キーワード検索の結果は関連度順に並べるので、キーセットページネーションは使わない
+        self.use_keyset_pagination = settings.USE_KEYSET_PAGINATION
         self.form = form = PostSearchForm(self.request.GET or None)
         if form.is_valid():
             # 選択したタグが含まれた記事
             tags = form.cleaned_data.get('tags')
             if tags:
-                for tag in tags:
-                    queryset = queryset.filter(tags=tag)
+                queryset = filter_by_tags(queryset, tags)
 
-            # タイトルか本文にキーワードが含まれたもの
-            # キーワードが半角スペースで区切られていれば、その回数だけfilterする。つまりAND。
+            # タイトルか本文、説明にキーワードが含まれたもの。関連度の高い順に並べる。
             key_word = form.cleaned_data.get('key_word')
             if key_word:
-                for word in key_word.split():
-                    queryset = queryset.filter(Q(title__icontains=word) | Q(text__icontains=word))
+                self.use_keyset_pagination = False
+                return search_posts(queryset, key_word).prefetch_related('tags')
 
         queryset = queryset.order_by('-updated_at').prefetch_related('tags')
         return queryset
 
+    def paginate_queryset(self, queryset, page_size):
+        """USE_KEYSET_PAGINATIONがTrueなら、cursorパラメータでページを送る。"""
+        if not self.use_keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        page = paginate_keyset(queryset, self.request.GET.get('cursor'), page_size)
+        return None, page, page.object_list, page.has_other_pages()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
@@ -77,14 +100,34 @@ class PrivatePostIndexView(LoginRequiredMixin, PublicPostIndexView):
     """非公開の記事一覧を表示する。"""
     raise_exception = True
     queryset = Post.objects.filter(is_public=False)
+    page_cache = False
 
 
-class PostDetailView(generic.DetailView):
+class PostDetailView(PageCacheMixin, generic.DetailView):
     """記事詳細ページを表示する。"""
     model = Post
 
+    def get_page_dependencies(self):
+        """記事自身と、表示しているタグ・関連記事に依存する。
+
+        記事を読み込む前に呼ばれるので、タグと関連記事は紐づけのテーブルから直接読みます。
+
+        """
+        pk = self.kwargs['pk']
+        tag_pks = Post.tags.through.objects.filter(post_id=pk).values_list('tag_id', flat=True)
+        relation_pks = Post.relation_posts.through.objects.filter(from_post_id=pk).values_list('to_post_id', flat=True)
+        return [
+            post_dependency(pk),
+            *[tag_dependency(tag_pk) for tag_pk in tag_pks],
+            *[post_dependency(relation_pk) for relation_pk in relation_pks],
+        ]
+
     def get_queryset(self):
-        return super().get_queryset().prefetch_related('tags', 'comment_set__reply_set')
+        # 関連記事は一覧の表示に使う列だけを読み込む
+        relation_posts = Post.objects.only('pk', 'title', 'description')
+        return super().get_queryset().prefetch_related(
+            'tags', Prefetch('relation_posts', queryset=relation_posts),
+        )
 
     def get_object(self, queryset=None):
         """その記事が公開か、ユーザがログインしていれば表示する。"""
@@ -94,6 +137,11 @@ class PostDetailView(generic.DetailView):
         else:
             raise Http404
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['comment_threads'] = load_comment_threads(self.object)
+        return context
+
 
 class CommentCreate(generic.CreateView):
     """記事へのコメント作成ビュー。"""
@@ -106,7 +154,9 @@ class CommentCreate(generic.CreateView):
         comment = form.save(commit=False)
         comment.target = post
         comment.request = self.request
-        comment.save()
+        # 通知メールのジョブも、コメントと同じトランザクションで登録する
+        with transaction.atomic():
+            comment.save()
         return redirect('nblog1:post_detail', pk=post_pk)
 
     def get_context_data(self, **kwargs):
@@ -127,7 +177,9 @@ class ReplyCreate(generic.CreateView):
         reply = form.save(commit=False)
         reply.target = comment
         reply.request = self.request
-        reply.save()
+        # 通知メールのジョブも、返信と同じトランザクションで登録する
+        with transaction.atomic():
+            reply.save()
         return redirect('nblog1:post_detail', pk=comment.target.pk)
 
     def get_context_data(self, **kwargs):
@@ -141,7 +193,10 @@ class ReplyCreate(generic.CreateView):
 @require_POST
 def subscribe_email(request):
     """ブログの購読ページ"""
-    form = EmailForm(request.POST)
+    # 仮登録のままのメールアドレスなら、削除せずにそのレコードを使い回し、確認メールを送り直す
+    mail = request.POST.get('mail', '').strip()
+    instance = EmailPush.objects.filter(mail=mail, is_active=False).first() if mail else None
+    form = EmailForm(request.POST, instance=instance)
     # メール購読の処理
     if form.is_valid():
         push = form.save()
@@ -258,17 +313,91 @@ def image_upload(request):
     return HttpResponseBadRequest()
 """
 
+def _can_upload(user):
+    """記事の管理画面と同じく、スタッフで記事の追加か変更の権限を持つユーザーにだけアップロードを許可する。"""
+    return user.is_active and user.is_staff and (
+        user.has_perm('nblog1.add_post') or user.has_perm('nblog1.change_post')
+    )
+
+
+def _upload_state(request, upload):
+    """分割アップロードの、次に送るべき位置等を返す。"""
+    return {
+        'upload_url': request.build_absolute_uri(reverse('nblog1:image_upload_chunk', kwargs={'pk': upload.pk})),
+        'offset': upload.offset,
+        'chunk_size': settings.UPLOAD_CHUNK_SIZE,
+    }
+
+
+@require_POST
 def image_upload(request):
-    """ファイルのアップロード用ビュー"""
-    if request.FILES:
-        print(request.FILES)
-    return HttpResponse()
+    """ファイルの分割アップロードを開始する。
+
+    途中まで送ったファイルであれば、続きの位置を返すので、そこから再開できます。
+
+    """
+    if not _can_upload(request.user):
+        return HttpResponseForbidden()
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+    form = ChunkedUploadForm(data)
+    if not form.is_valid():
+        return JsonResponse(form.errors.get_json_data(), status=400)
+    upload = uploads.start(request.user, **form.cleaned_data)
+    return JsonResponse(_upload_state(request, upload))
+
+
+@require_http_methods(['GET', 'PUT'])
+def image_upload_chunk(request, pk):
+    """分割アップロードのデータを受け取る。GETなら、受信済みの位置を返す。
+
+    リクエストの本文はメモリに読み込まず、少しずつ一時ファイルに書き込みます。
+    最後のデータを受け取ったら、ファイルを保存してそのURLを返します。
+
+    """
+    if not _can_upload(request.user):
+        return HttpResponseForbidden()
+    upload = get_object_or_404(ChunkedUpload, pk=pk, user__pk=request.user.pk)
+    if request.method == 'GET':
+        return JsonResponse(_upload_state(request, upload))
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+        uploads.write_chunk(upload, offset, request, length)
+    except uploads.OffsetMismatch as e:
+        upload.refresh_from_db()
+        return JsonResponse({**_upload_state(request, upload), 'error': str(e)}, status=409)
+    except (KeyError, ValueError, uploads.UploadError) as e:
+        return JsonResponse({**_upload_state(request, upload), 'error': str(e)}, status=400)
+
+    if upload.offset < upload.size:
+        return JsonResponse(_upload_state(request, upload))
+
+    try:
+        name = uploads.finish(upload)
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'url': request.build_absolute_uri(default_storage.url(name))})
 
 def posts_suggest(request):
-    """サジェスト候補の記事をJSONで返す。"""
+    """サジェスト候補の記事をJSONで返す。
+
+    データベースは使わず、メモリ上のタイトルのインデックスから候補を探します。
+
+    """
     keyword = request.GET.get('keyword')
+    try:
+        limit = min(max(int(request.GET.get('limit', SUGGEST_LIMIT)), 1), SUGGEST_MAX_LIMIT)
+    except ValueError:
+        limit = SUGGEST_LIMIT
     if keyword:
-        post_list = [{'pk': post.pk, 'name': str(post)} for post in Post.objects.filter(title__icontains=keyword)]
+        post_list = [{'pk': pk, 'name': title} for pk, title in title_index.search(keyword, limit)]
     else:
         post_list = []
-    return JsonResponse({'object_list': post_list})
+    response = JsonResponse({'object_list': post_list})
+    # 同じキーワードを打ち直した際は、ブラウザのキャッシュを使う
+    patch_cache_control(response, private=True, max_age=SUGGEST_MAX_AGE)
+    return response